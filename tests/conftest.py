@@ -0,0 +1,63 @@
+# Tests run against benchmark.py's fake OpenAI server, in a child process,
+# so that everything from the HTTP client up is the real thing.
+
+import json
+import os
+
+import pytest
+
+from text2table.benchmark import FakeServerConfig, FakeServerProcess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Questions whose datatypes are already known, so that the answers' types
+# don't depend on the fake server. Every run still makes one datatype
+# inference call, which fills in their explanations and units.
+QUESTIONS = {
+    "name": {"text": "What is the child's name?", "datatype": "str"},
+    "age": {"text": "How old is the child?", "datatype": "int"},
+}
+
+
+@pytest.fixture
+def letters():
+    with open(os.path.join(ROOT, "letters-to-santa.json"), encoding="utf-8") as f:
+        return json.load(f)[:6]
+
+
+@pytest.fixture
+def start_server():
+    # Call with FakeServerConfig arguments; every server started is shut
+    # down at the end of the test. Unless a test says otherwise, replies
+    # come back at once and nothing fails.
+    servers = []
+
+    def start(**config):
+        config.setdefault("latency_median", 0.005)
+        config.setdefault("tokens_per_second", 0)
+        server = FakeServerProcess(FakeServerConfig(**config))
+        server.__enter__()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.__exit__(None, None, None)
+
+
+@pytest.fixture
+def make_client():
+    # A client for a fake server that, like create_client's, leaves the
+    # retrying to the engine.
+    import openai
+
+    clients = []
+
+    def make(server):
+        client = openai.OpenAI(api_key="test", base_url=server.base_url, max_retries=0)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
@@ -0,0 +1,89 @@
+import text2table
+
+from text2table.benchmark import canned_reply
+
+from conftest import QUESTIONS
+
+
+def respond(body):
+    # The same replies the fake server gives.
+    return canned_reply(body["messages"], absent_rate=0.5)
+
+
+def test_batch_answers_match_the_interactive_engine(
+    tmp_path, start_server, make_client, letters
+):
+    server = start_server(absent_rate=0.5)
+    expected = text2table.text2table(
+        QUESTIONS, documents=letters, openai_client=make_client(server)
+    )
+
+    backend = text2table.LocalBatchBackend(str(tmp_path / "backend"), respond)
+    table = text2table.batch_text2table(
+        QUESTIONS,
+        documents=letters,
+        directory=str(tmp_path / "job"),
+        backend=backend,
+        poll_interval=0,
+        max_requests_per_file=5,
+    )
+
+    assert list(table.column("document_id")) == [
+        text2table.Document.generated_id(i) for i in range(len(letters))
+    ]
+    assert table.to_dict() == expected.to_dict()
+
+
+def test_a_batch_job_survives_a_restart(tmp_path, letters):
+    backend = text2table.LocalBatchBackend(
+        str(tmp_path / "backend"), respond, polls_until_done=2
+    )
+    directory = str(tmp_path / "job")
+    job = text2table.prepare_batch_job(
+        QUESTIONS,
+        documents=letters,
+        directory=directory,
+        backend=backend,
+        max_requests_per_file=4,
+    )
+    job.submit()
+    assert not job.poll()
+
+    # A new process finds the job where the last one left it.
+    job = text2table.prepare_batch_job(
+        QUESTIONS, documents=letters, directory=directory, backend=backend
+    )
+    job.submit()
+    job.wait(poll_interval=0)
+    table = text2table.ingest_batch_job(job)
+
+    assert len(table) == len(letters)
+    assert (
+        table.to_dict()
+        == text2table.batch_text2table(
+            QUESTIONS,
+            documents=letters,
+            directory=directory,
+            backend=backend,
+            poll_interval=0,
+        ).to_dict()
+    )
+
+
+def test_failed_batch_requests_get_default_values(tmp_path, letters):
+    def respond_or_fail(body):
+        if "How old" in body["messages"][0]["content"]:
+            raise ValueError("no")
+        return respond(body)
+
+    backend = text2table.LocalBatchBackend(str(tmp_path / "backend"), respond_or_fail)
+    table = text2table.batch_text2table(
+        QUESTIONS,
+        documents=letters,
+        directory=str(tmp_path / "job"),
+        backend=backend,
+        poll_interval=0,
+    )
+
+    assert len(table) == len(letters)
+    assert table.column("age") == [None] * len(letters)
@@ -0,0 +1,63 @@
+import text2table
+
+from conftest import QUESTIONS
+
+
+def test_absent_answers_stop_early(start_server, make_client, letters):
+    server = start_server(absent_rate=1.0)
+    metrics = text2table.Metrics()
+    table = text2table.text2table(
+        QUESTIONS,
+        documents=letters,
+        openai_client=make_client(server),
+        early_stop=True,
+        metrics=metrics,
+    )
+
+    assert len(table) == len(letters)
+    assert all(answers == {"name": None, "age": None} for _, answers in table.rows())
+    finish_reasons = metrics.summary()["finish_reasons"]
+    assert finish_reasons["early_stop"] == len(letters) * len(QUESTIONS)
+
+
+def test_stated_answers_are_read_to_the_end(start_server, make_client, letters):
+    server = start_server(absent_rate=0.0)
+    metrics = text2table.Metrics()
+    table = text2table.text2table(
+        QUESTIONS,
+        documents=letters,
+        openai_client=make_client(server),
+        early_stop=True,
+        metrics=metrics,
+    )
+
+    assert all(answers["name"] is not None for _, answers in table.rows())
+    assert "early_stop" not in metrics.summary()["finish_reasons"]
+
+
+def test_cut_short_replies_are_only_reused_by_early_stopping_runs(
+    tmp_path, start_server, make_client, letters
+):
+    server = start_server(absent_rate=1.0)
+    client = make_client(server)
+    cache = text2table.ResponseCache(str(tmp_path / "cache.sqlite3"))
+    # The datatype inference call is cached like any other.
+    cells = len(letters) * len(QUESTIONS) + 1
+
+    def run(**options):
+        return text2table.text2table(
+            QUESTIONS, documents=letters, openai_client=client, cache=cache, **options
+        )
+
+    run(early_stop=True)
+    assert server.stats()["requests"] == cells
+    # Another early-stopping run gets every reply from the cache...
+    run(early_stop=True)
+    assert server.stats()["requests"] == cells
+    # ...but a run that wants whole replies asks again, and caches those,
+    # which then do for either kind of run.
+    run()
+    assert server.stats()["requests"] == 2 * cells - 1
+    run(early_stop=True)
+    run()
+    assert server.stats()["requests"] == 2 * cells - 1
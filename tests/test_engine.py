@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import text2table
+
+from conftest import QUESTIONS
+
+
+def test_every_document_gets_a_row(start_server, make_client, letters):
+    server = start_server(absent_rate=0.0)
+    table = text2table.text2table(
+        QUESTIONS, documents=letters, openai_client=make_client(server)
+    )
+
+    assert table.column_names == ["document_id", "name", "age"]
+    assert sorted(table.column("document_id")) == [
+        text2table.Document.generated_id(i) for i in range(len(letters))
+    ]
+    for _, answers in table.rows():
+        assert isinstance(answers["name"], str)
+        assert isinstance(answers["age"], int)
+    # One call per cell, and one to infer the datatypes.
+    assert server.stats()["requests"] == len(letters) * len(QUESTIONS) + 1
+
+
+def test_answers_are_the_same_from_every_entry_point(
+    start_server, make_client, letters
+):
+    server = start_server()
+    client = make_client(server)
+    table = text2table.text2table(QUESTIONS, documents=letters, openai_client=client)
+    rows = dict(
+        text2table.iter_text2table(QUESTIONS, documents=letters, openai_client=client)
+    )
+
+    async def run_async():
+        import openai
+
+        async with openai.AsyncOpenAI(
+            api_key="test", base_url=server.base_url, max_retries=0
+        ) as async_client:
+            return await text2table.async_text2table(
+                QUESTIONS, documents=letters, openai_client=async_client
+            )
+
+    assert table.to_dict() == rows == asyncio.run(run_async()).to_dict()
+
+
+def test_multi_question_asks_once_per_document(start_server, make_client, letters):
+    server = start_server(absent_rate=0.0)
+    table = text2table.text2table(
+        QUESTIONS,
+        documents=letters,
+        openai_client=make_client(server),
+        multi_question=True,
+    )
+
+    assert len(table) == len(letters)
+    assert all(answers["name"] is not None for _, answers in table.rows())
+    assert server.stats()["requests"] == len(letters) + 1
+
+
+def test_datatypes_are_inferred_when_not_given(start_server, make_client, letters):
+    server = start_server()
+    table = text2table.text2table(
+        {"name": "What is the child's name?"},
+        documents=letters,
+        openai_client=make_client(server),
+    )
+
+    assert [q.datatype for q in table.questions] == [str]
+    assert server.stats()["requests"] == len(letters) + 1
+
+
+def test_options_and_keyword_arguments(start_server, make_client, letters):
+    server = start_server()
+    metrics = text2table.Metrics()
+    options = text2table.ExtractionOptions(max_concurrency=2, multi_question=True)
+    table = text2table.text2table(
+        QUESTIONS,
+        documents=letters,
+        openai_client=make_client(server),
+        options=options,
+        metrics=metrics,
+    )
+
+    assert len(table) == len(letters)
+    assert metrics.summary()["calls"] == len(letters) + 1
+    # The keyword argument applied to this run only.
+    assert options.metrics is None
+
+
+def test_unknown_options_are_rejected():
+    with pytest.raises(TypeError):
+        text2table.ExtractionOptions(early_stopping=True)
+    with pytest.raises(TypeError):
+        text2table.ExtractionOptions().replace(concurrency=4)
+
+
+def test_changed_options():
+    options = text2table.ExtractionOptions(early_stop=True, max_concurrency=16)
+    assert options.changed() == {"early_stop": True}
+    assert options.replace(early_stop=False).changed() == {}
@@ -0,0 +1,75 @@
+import text2table
+
+from conftest import QUESTIONS
+
+
+def test_resume_skips_cells_already_answered(
+    tmp_path, start_server, make_client, letters
+):
+    path = str(tmp_path / "journal.jsonl")
+    first = start_server()
+    table = text2table.text2table(
+        QUESTIONS,
+        documents=letters[:4],
+        openai_client=make_client(first),
+        journal=text2table.ExtractionJournal(path),
+    )
+
+    # The second run picks up where the first one stopped: only the two new
+    # documents are asked about (besides the datatypes).
+    second = start_server()
+    resumed = text2table.text2table(
+        QUESTIONS,
+        documents=letters,
+        openai_client=make_client(second),
+        journal=text2table.ExtractionJournal(path),
+        resume=True,
+    )
+
+    assert second.stats()["requests"] == 2 * len(QUESTIONS) + 1
+    assert len(resumed) == len(letters)
+    for docid, answers in table.rows():
+        assert resumed.to_dict()[docid] == answers
+
+
+def test_a_finished_job_resumes_without_any_calls(
+    tmp_path, start_server, make_client, letters
+):
+    path = str(tmp_path / "journal.jsonl")
+    first = start_server()
+    table = text2table.text2table(
+        {"name": "What is the child's name?", "age": "How old is the child?"},
+        documents=letters,
+        openai_client=make_client(first),
+        journal=text2table.ExtractionJournal(path),
+    )
+
+    second = start_server()
+    resumed = text2table.text2table(
+        {"name": "What is the child's name?", "age": "How old is the child?"},
+        documents=letters,
+        openai_client=make_client(second),
+        journal=text2table.ExtractionJournal(path),
+        resume=True,
+    )
+
+    # Nothing but the datatypes.
+    assert second.stats()["requests"] == 1
+    assert resumed.to_dict() == table.to_dict()
+
+
+def test_without_resume_the_journal_starts_over(
+    tmp_path, start_server, make_client, letters
+):
+    path = str(tmp_path / "journal.jsonl")
+    server = start_server()
+    client = make_client(server)
+    for _ in range(2):
+        text2table.text2table(
+            QUESTIONS,
+            documents=letters,
+            openai_client=client,
+            journal=text2table.ExtractionJournal(path),
+        )
+
+    assert server.stats()["requests"] == 2 * (len(letters) * len(QUESTIONS) + 1)
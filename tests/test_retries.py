@@ -0,0 +1,95 @@
+import text2table
+
+from text2table.core import send_gpt_chat
+
+MESSAGES = [
+    {"role": "system", "content": "Answer the question."},
+    {"role": "user", "content": "Dear Santa, my name is Megan."},
+]
+
+
+def test_failed_calls_are_retried(start_server, make_client):
+    server = start_server(rate_429=0.3, rate_500=0.2, retry_after=0.01)
+    client = make_client(server)
+    metrics = text2table.Metrics()
+
+    for _ in range(10):
+        reply = send_gpt_chat(
+            MESSAGES,
+            openai_client=client,
+            model=text2table.DEFAULT_MODEL,
+            retries=20,
+            throttle=0.01,
+            metrics=metrics,
+        )
+        assert reply is not None
+
+    stats = server.stats()
+    summary = metrics.summary()
+    assert stats["completed"] == summary["calls"] == 10
+    assert summary["failed_calls"] == 0
+    assert summary["retries"] == stats["requests"] - stats["completed"] > 0
+    assert summary["errors"].get("RateLimitError", 0) == stats.get("injected_429", 0)
+    assert summary["errors"].get("InternalServerError", 0) == stats.get(
+        "injected_500", 0
+    )
+
+
+def test_a_call_gives_up_after_its_retries(start_server, make_client):
+    server = start_server(rate_500=1.0)
+    metrics = text2table.Metrics()
+    reply = send_gpt_chat(
+        MESSAGES,
+        openai_client=make_client(server),
+        model=text2table.DEFAULT_MODEL,
+        retries=3,
+        throttle=0.01,
+        metrics=metrics,
+    )
+
+    assert reply is None
+    assert server.stats()["requests"] == 3
+    assert metrics.summary()["failed_calls"] == 1
+
+
+def test_throttling_pauses_the_rate_limiter(start_server, make_client):
+    server = start_server(rate_429=0.5, retry_after=0.01)
+    limiter = text2table.RateLimiter(requests_per_minute=6000)
+
+    for _ in range(5):
+        reply = send_gpt_chat(
+            MESSAGES,
+            openai_client=make_client(server),
+            model=text2table.DEFAULT_MODEL,
+            retries=20,
+            throttle=0.01,
+            rate_limiter=limiter,
+        )
+        assert reply is not None
+
+    assert limiter.throttled_count == server.stats().get("injected_429", 0)
+
+
+def test_rate_limiter_paces_and_settles():
+    limiter = text2table.RateLimiter(tokens_per_minute=600)
+
+    limiter.acquire(600)
+    # The bucket is empty, and refills at 10 tokens a second.
+    assert 0.9 < limiter._try_acquire(10) <= 1.0
+
+    # The call only used 100 of the 600 tokens it reserved.
+    limiter.settle(600, type("Usage", (), {"total_tokens": 100})())
+    assert limiter._try_acquire(10) == 0.0
+
+
+def test_rate_limits_are_split_among_workers():
+    from text2table.core import _worker_option_configs
+
+    options = text2table.ExtractionOptions(
+        rate_limiter=text2table.RateLimiter(requests_per_minute=400),
+        budget=text2table.Budget(max_dollars=10.0),
+    )
+    configs = _worker_option_configs(options, 4)
+
+    assert configs["rate_limiter"]["requests_per_minute"] == 100
+    assert configs["budget"]["max_dollars"] == 2.5
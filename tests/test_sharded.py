@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+import text2table
+
+from conftest import QUESTIONS
+
+
+def test_sharded_run_matches_a_single_process(
+    tmp_path, start_server, make_client, letters
+):
+    server = start_server()
+    client = make_client(server)
+    source = tmp_path / "letters.json"
+    source.write_text(json.dumps(letters), encoding="utf-8")
+    expected = text2table.text2table(
+        QUESTIONS,
+        documents=text2table.iter_documents(str(source)),
+        openai_client=client,
+    )
+
+    deduplicator = text2table.Deduplicator(
+        clusters_path=str(tmp_path / "clusters.jsonl")
+    )
+    table = text2table.sharded_text2table(
+        QUESTIONS,
+        source=str(source),
+        queue_path=str(tmp_path / "queue.sqlite3"),
+        output_dir=str(tmp_path / "shards"),
+        openai_client=client,
+        num_workers=2,
+        shard_size=2,
+        options=text2table.ExtractionOptions(deduplicator=deduplicator),
+        max_concurrency=4,
+    )
+
+    # Shards come back in order, but each shard's rows in completion order.
+    assert sorted(table.column("document_id")) == [
+        text2table.Document.generated_id(i) for i in range(len(letters))
+    ]
+    assert table.to_dict() == expected.to_dict()
+    with open(deduplicator.clusters_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == len(letters)
+    deduplicator.close()
+
+
+def test_per_shard_options_are_rejected(tmp_path, make_client, start_server):
+    with pytest.raises(ValueError):
+        text2table.sharded_text2table(
+            QUESTIONS,
+            source=str(tmp_path / "letters.json"),
+            queue_path=str(tmp_path / "queue.sqlite3"),
+            output_dir=str(tmp_path / "shards"),
+            openai_client=make_client(start_server()),
+            resume=True,
+        )
@@ -0,0 +1,78 @@
+# Turns freeform text into structured data. The names below are importable
+# straight from the package, but each one is only looked up (and its module
+# only imported) the first time it's used, so that `import text2table` costs
+# next to nothing: short-lived and pooled workers start fast, and nothing
+# runs at import time. openai, tiktoken and pyarrow are imported lazily by
+# the modules themselves, only when something needs them.
+
+import importlib
+
+from typing import Any, List
+
+# Public name -> the submodule that defines it.
+_EXPORTS = {
+    # The engine and its entry points.
+    "DEFAULT_MODEL": "options",
+    "DATATYPES_MODEL": "options",
+    "ExtractionOptions": "options",
+    "text2table": "core",
+    "async_text2table": "core",
+    "iter_text2table": "core",
+    "async_iter_text2table": "core",
+    "determine_datatypes": "core",
+    "async_determine_datatypes": "core",
+    "plan_text2table": "core",
+    "prepare_batch_job": "core",
+    "ingest_batch_job": "core",
+    "batch_text2table": "core",
+    "create_sharded_job": "core",
+    "run_shard_worker": "core",
+    "merge_shard_outputs": "core",
+    "sharded_text2table": "core",
+    "create_client": "core",
+    "create_async_client": "core",
+    "read_questions": "core",
+    "main": "core",
+    # Inputs and outputs.
+    "Question": "question",
+    "Document": "document",
+    "Corpus": "corpus",
+    "iter_documents": "document_source",
+    "ResultTable": "result_table",
+    # Everything the engine can be handed.
+    "AdaptiveTimeouts": "adaptive_timeouts",
+    "BatchJob": "batch_api",
+    "LocalBatchBackend": "batch_api",
+    "OpenAIBatchBackend": "batch_api",
+    "ClientPool": "client_pool",
+    "PoolEndpoint": "client_pool",
+    "Budget": "cost_planner",
+    "JobPlan": "cost_planner",
+    "TokenCounter": "cost_planner",
+    "Deduplicator": "dedup",
+    "HedgePolicy": "hedging",
+    "Metrics": "instrumentation",
+    "ExtractionJournal": "journal",
+    "ModelCascade": "model_cascade",
+    "RateLimiter": "rate_limiter",
+    "ResponseCache": "response_cache",
+    "SchemaCache": "schema_cache",
+    "SkipPredictor": "skip_predictor",
+    "StructuredOutput": "structured_output",
+    "WorkQueue": "work_queue",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    # Looked up once; after that it's an ordinary module attribute.
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(globals()) | set(_EXPORTS))
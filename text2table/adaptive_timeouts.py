@@ -0,0 +1,144 @@
+import collections
+import threading
+
+from .cost_planner import DEFAULT_OUTPUT_TOKENS_PER_QUESTION
+from .instrumentation import percentile
+
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# Per-call timeouts worked out from how long similar calls have taken. Calls
+# are bucketed by model and by the rough size (in powers of two) of their
+# prompt and expected reply; each bucket keeps a rolling window of recent
+# latencies. A call's timeout is a high percentile of its bucket, times a
+# safety multiplier, plus a fixed margin. Until a bucket has enough samples
+# the model's other buckets stand in for it, and until the model has any,
+# the timeout is worked out from the expected reply length instead.
+#
+# Each time a call times out, its next attempt gets twice the timeout, so a
+# reply that's genuinely long still gets through in the end, while one
+# stuck connection no longer holds a concurrency slot for minutes.
+
+
+def size_bucket(tokens: int) -> int:
+    # 0 for nothing, then 1, 2, 3... for up to 1, 2, 4... tokens.
+    return max(0, int(tokens)).bit_length()
+
+
+class AdaptiveTimeouts:
+    def __init__(
+        self,
+        *,
+        timeout_percentile: float = 99.0,
+        multiplier: float = 1.5,
+        margin: float = 2.0,
+        min_timeout: float = 5.0,
+        max_timeout: float = 600.0,
+        min_samples: int = 20,
+        window: int = 500,
+        expected_output_tokens: int = DEFAULT_OUTPUT_TOKENS_PER_QUESTION,
+        cold_start_seconds: float = 15.0,
+        cold_tokens_per_second: float = 15.0,
+    ):
+        # expected_output_tokens is per question. The cold-start timeout
+        # allows cold_start_seconds for the request plus generation at
+        # cold_tokens_per_second, which is slow enough for any model that's
+        # working properly.
+        self.timeout_percentile = timeout_percentile
+        self.multiplier = multiplier
+        self.margin = margin
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.min_samples = min_samples
+        self.window = window
+        self.expected_output_tokens = expected_output_tokens
+        self.cold_start_seconds = cold_start_seconds
+        self.cold_tokens_per_second = cold_tokens_per_second
+
+        self.buckets: Dict[Tuple[str, int, int], Deque[float]] = {}
+        self.models: Dict[str, Deque[float]] = {}
+        self.timeouts: Dict[Tuple[str, int, int], int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "AdaptiveTimeouts":
+        return AdaptiveTimeouts(**config)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "timeout_percentile": self.timeout_percentile,
+            "multiplier": self.multiplier,
+            "margin": self.margin,
+            "min_timeout": self.min_timeout,
+            "max_timeout": self.max_timeout,
+            "min_samples": self.min_samples,
+            "window": self.window,
+            "expected_output_tokens": self.expected_output_tokens,
+            "cold_start_seconds": self.cold_start_seconds,
+            "cold_tokens_per_second": self.cold_tokens_per_second,
+        }
+
+    @staticmethod
+    def bucket_key(
+        model: str, prompt_tokens: int, output_tokens: int
+    ) -> Tuple[str, int, int]:
+        return (model, size_bucket(prompt_tokens), size_bucket(output_tokens))
+
+    def observe(
+        self, model: str, prompt_tokens: int, output_tokens: int, latency: float
+    ):
+        # Only calls that ran to completion should be observed; a reply that
+        # was cut short says nothing about how long a whole one takes.
+        key = AdaptiveTimeouts.bucket_key(model, prompt_tokens, output_tokens)
+        with self._lock:
+            for samples, k in ((self.buckets, key), (self.models, model)):
+                if k not in samples:
+                    samples[k] = collections.deque(maxlen=self.window)
+                samples[k].append(latency)
+
+    def record_timeout(self, model: str, prompt_tokens: int, output_tokens: int):
+        key = AdaptiveTimeouts.bucket_key(model, prompt_tokens, output_tokens)
+        with self._lock:
+            self.timeouts[key] = self.timeouts.get(key, 0) + 1
+
+    def latency_percentile(
+        self, model: str, prompt_tokens: int, output_tokens: int, p: float
+    ) -> Optional[float]:
+        # The p-th percentile latency of calls like this one, or None if
+        # there isn't enough history to say.
+        key = AdaptiveTimeouts.bucket_key(model, prompt_tokens, output_tokens)
+        with self._lock:
+            for samples in (self.buckets.get(key), self.models.get(model)):
+                if samples is not None and len(samples) >= self.min_samples:
+                    return percentile(list(samples), p)
+        return None
+
+    def timeout_for(
+        self, model: str, prompt_tokens: int, output_tokens: int, *, attempt: int = 0
+    ) -> float:
+        latency = self.latency_percentile(
+            model, prompt_tokens, output_tokens, self.timeout_percentile
+        )
+        if latency is None:
+            timeout = self.cold_start_seconds + output_tokens / max(
+                1e-6, self.cold_tokens_per_second
+            )
+        else:
+            timeout = latency * self.multiplier + self.margin
+        timeout *= 2**attempt
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def stats(self) -> Dict[str, Any]:
+        # Keyed by "model/prompt bucket/output bucket".
+        with self._lock:
+            samples_by_key = {k: list(v) for k, v in self.buckets.items()}
+            timeouts = dict(self.timeouts)
+        retval = {}
+        for key in sorted(set(samples_by_key) | set(timeouts)):
+            samples = samples_by_key.get(key, [])
+            retval["/".join(str(k) for k in key)] = {
+                "samples": len(samples),
+                "p50": percentile(samples, 50),
+                "p99": percentile(samples, 99),
+                "timeouts": timeouts.get(key, 0),
+            }
+        return retval
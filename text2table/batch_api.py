@@ -0,0 +1,373 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Offline execution through OpenAI's Batch API. Requests are written out as
+# sharded JSONL files, each shard is submitted as one batch, and the output
+# files are downloaded once the batches finish. The backend that does the
+# submitting can be swapped for LocalBatchBackend, which processes the files
+# on the local disk, so that the whole flow can be exercised without a
+# network connection.
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# Batches in any of these states won't change any more.
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def make_custom_id(document_index: int, unit_index: int) -> str:
+    # Deterministic, so that the same inputs always produce the same files,
+    # and short, since the Batch API caps custom_id length.
+    return f"d{document_index}-u{unit_index}"
+
+
+def parse_custom_id(custom_id: str) -> Tuple[int, int]:
+    d, u = custom_id.split("-")
+    return int(d[1:]), int(u[1:])
+
+
+def _write_json_atomically(path: str, data: Any):
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+
+def iter_batch_output(path: str) -> Iterator[Tuple[str, Optional[str]]]:
+    # Yields (custom_id, reply) for each line of a batch output (or error)
+    # file. Requests that failed, or whose completion didn't finish
+    # normally, come back with a reply of None.
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            reply = None
+            try:
+                response = record.get("response") or {}
+                if response.get("status_code") == 200:
+                    choice = response["body"]["choices"][0]
+                    if choice.get("finish_reason") in ("stop", "tool_calls"):
+                        # With function calling, the reply is the call's
+                        # arguments.
+                        message = choice["message"]
+                        reply = message.get("content")
+                        if message.get("tool_calls"):
+                            reply = message["tool_calls"][0]["function"]["arguments"]
+            except (KeyError, IndexError, TypeError):
+                reply = None
+            yield record["custom_id"], reply
+
+
+class OpenAIBatchBackend:
+    # Talks to the real Batch API through a (sync) openai.OpenAI client.
+
+    def __init__(self, openai_client, *, completion_window: str = "24h"):
+        self.openai_client = openai_client
+        self.completion_window = completion_window
+
+    def submit(self, path: str) -> str:
+        with open(path, "rb") as f:
+            input_file = self.openai_client.files.create(file=f, purpose="batch")
+        batch = self.openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=self.completion_window,
+        )
+        return batch.id
+
+    def status(self, batch_id: str) -> str:
+        return self.openai_client.batches.retrieve(batch_id).status
+
+    def download(self, batch_id: str, path: str) -> bool:
+        # Writes the batch's output (followed by its errors, if any) to path.
+        # Returns False if the batch produced no output at all.
+        batch = self.openai_client.batches.retrieve(batch_id)
+        file_ids = [batch.output_file_id, getattr(batch, "error_file_id", None)]
+        file_ids = [file_id for file_id in file_ids if file_id]
+        if not file_ids:
+            return False
+        with open(path, "wb") as f:
+            for file_id in file_ids:
+                f.write(self.openai_client.files.content(file_id).content)
+        return True
+
+
+class LocalBatchBackend:
+    # A file-based stand-in for the Batch API. Submitted files are copied
+    # into `directory`; a batch stays "in_progress" until it has been polled
+    # `polls_until_done` times, at which point every request in it is passed
+    # to `respond` and the output file is written in the same format the
+    # real API uses. `respond` takes a request body and returns the reply
+    # text, or raises to make that one request fail.
+
+    def __init__(
+        self,
+        directory: str,
+        respond: Callable[[Dict[str, Any]], str],
+        *,
+        polls_until_done: int = 1,
+    ):
+        self.directory = directory
+        self.respond = respond
+        self.polls_until_done = polls_until_done
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, batch_id: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}.{suffix}")
+
+    def submit(self, path: str) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        shutil.copyfile(path, self._path(batch_id, "input.jsonl"))
+        _write_json_atomically(
+            self._path(batch_id, "status.json"), {"status": "validating", "polls": 0}
+        )
+        return batch_id
+
+    def status(self, batch_id: str) -> str:
+        statuspath = self._path(batch_id, "status.json")
+        with open(statuspath, encoding="utf-8") as f:
+            state = json.load(f)
+        if state["status"] in TERMINAL_STATUSES:
+            return state["status"]
+
+        state["polls"] += 1
+        if state["polls"] < self.polls_until_done:
+            state["status"] = "in_progress"
+        else:
+            self._process(batch_id)
+            state["status"] = "completed"
+        _write_json_atomically(statuspath, state)
+        return state["status"]
+
+    def _process(self, batch_id: str):
+        with open(self._path(batch_id, "input.jsonl"), encoding="utf-8") as fin:
+            with open(
+                self._path(batch_id, "output.jsonl"), "w", encoding="utf-8"
+            ) as fout:
+                for line in fin:
+                    if not line.strip():
+                        continue
+                    request = json.loads(line)
+                    record = {
+                        "id": f"batch_req_{uuid.uuid4().hex}",
+                        "custom_id": request["custom_id"],
+                        "response": None,
+                        "error": None,
+                    }
+                    try:
+                        content = self.respond(request["body"])
+                        record["response"] = {
+                            "status_code": 200,
+                            "body": {
+                                "object": "chat.completion",
+                                "model": request["body"].get("model"),
+                                "choices": [
+                                    {
+                                        "index": 0,
+                                        "message": {
+                                            "role": "assistant",
+                                            "content": content,
+                                        },
+                                        "finish_reason": "stop",
+                                    }
+                                ],
+                            },
+                        }
+                    except Exception as e:
+                        record["error"] = {"code": "server_error", "message": f"{e}"}
+                    fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def download(self, batch_id: str, path: str) -> bool:
+        outpath = self._path(batch_id, "output.jsonl")
+        if not os.path.exists(outpath):
+            return False
+        shutil.copyfile(outpath, path)
+        return True
+
+
+class BatchJob:
+    # One offline extraction job, kept entirely in `directory`:
+    #
+    #   state.json        what's been written, submitted and downloaded
+    #   documents.jsonl   document IDs, in input order
+    #   input-NNNNN.jsonl the request shards
+    #   output-NNNNN.jsonl the downloaded results, one per shard
+    #
+    # Every step records its progress in state.json, so a job can be picked
+    # up again by a later process (e.g. submit tonight, ingest tomorrow).
+
+    STATE_FILE = "state.json"
+    DOCUMENTS_FILE = "documents.jsonl"
+
+    def __init__(self, directory: str, *, backend: Any = None):
+        self.directory = directory
+        self.backend = backend
+        self.metadata: Dict[str, Any] = {}
+        self.shards: List[Dict[str, Any]] = []
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(self._path(BatchJob.STATE_FILE)):
+            self.load()
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    @property
+    def prepared(self) -> bool:
+        return bool(self.shards)
+
+    def load(self):
+        with open(self._path(BatchJob.STATE_FILE), encoding="utf-8") as f:
+            state = json.load(f)
+        self.metadata = state.get("metadata", {})
+        self.shards = state.get("shards", [])
+
+    def save(self):
+        _write_json_atomically(
+            self._path(BatchJob.STATE_FILE),
+            {"metadata": self.metadata, "shards": self.shards},
+        )
+
+    def write_requests(
+        self,
+        documents: Iterable[Tuple[str, List[Tuple[str, str, List[Dict[str, str]]]]]],
+        *,
+        max_requests_per_file: int = 50000,
+        max_bytes_per_file: int = 100 << 20,
+    ):
+        # Takes (document id, requests) pairs, in input order, where each
+        # request is a (custom_id, model, messages) triple, or a
+        # (custom_id, model, messages, options) quadruple whose options are
+        # extra fields for the request body (e.g. a response_format), and
+        # writes the requests out in shards no bigger than the Batch API
+        # accepts.
+        if self.prepared:
+            raise ValueError(f"{self.directory} already holds a prepared job")
+
+        shards = []
+        f = None
+        count = 0
+        size = 0
+        docfile = open(self._path(BatchJob.DOCUMENTS_FILE), "w", encoding="utf-8")
+        try:
+            for request in self._iter_requests(documents, docfile):
+                custom_id, model, messages = request[:3]
+                body = {"model": model, "messages": messages, "temperature": 0}
+                if len(request) > 3 and request[3]:
+                    body.update(request[3])
+                line = json.dumps(
+                    {
+                        "custom_id": custom_id,
+                        "method": "POST",
+                        "url": BATCH_ENDPOINT,
+                        "body": body,
+                    },
+                    ensure_ascii=False,
+                )
+                line_size = len(line.encode("utf-8")) + 1
+                if f is not None and (
+                    count >= max_requests_per_file
+                    or size + line_size > max_bytes_per_file
+                ):
+                    f.close()
+                    f = None
+                if f is None:
+                    filename = f"input-{len(shards):05d}.jsonl"
+                    shards.append({"input": filename, "requests": 0})
+                    f = open(self._path(filename), "w", encoding="utf-8")
+                    count = 0
+                    size = 0
+                f.write(line + "\n")
+                count += 1
+                size += line_size
+                shards[-1]["requests"] += 1
+        finally:
+            if f is not None:
+                f.close()
+            docfile.close()
+
+        self.shards = shards
+        self.save()
+
+    @staticmethod
+    def _iter_requests(documents, docfile) -> Iterator[Tuple[str, str, Any]]:
+        for docid, requests in documents:
+            docfile.write(json.dumps(docid, ensure_ascii=False) + "\n")
+            yield from requests
+
+    def document_ids(self) -> Iterator[str]:
+        with open(self._path(BatchJob.DOCUMENTS_FILE), encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def submit(self):
+        # Submits every shard that hasn't been submitted yet. Progress is
+        # saved after each one, so a failure partway through doesn't cause
+        # shards to be submitted twice when it's retried.
+        for shard in self.shards:
+            if shard.get("batch_id"):
+                continue
+            shard["batch_id"] = self.backend.submit(self._path(shard["input"]))
+            shard["status"] = "submitted"
+            self.save()
+
+    def poll(self) -> bool:
+        # Checks on every unfinished batch, and downloads the output of the
+        # ones that have finished. Returns True once all of them have.
+        for shard in self.shards:
+            if not shard.get("batch_id") or shard["status"] in TERMINAL_STATUSES:
+                continue
+            status = self.backend.status(shard["batch_id"])
+            if status in TERMINAL_STATUSES:
+                filename = shard["input"].replace("input-", "output-")
+                if self.backend.download(shard["batch_id"], self._path(filename)):
+                    shard["output"] = filename
+            shard["status"] = status
+        self.save()
+        return all(shard.get("status") in TERMINAL_STATUSES for shard in self.shards)
+
+    def wait(self, *, poll_interval: float = 60.0, timeout: Optional[float] = None):
+        start = time.monotonic()
+        while not self.poll():
+            if timeout is not None and time.monotonic() - start >= timeout:
+                raise TimeoutError(f"Batch job in {self.directory} is still running")
+            time.sleep(poll_interval)
+
+    def iter_shard_results(
+        self,
+    ) -> Iterator[Tuple[Dict[str, Any], Iterator[Tuple[str, Optional[str]]]]]:
+        # Like iter_results, but a shard at a time: yields each shard along
+        # with its results (none, if it didn't produce an output file).
+        for shard in self.shards:
+            results = iter(())
+            if shard.get("output"):
+                results = iter_batch_output(self._path(shard["output"]))
+            yield shard, results
+
+    def iter_results(self) -> Iterator[Tuple[str, Optional[str]]]:
+        for _, results in self.iter_shard_results():
+            yield from results
+
+    def stats(self) -> Dict[str, Any]:
+        statuses = {}
+        for shard in self.shards:
+            status = shard.get("status", "unsubmitted")
+            statuses[status] = statuses.get(status, 0) + 1
+        return {
+            "shards": len(self.shards),
+            "requests": sum(shard["requests"] for shard in self.shards),
+            "statuses": statuses,
+        }
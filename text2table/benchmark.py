@@ -0,0 +1,699 @@
+import argparse
+import asyncio
+import hashlib
+import http.server
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+from .instrumentation import percentile
+
+from typing import Any, Dict, Iterator, List, Optional
+
+# Measures the throughput of the extraction engine without touching the live
+# API. A fake OpenAI-compatible server runs in a child process (so that its
+# memory doesn't count against the client's), replying in the
+# RELEVANCE/AVAILABILITY/ANSWER format (or, when the request asks for a
+# JSON schema or a function call, with a JSON object) after a configurable
+# delay, and
+# failing a configurable fraction of requests with 429s, 500s or hangs.
+# Synthetic corpora of increasing size are built from letters-to-santa.json
+# and pushed through async_text2table end to end.
+#
+#     python -m text2table.benchmark --scales 100,1000,10000 --concurrency 64
+
+
+class FakeServerConfig:
+    def __init__(
+        self,
+        *,
+        latency_median: float = 0.5,
+        latency_sigma: float = 0.5,
+        tokens_per_second: float = 200.0,
+        rate_429: float = 0.0,
+        rate_500: float = 0.0,
+        rate_timeout: float = 0.0,
+        hang_seconds: float = 30.0,
+        retry_after: Optional[float] = 1.0,
+        absent_rate: float = 0.5,
+        seed: int = 0,
+    ):
+        # Latency is lognormal around latency_median, plus the time to
+        # "generate" the reply at tokens_per_second. Each failure rate is an
+        # independent per-request probability; a timeout just hangs for
+        # hang_seconds, which should exceed the client's timeout.
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.rate_timeout = rate_timeout
+        self.hang_seconds = hang_seconds
+        self.retry_after = retry_after
+        self.absent_rate = absent_rate
+        self.seed = seed
+
+
+def _canned_answer(instructions: str, rng: random.Random) -> str:
+    # Picks a plausible answer for whatever format the prompt asked for
+    # (see Question.instructions_for_datatype).
+    if "exactly one of the following values" in instructions:
+        options = re.findall(r'"([^"]*)"', instructions.split("as follows:", 1)[-1])
+        return json.dumps(rng.choice(options)) if options else '""'
+    if "list of integers" in instructions:
+        return json.dumps([rng.randint(1, 10) for _ in range(rng.randint(1, 3))])
+    if "list of floating-point" in instructions:
+        return json.dumps([round(rng.uniform(1, 100), 2) for _ in range(2)])
+    if "list of strings" in instructions:
+        return json.dumps(rng.sample(["bike", "doll", "dog", "train", "books"], 2))
+    if "an int" in instructions:
+        return f"{rng.randint(1, 12)}"
+    if "floating-point" in instructions:
+        return f"{rng.uniform(1, 100):.2f}"
+    return json.dumps(rng.choice(["Megan", "Rayne", "Yadiel", "a dog", "a bike"]))
+
+
+def _canned_section(instructions: str, rng: random.Random, absent_rate: float) -> str:
+    if rng.random() < absent_rate:
+        return (
+            "# RELEVANCE\nRELEVANT\n\n# AVAILABILITY\nABSENT\n\n"
+            "# DISCUSSION\nThe letter doesn't say.\n\n# ANSWER\n"
+        )
+    return (
+        "# RELEVANCE\nRELEVANT\n\n# AVAILABILITY\nSTATED\n\n"
+        "# DISCUSSION\nThe letter says so directly.\n\n"
+        f"# ANSWER\n{_canned_answer(instructions, rng)}\n"
+    )
+
+
+def canned_reply(messages: List[Dict[str, str]], *, absent_rate: float) -> str:
+    # Answers deterministically for a given prompt, so that a response cache
+    # behaves the same way it would against the real API.
+    prompt = "\n".join(f"{m.get('content', '')}" for m in messages)
+    seed = int.from_bytes(hashlib.sha1(prompt.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    system = messages[0].get("content", "") if messages else ""
+
+    if "VARIABLE: name_of_variable" in prompt:
+        # Datatype inference.
+        keys = re.findall(r"^- \*\*(.+?)\*\*:", prompt, flags=re.MULTILINE)
+        return "\n\n".join(
+            f"VARIABLE: {key}\nDISCUSSION: A name will do.\nDATATYPE: str\nUNITS: N/A"
+            for key in keys
+        )
+
+    if '"# QUESTION: key"' in system:
+        retval = ""
+        for key, instructions in re.findall(
+            r"^- \*\*(.+?)\*\*: .*\n(?:  Its final answer will be written in the following format: (.*)\n)?",
+            system,
+            flags=re.MULTILINE,
+        ):
+            section = _canned_section(instructions, rng, absent_rate)
+            retval += f"# QUESTION: {key}\n" + section.replace("# ", "## ") + "\n"
+        return retval
+
+    instructions = ""
+    match = re.search(r"written in the following format: (.*)", system)
+    if match:
+        instructions = match.group(1)
+    return _canned_section(instructions, rng, absent_rate)
+
+
+def _canned_json_value(schema: Dict[str, Any], rng: random.Random) -> Any:
+    # Any value that fits the schema.
+    if "anyOf" in schema:
+        schema = [s for s in schema["anyOf"] if s.get("type") != "null"][0]
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    kind = schema.get("type")
+    if kind == "integer":
+        return rng.randint(1, 12)
+    if kind == "number":
+        return round(rng.uniform(1, 100), 2)
+    if kind == "array":
+        return [_canned_json_value(schema["items"], rng) for _ in range(2)]
+    if kind == "object":
+        return {
+            k: _canned_json_value(v, rng)
+            for k, v in schema.get("properties", {}).items()
+        }
+    return rng.choice(["Megan", "Rayne", "Yadiel", "a dog", "a bike"])
+
+
+def _canned_answer_object(
+    schema: Dict[str, Any], rng: random.Random, absent_rate: float
+) -> Dict[str, Any]:
+    properties = schema["properties"]
+    absent = rng.random() < absent_rate
+    retval = {}
+    if "reasoning" in properties:
+        retval["reasoning"] = (
+            "The letter doesn't say." if absent else "The letter says so directly."
+        )
+    retval["relevance"] = "RELEVANT"
+    retval["availability"] = "ABSENT" if absent else "STATED"
+    retval["answer"] = None if absent else _canned_json_value(properties["answer"], rng)
+    return retval
+
+
+def canned_structured_reply(
+    schema: Dict[str, Any], prompt: str, *, absent_rate: float
+) -> str:
+    # A reply in the structured answer format (see structured_output), to
+    # one question or to several.
+    seed = int.from_bytes(hashlib.sha1(prompt.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    if "relevance" in schema.get("properties", {}):
+        return json.dumps(_canned_answer_object(schema, rng, absent_rate))
+    return json.dumps(
+        {
+            key: _canned_answer_object(subschema, rng, absent_rate)
+            for key, subschema in schema.get("properties", {}).items()
+        }
+    )
+
+
+def requested_schema(request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    # The JSON schema a request wants its reply to follow, if any. In JSON
+    # mode, it's spelled out at the end of the system prompt.
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return response_format["json_schema"]["schema"]
+    if request.get("tools"):
+        return request["tools"][0]["function"]["parameters"]
+    if response_format.get("type") == "json_object":
+        messages = request.get("messages") or [{}]
+        system = f"{messages[0].get('content', '')}"
+        match = re.search(r"match this JSON schema: (.*)", system)
+        if match:
+            return json.loads(match.group(1))
+    return None
+
+
+class _FakeOpenAIHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(
+        self, status: int, payload: Any, headers: Optional[Dict[str, str]] = None
+    ):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", f"{len(body)}")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.server.snapshot())
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        config = self.server.config
+        rng = self.server.next_rng()
+        self.server.count("requests")
+
+        roll = rng.random()
+        if roll < config.rate_429:
+            self.server.count("injected_429")
+            headers = {}
+            if config.retry_after is not None:
+                headers["retry-after-ms"] = f"{int(config.retry_after * 1000)}"
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests"}},
+                headers,
+            )
+            return
+        roll -= config.rate_429
+        if roll < config.rate_500:
+            self.server.count("injected_500")
+            self._send_json(500, {"error": {"message": "Internal error"}})
+            return
+        roll -= config.rate_500
+        if roll < config.rate_timeout:
+            self.server.count("injected_timeouts")
+            time.sleep(config.hang_seconds)
+            return
+
+        messages = request.get("messages") or []
+        schema = requested_schema(request)
+        if schema is not None:
+            content = canned_structured_reply(
+                schema,
+                "\n".join(f"{m.get('content', '')}" for m in messages),
+                absent_rate=config.absent_rate,
+            )
+        else:
+            content = canned_reply(messages, absent_rate=config.absent_rate)
+        prompt_tokens = sum(len(f"{m.get('content', '')}") for m in messages) // 4
+        completion_tokens = max(1, len(content) // 4)
+
+        delay = config.latency_median * math.exp(rng.gauss(0, config.latency_sigma))
+        if config.tokens_per_second:
+            delay += completion_tokens / config.tokens_per_second
+        time.sleep(delay)
+
+        self.server.count("completed")
+        created = int(time.time())
+        if request.get("stream"):
+            self._stream(request, content, created)
+            return
+        message = {"role": "assistant", "content": content}
+        if request.get("tools"):
+            function = request["tools"][0]["function"]["name"]
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [
+                    {
+                        "id": f"call_{rng.getrandbits(64):x}",
+                        "type": "function",
+                        "function": {"name": function, "arguments": content},
+                    }
+                ],
+            }
+        self._send_json(
+            200,
+            {
+                "id": f"chatcmpl-{rng.getrandbits(64):x}",
+                "object": "chat.completion",
+                "created": created,
+                "model": request.get("model", ""),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            },
+        )
+
+    def _stream(self, request: Dict[str, Any], content: str, created: int):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        pieces = re.findall(r"[^\n]*\n?", content)
+        for i, piece in enumerate(pieces + [None]):
+            chunk = {
+                "id": "chatcmpl-stream",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": request.get("model", ""),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": piece} if piece else {},
+                        "finish_reason": None if piece is not None else "stop",
+                    }
+                ],
+            }
+            try:
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # The client stopped reading early, which is allowed.
+                return
+        if (request.get("stream_options") or {}).get("include_usage"):
+            prompt_tokens = (
+                sum(len(f"{m.get('content', '')}") for m in request["messages"]) // 4
+            )
+            completion_tokens = max(1, len(content) // 4)
+            chunk = {
+                "id": "chatcmpl-stream",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": request.get("model", ""),
+                "choices": [],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+class FakeOpenAIServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, config: FakeServerConfig, port: int = 0):
+        super().__init__(("127.0.0.1", port), _FakeOpenAIHandler)
+        self.config = config
+        self.counters: Dict[str, int] = {}
+        self._rng = random.Random(config.seed)
+        self._lock = threading.Lock()
+
+    def next_rng(self) -> random.Random:
+        with self._lock:
+            return random.Random(self._rng.getrandbits(64))
+
+    def count(self, name: str):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+    def handle_error(self, request, client_address):
+        # Clients hang up mid-request on purpose (cancelled hedges, early
+        # stops), which isn't worth a traceback.
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def _serve(config: FakeServerConfig, port_pipe):
+    server = FakeOpenAIServer(config)
+    port_pipe.send(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeServerProcess:
+    # Runs a FakeOpenAIServer in a child process for the duration of a
+    # `with` block.
+
+    def __init__(self, config: FakeServerConfig):
+        self.config = config
+        self.process = None
+        self.port = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def __enter__(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_serve, args=(self.config, sender), daemon=True
+        )
+        self.process.start()
+        self.port = receiver.recv()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.process.terminate()
+        self.process.join()
+
+    def stats(self) -> Dict[str, int]:
+        import urllib.request
+
+        with urllib.request.urlopen(f"{self.base_url}/stats") as f:
+            return json.load(f)
+
+
+def generate_corpus(
+    count: int,
+    *,
+    source: str = "letters-to-santa.json",
+    seed: int = 0,
+    sentences_per_letter: int = 8,
+) -> Iterator[str]:
+    # Synthetic letters, built by recombining sentences from the real ones.
+    # Lazy, so the corpus never has to fit in memory.
+    with open(source, encoding="utf-8") as f:
+        letters = json.load(f)
+    sentences = []
+    for letter in letters:
+        sentences += [s for s in re.split(r"(?<=[.!?])\s+", letter) if s.strip()]
+
+    rng = random.Random(seed)
+    for _ in range(count):
+        body = " ".join(rng.choice(sentences) for _ in range(sentences_per_letter))
+        yield f"Dear Santa, {body}"
+
+
+class _TimedCompletions:
+    def __init__(self, completions, recorder: "CallRecorder"):
+        self._completions = completions
+        self._recorder = recorder
+
+    async def create(self, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self._completions.create(**kwargs)
+        except Exception as e:
+            self._recorder.record(time.perf_counter() - start, type(e).__name__)
+            raise
+        self._recorder.record(time.perf_counter() - start, None)
+        return response
+
+
+class CallRecorder:
+    # Wraps an AsyncOpenAI client so that every chat completion call has its
+    # latency and outcome recorded, as the engine sees them.
+
+    def __init__(self, openai_client):
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = {}
+        recorder = self
+
+        class _Chat:
+            completions = _TimedCompletions(openai_client.chat.completions, recorder)
+
+        self.chat = _Chat()
+
+    def record(self, seconds: float, error: Optional[str]):
+        if error is None:
+            self.latencies.append(seconds)
+        else:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+
+def peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux but in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak / 1024
+
+
+def measure_cold_start(
+    module: str = "text2table", *, runs: int = 10
+) -> Dict[str, Optional[float]]:
+    # How long a fresh interpreter takes to import `module`, over and above
+    # starting up at all, which is what every short-lived or pooled worker
+    # pays before doing any work. Medians of `runs` runs, in seconds.
+    def median_seconds(code: str) -> float:
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", code],
+                check=True,
+                # The directory the package is in, so that it's the one
+                # that gets imported.
+                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            )
+            samples.append(time.perf_counter() - start)
+        return percentile(samples, 50)
+
+    interpreter = median_seconds("pass")
+    total = median_seconds(f"import {module}")
+    return {"interpreter": interpreter, "import": max(0.0, total - interpreter)}
+
+
+BENCHMARK_QUESTIONS = {
+    "name": "What is the name of the child who wrote the letter?",
+    "age": "How old is the child?",
+    "gifts": "What gifts does the child ask for?",
+}
+
+
+def run_benchmark(
+    count: int,
+    *,
+    config: FakeServerConfig,
+    questions: Dict[str, str] = BENCHMARK_QUESTIONS,
+    request_timeout: float = 10.0,
+    **kwargs,
+) -> Dict[str, Any]:
+    # One end-to-end run over a synthetic corpus of `count` letters. Extra
+    # arguments go to async_text2table.
+    import openai
+
+    from .core import async_text2table
+
+    with FakeServerProcess(config) as server:
+        client = openai.AsyncOpenAI(
+            api_key="benchmark",
+            base_url=server.base_url,
+            timeout=request_timeout,
+            # Retrying is the engine's job; the client mustn't hide it.
+            max_retries=0,
+        )
+        recorder = CallRecorder(client)
+
+        start = time.perf_counter()
+        table = asyncio.run(
+            async_text2table(
+                questions=questions,
+                documents=generate_corpus(count),
+                openai_client=recorder,
+                **kwargs,
+            )
+        )
+        elapsed = time.perf_counter() - start
+        server_stats = server.stats()
+
+    cells = len(table) * len(questions)
+    calls = len(recorder.latencies) + sum(recorder.errors.values())
+    return {
+        "documents": len(table),
+        "cells": cells,
+        "seconds": elapsed,
+        "cells_per_second": cells / elapsed if elapsed else None,
+        "calls": calls,
+        "retries": sum(recorder.errors.values()),
+        "errors": recorder.errors,
+        "p50": percentile(recorder.latencies, 50),
+        "p95": percentile(recorder.latencies, 95),
+        "p99": percentile(recorder.latencies, 99),
+        "peak_rss_mib": peak_rss_mib(),
+        "server": server_stats,
+    }
+
+
+def format_report(results: List[Dict[str, Any]]) -> str:
+    def ms(x):
+        return "-" if x is None else f"{x * 1000:.0f}"
+
+    lines = [
+        f"{'docs':>8} {'cells':>8} {'secs':>8} {'cells/s':>9} {'p50ms':>7}"
+        f" {'p95ms':>7} {'p99ms':>7} {'retries':>8} {'rssMiB':>8}"
+    ]
+    for r in results:
+        lines.append(
+            f"{r['documents']:>8} {r['cells']:>8} {r['seconds']:>8.2f}"
+            f" {r['cells_per_second']:>9.1f} {ms(r['p50']):>7} {ms(r['p95']):>7}"
+            f" {ms(r['p99']):>7} {r['retries']:>8} {r['peak_rss_mib']:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark text2table against a local fake OpenAI server."
+    )
+    parser.add_argument("--scales", default="100,1000", help="corpus sizes to run")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--multi-question", action="store_true")
+    parser.add_argument("--early-stop", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.5, help="median seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--rate-timeout", type=float, default=0.0)
+    parser.add_argument("--request-timeout", type=float, default=10.0)
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        help="hedge calls still running at this latency percentile",
+    )
+    parser.add_argument(
+        "--answer-format",
+        choices=["markdown", "json_schema", "json_object", "function"],
+        default="markdown",
+    )
+    parser.add_argument(
+        "--reasoning",
+        choices=["none", "brief", "full"],
+        default="brief",
+        help="reasoning level of the structured answer formats",
+    )
+    parser.add_argument(
+        "--cold-start",
+        action="store_true",
+        help="only measure how long importing text2table takes",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    if args.cold_start:
+        result = measure_cold_start()
+        print(
+            f"interpreter start-up {result['interpreter'] * 1000:.0f} ms,"
+            f" import text2table {result['import'] * 1000:.0f} ms"
+        )
+        return
+
+    config = FakeServerConfig(
+        latency_median=args.latency,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        rate_timeout=args.rate_timeout,
+        hang_seconds=args.request_timeout * 2,
+    )
+
+    results = []
+    for count in [int(x) for x in args.scales.split(",") if x.strip()]:
+        hedge_policy = None
+        if args.hedge_percentile is not None:
+            from .hedging import HedgePolicy
+
+            hedge_policy = HedgePolicy(hedge_percentile=args.hedge_percentile)
+        structured_output = None
+        if args.answer_format != "markdown":
+            from .structured_output import StructuredOutput
+
+            structured_output = StructuredOutput(
+                mode=args.answer_format, reasoning=args.reasoning
+            )
+        results.append(
+            run_benchmark(
+                count,
+                config=config,
+                request_timeout=args.request_timeout,
+                max_concurrency=args.concurrency,
+                multi_question=args.multi_question,
+                early_stop=args.early_stop,
+                hedge_policy=hedge_policy,
+                structured_output=structured_output,
+            )
+        )
+        print(format_report(results[-1:]).splitlines()[-1], flush=True)
+
+    print()
+    print(format_report(results))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import collections
+import re
+
+from .document import Document
+from .question import Question
+
+from typing import Any, Callable, List, Optional
+
+# Long documents get split into overlapping, token-bounded chunks. Every
+# question is asked of every chunk, and the per-chunk answers are then
+# reduced back down to a single value for the document.
+
+
+def _load_token_counter() -> Callable[[str], int]:
+    # tiktoken gives exact counts, but it's optional; without it we fall
+    # back on the usual four-characters-per-token rule of thumb.
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return lambda text: (len(text) + 3) // 4
+
+
+_count_tokens = None
+
+
+def count_tokens(text: str) -> int:
+    global _count_tokens
+    if _count_tokens is None:
+        _count_tokens = _load_token_counter()
+    return _count_tokens(text)
+
+
+def split_into_chunks(
+    text: str, *, max_tokens: int, overlap_tokens: int = 0
+) -> List[str]:
+    if count_tokens(text) <= max_tokens:
+        return [text]
+
+    # Work in whitespace-delimited words so that chunk edges never land in
+    # the middle of one. Each word's token cost is estimated from its length,
+    # which is accurate enough for sizing chunks. A "word" that's too big for
+    # a chunk on its own (as text in Chinese or Japanese, which don't put
+    # spaces between words, usually is) gets split into runs of characters
+    # instead, sized by its actual token count, since the estimate is far
+    # too low for such scripts.
+    words = []
+    costs = []
+    for word in re.findall(r"\S+\s*", text):
+        cost = max(1, (len(word) + 3) // 4)
+        if len(word) > max_tokens:
+            # A token is at least one character, so shorter words fit.
+            cost = max(cost, count_tokens(word))
+        if cost <= max_tokens:
+            words.append(word)
+            costs.append(cost)
+            continue
+        piece_length = max(1, len(word) * max_tokens // cost)
+        for i in range(0, len(word), piece_length):
+            piece = word[i : i + piece_length]
+            words.append(piece)
+            costs.append(max(1, -(-len(piece) * cost // len(word))))
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+
+    chunks = []
+    start = 0
+    while start < len(words):
+        end = start
+        used = 0
+        while end < len(words) and (used + costs[end] <= max_tokens or end == start):
+            used += costs[end]
+            end += 1
+        chunks.append("".join(words[start:end]).strip())
+        if end >= len(words):
+            break
+
+        # Back up far enough to repeat overlap_tokens worth of words at the
+        # start of the next chunk, but always make forward progress.
+        next_start = end
+        backed = 0
+        while (
+            next_start - 1 > start and backed + costs[next_start - 1] <= overlap_tokens
+        ):
+            next_start -= 1
+            backed += costs[next_start]
+        start = next_start
+
+    return chunks
+
+
+def chunk_document(
+    document: Document, *, max_tokens: int, overlap_tokens: int = 0
+) -> List[Document]:
+    bodies = split_into_chunks(
+        document.body, max_tokens=max_tokens, overlap_tokens=overlap_tokens
+    )
+    if len(bodies) == 1:
+        return [document]
+
+    retval = []
+    for i, body in enumerate(bodies):
+        description = f"Excerpt {i + 1} of {len(bodies)} from a longer document."
+        if document.description:
+            description = f"{document.description} ({description})"
+        retval.append(Document(id=document.id, description=description, body=body))
+    return retval
+
+
+def default_aggregation(question: Question) -> str:
+    datatype = question.datatype
+    if datatype == int or datatype == float:
+        return "max"
+    elif datatype in (List[int], List[float], List[str]):
+        return "union"
+    # Enums and everything else.
+    return "majority"
+
+
+def reduce_answers(question: Question, values: List[Any]) -> Optional[Any]:
+    # Combines the answers from each chunk of a document. Chunks where the
+    # answer was absent contribute None and are ignored.
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+
+    aggregation = question.aggregation or default_aggregation(question)
+
+    if aggregation == "sum":
+        # Started from the first value, so that timedeltas add up too.
+        return sum(values[1:], values[0])
+    elif aggregation == "max":
+        return max(values)
+    elif aggregation == "min":
+        return min(values)
+    elif aggregation == "first":
+        return values[0]
+    elif aggregation == "union":
+        retval = []
+        seen = set()
+        for value in values:
+            for x in value if isinstance(value, list) else [value]:
+                marker = repr(x)
+                if marker not in seen:
+                    seen.add(marker)
+                    retval.append(x)
+        return retval
+    elif aggregation == "majority":
+        # Ties go to whichever value showed up first.
+        counts = collections.Counter(repr(v) for v in values)
+        best = max(counts.values())
+        for v in values:
+            if counts[repr(v)] == best:
+                return v
+
+    raise ValueError(f"Unknown aggregation: {aggregation}")
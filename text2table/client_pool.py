@@ -0,0 +1,294 @@
+import asyncio
+import threading
+import time
+
+from .rate_limiter import RateLimiter
+
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional
+
+if TYPE_CHECKING:
+    import openai
+
+# Spreads requests over several OpenAI accounts or OpenAI-compatible
+# servers. Each endpoint has its own API key, organization and/or base URL,
+# its own rate limits, its own keep-alive connection pool, and its own
+# health record. ClientPool.choose() hands out the least-loaded healthy
+# endpoint; endpoints that keep failing are ejected for a while, with the
+# ejection growing longer each time it happens again.
+#
+# A ClientPool can be passed anywhere the engine takes an openai_client.
+# The endpoints' own clients are built with max_retries=0, since the send
+# functions do the retrying, and a retry can then go to another endpoint.
+# They're only built (and openai only imported) when first used.
+
+
+def _http_limits(
+    *, max_connections: int, max_keepalive_connections: int, keepalive_expiry: float
+):
+    # Whichever HTTP library the installed openai package is built on.
+    try:
+        import httpx
+    except ImportError:
+        import httpx2 as httpx
+
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=keepalive_expiry,
+    )
+
+
+class PoolEndpoint:
+    def __init__(
+        self,
+        *,
+        api_key: Optional[str] = None,
+        organization: Optional[str] = None,
+        base_url: Optional[str] = None,
+        name: Optional[str] = None,
+        weight: float = 1.0,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 50,
+        keepalive_expiry: float = 30.0,
+        timeout: Optional[float] = None,
+    ):
+        # Keep-alive connections are kept open for keepalive_expiry seconds
+        # so that a steady stream of requests never pays for a new TLS
+        # handshake; max_keepalive_connections should be around the number
+        # of requests this endpoint will have in flight.
+        self.api_key = api_key
+        self.organization = organization
+        self.base_url = base_url
+        self.name = name
+        self.weight = weight
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+
+        self.rate_limiter = None
+        if requests_per_minute or tokens_per_minute:
+            self.rate_limiter = RateLimiter(
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+            )
+
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejection_streak = 0
+        self.ejected_until = 0.0
+
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "api_key": self.api_key,
+            "organization": self.organization,
+            "base_url": None if self.base_url is None else str(self.base_url),
+            "name": self.name,
+            "weight": self.weight,
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "max_connections": self.max_connections,
+            "max_keepalive_connections": self.max_keepalive_connections,
+            "keepalive_expiry": self.keepalive_expiry,
+            "timeout": self.timeout,
+        }
+
+    def _client_options(self) -> Dict[str, Any]:
+        options = {
+            "api_key": self.api_key,
+            "organization": self.organization,
+            "base_url": self.base_url,
+            "max_retries": 0,
+        }
+        if self.timeout is not None:
+            options["timeout"] = self.timeout
+        return options
+
+    def _limits(self):
+        return _http_limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @property
+    def client(self) -> "openai.OpenAI":
+        import openai
+
+        if self._client is None:
+            self._client = openai.OpenAI(
+                http_client=openai.DefaultHttpxClient(limits=self._limits()),
+                **self._client_options(),
+            )
+        return self._client
+
+    @property
+    def async_client(self) -> "openai.AsyncOpenAI":
+        # An async client's connections belong to the event loop they were
+        # opened on, and iter_text2table runs a new loop each time, so a
+        # new loop gets a new client. Whoever runs the loop should close the
+        # client (with ClientPool.aclose) before the loop ends, as
+        # iter_text2table does; one that's left open is closed here if its
+        # loop is still running somewhere, and only dropped otherwise.
+        import openai
+
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            old_client, old_loop = self._async_client, self._async_loop
+            if (
+                old_client is not None
+                and not old_loop.is_closed()
+                and old_loop.is_running()
+            ):
+                asyncio.run_coroutine_threadsafe(old_client.close(), old_loop)
+            self._async_client = openai.AsyncOpenAI(
+                http_client=openai.DefaultAsyncHttpxClient(limits=self._limits()),
+                **self._client_options(),
+            )
+            self._async_loop = loop
+        return self._async_client
+
+    async def aclose(self):
+        # Closes the async client, if it was opened on the running loop.
+        if (
+            self._async_client is not None
+            and self._async_loop is asyncio.get_running_loop()
+        ):
+            client = self._async_client
+            self._async_client = None
+            self._async_loop = None
+            await client.close()
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+
+class ClientPool:
+    def __init__(
+        self,
+        endpoints: Iterable[Any],
+        *,
+        eject_after: int = 3,
+        base_ejection_seconds: float = 10.0,
+        max_ejection_seconds: float = 300.0,
+    ):
+        # endpoints are PoolEndpoints, or dicts of PoolEndpoint arguments.
+        # An endpoint is ejected after eject_after failures in a row, for
+        # base_ejection_seconds doubled for each earlier ejection (up to
+        # max_ejection_seconds). Its first success afterwards clears its
+        # record.
+        self.endpoints: List[PoolEndpoint] = [
+            e if isinstance(e, PoolEndpoint) else PoolEndpoint(**e) for e in endpoints
+        ]
+        if not self.endpoints:
+            raise ValueError("A client pool needs at least one endpoint")
+        for i, endpoint in enumerate(self.endpoints):
+            if not endpoint.name:
+                endpoint.name = f"endpoint-{i}"
+        self.eject_after = eject_after
+        self.base_ejection_seconds = base_ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "ClientPool":
+        config = dict(config)
+        return ClientPool(config.pop("endpoints"), **config)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "endpoints": [e.to_config() for e in self.endpoints],
+            "eject_after": self.eject_after,
+            "base_ejection_seconds": self.base_ejection_seconds,
+            "max_ejection_seconds": self.max_ejection_seconds,
+        }
+
+    async def aclose(self):
+        # Closes the endpoints' async clients (and their connection pools)
+        # that belong to the running loop. They're opened again if needed.
+        for endpoint in self.endpoints:
+            await endpoint.aclose()
+
+    def choose(self) -> PoolEndpoint:
+        # The healthy endpoint with the fewest requests in flight for its
+        # weight; ties are broken round-robin. If every endpoint has been
+        # ejected, the one that's due back soonest is used anyway, since
+        # failing outright wouldn't help anybody. The caller must hand the
+        # endpoint back with release().
+        with self._lock:
+            now = time.monotonic()
+            n = len(self.endpoints)
+            order = [self.endpoints[(self._next + k) % n] for k in range(n)]
+            healthy = [e for e in order if e.is_healthy(now)]
+            if healthy:
+                endpoint = min(healthy, key=lambda e: e.in_flight / e.weight)
+            else:
+                endpoint = min(order, key=lambda e: e.ejected_until)
+            self._next = (self.endpoints.index(endpoint) + 1) % n
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(
+        self,
+        endpoint: PoolEndpoint,
+        *,
+        succeeded: bool = False,
+        error: Optional[str] = None,
+        throttled_for: Optional[float] = None,
+    ):
+        # Records how the request went: succeeded if the endpoint answered
+        # at all, error if it failed in a way that's its own fault (timeouts,
+        # 5xx, connection and auth errors), or neither, e.g. if the request
+        # was cancelled. A 429 (throttled_for is how long the server asked
+        # us to back off) doesn't count against the endpoint either; it just
+        # takes it out of the rotation until then.
+        with self._lock:
+            endpoint.in_flight = max(0, endpoint.in_flight - 1)
+            now = time.monotonic()
+            if throttled_for is not None:
+                endpoint.ejected_until = max(
+                    endpoint.ejected_until, now + throttled_for
+                )
+            elif succeeded:
+                endpoint.consecutive_failures = 0
+                endpoint.ejection_streak = 0
+            elif error is not None:
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.consecutive_failures >= self.eject_after:
+                    seconds = min(
+                        self.max_ejection_seconds,
+                        self.base_ejection_seconds * 2**endpoint.ejection_streak,
+                    )
+                    endpoint.ejections += 1
+                    endpoint.ejection_streak += 1
+                    endpoint.consecutive_failures = 0
+                    endpoint.ejected_until = now + seconds
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                e.name: {
+                    "requests": e.requests,
+                    "failures": e.failures,
+                    "in_flight": e.in_flight,
+                    "ejections": e.ejections,
+                    "healthy": e.is_healthy(now),
+                }
+                for e in self.endpoints
+            }
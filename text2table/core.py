@@ -0,0 +1,2953 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import time
+
+from .adaptive_timeouts import AdaptiveTimeouts
+from .batch_api import BatchJob, OpenAIBatchBackend, make_custom_id, parse_custom_id
+from .chunking import chunk_document, count_tokens, reduce_answers
+from .client_pool import ClientPool
+from .corpus import Corpus
+from .cost_planner import (
+    DEFAULT_OUTPUT_TOKENS_PER_QUESTION,
+    TOKENS_PER_MESSAGE,
+    Budget,
+    JobPlan,
+    TokenCounter,
+    chunk_layout,
+    message_tokens,
+)
+from .dedup import Deduplicator
+from .document import Document
+from .instrumentation import CallRecord, Metrics
+from .document_source import iter_documents, iter_source_offsets
+from .hedging import HedgePolicy, run_hedged
+from .journal import ExtractionJournal
+from .model_cascade import ModelCascade
+from .options import DATATYPES_MODEL, DEFAULT_MODEL, ExtractionOptions
+from .question import Question
+from .rate_limiter import (
+    RateLimiter,
+    compute_backoff,
+    estimate_prompt_tokens,
+    get_retry_after,
+)
+from .response_cache import ResponseCache
+from .result_table import (
+    ArrowIpcTableWriter,
+    CsvTableWriter,
+    ParquetTableWriter,
+    ResultTable,
+)
+from .schema_cache import SchemaCache
+from .skip_predictor import SkipPredictor
+from .structured_output import (
+    StructuredOutput,
+    is_structured_reply,
+    parse_structured_reply,
+    split_structured_multi_question_output,
+)
+from .work_queue import WorkQueue, make_worker_id
+
+from types import SimpleNamespace
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+# openai takes longer to import than everything else here put together, so
+# it's imported by the functions that need it rather than up front. That
+# keeps `import text2table` (and so the start-up of every worker process
+# and of the command line) fast, and importing it does nothing else either.
+if TYPE_CHECKING:
+    import openai
+
+# What the datatype inference call is tagged with in place of a question key.
+DATATYPES_METRICS_KEY = "(datatypes)"
+
+# Roughly how long the datatype inference reply runs, per question: a short
+# discussion and four one-line fields.
+DATATYPES_OUTPUT_TOKENS_PER_QUESTION = 100
+
+# The example that `python -m text2table --sample` runs.
+sample_questions = dict(
+    name="What is the child's name?",
+    age="How old are they?",
+    wealth={
+        "text": "What socioeconomic bracket are they in?",
+        "datatype": ["POOR", "MIDDLECLASS", "RICH"],
+    },
+    present_desired="What present or presents do they want?",
+    misspellings_count="How many misspellings or grammatical mistakes did they make?",
+)
+sample_description = "A letter from a child to Santa Claus"
+
+sample_input = """
+Dear Santa Claus, My name is Yadiel and I am 4 years old. I'm from Dominican parents, but I borned in the United States. I wish you to give me something for Chritsmas. My parents do not have enough money for buy me something. My dad is the only one that is working and my mom is pregnant. My sister, Yazlyn, will born is Chritsmas and I will love if you send her something too for Chritsmas. It will mean something big to me if you send her something. My sizes in clothes are the following: coats, t-shirts, swetters: 4t. Pants, pajamas, and interior clothes: 4t. Sneakers, boots and shoes: 11.5. I am a little friendfull (friendly) and loving boy. I've been a good boy this whole year. I got good news for you. I can sleep without doing pee in my bed since June. With Love, Yadiel.
+"""
+
+
+# What a stream asks for so that its last chunk reports the call's usage.
+_STREAM_OPTIONS = {"stream_options": {"include_usage": True}}
+
+
+def _stream_usage(reply: str, prompt_tokens: int) -> SimpleNamespace:
+    # A stream that was closed early never gets to its usage chunk, so its
+    # usage is counted locally: the prompt as estimated, and the reply as
+    # far as it got (the server may have generated a little more).
+    completion_tokens = count_tokens(reply)
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+    )
+
+
+def _read_stream(
+    response,
+    *,
+    stop_when: Optional[Callable[[str], bool]] = None,
+    call: Optional[CallRecord] = None,
+) -> Tuple[Optional[str], Any, bool]:
+    # Accumulates a streamed reply. If stop_when says the partial reply
+    # already tells us everything we need, the stream is closed right away
+    # (which stops generation) and the partial reply is returned. Returns
+    # (reply, usage, cut_short), where the reply is None if it didn't finish
+    # normally and usage is None if the server didn't report it.
+    reply = ""
+    finish_reason = None
+    usage = None
+    try:
+        for chunk in response:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta.content if choice.delta else None
+            if delta:
+                reply += delta
+                # A section only settles once the next header line is
+                # complete, so there's no point checking mid-line.
+                if stop_when is not None and "\n" in delta and stop_when(reply):
+                    if call is not None:
+                        call.finish_reason = "early_stop"
+                    return reply, usage, True
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+                if call is not None:
+                    call.finish_reason = finish_reason
+    finally:
+        response.close()
+
+    if finish_reason != "stop":
+        return None, usage, False
+    return reply, usage, False
+
+
+async def _async_read_stream(
+    response,
+    *,
+    stop_when: Optional[Callable[[str], bool]] = None,
+    call: Optional[CallRecord] = None,
+) -> Tuple[Optional[str], Any, bool]:
+    reply = ""
+    finish_reason = None
+    usage = None
+    try:
+        async for chunk in response:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            delta = choice.delta.content if choice.delta else None
+            if delta:
+                reply += delta
+                if stop_when is not None and "\n" in delta and stop_when(reply):
+                    if call is not None:
+                        call.finish_reason = "early_stop"
+                    return reply, usage, True
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+                if call is not None:
+                    call.finish_reason = finish_reason
+    finally:
+        await response.close()
+
+    if finish_reason != "stop":
+        return None, usage, False
+    return reply, usage, False
+
+
+def _cache_keys(
+    model: str,
+    messages: List[Dict[str, str]],
+    completion_options: Dict[str, Any],
+    *,
+    early_stop: bool,
+) -> Tuple[str, Optional[str]]:
+    # A reply that was cut short by an early stop is cached under a key of
+    # its own, so that only another early-stopping call can get it back. A
+    # whole reply does for either kind of call.
+    key = ResponseCache.make_key(model, messages, temperature=0, **completion_options)
+    cut_short_key = None
+    if early_stop:
+        cut_short_key = ResponseCache.make_key(
+            model, messages, temperature=0, early_stop=True, **completion_options
+        )
+    return key, cut_short_key
+
+
+def _cache_get(
+    cache: ResponseCache, key: str, cut_short_key: Optional[str]
+) -> Optional[str]:
+    reply = cache.get(key)
+    if reply is None and cut_short_key is not None:
+        reply = cache.get(cut_short_key)
+    return reply
+
+
+def _reply_from_choice(choice) -> Optional[str]:
+    # The reply's text, or with function calling, the arguments the model
+    # called the function with. None if the reply didn't finish normally.
+    if choice.finish_reason not in ("stop", "tool_calls"):
+        return None
+    message = choice.message
+    if message.tool_calls:
+        return message.tool_calls[0].function.arguments
+    return message.content
+
+
+def send_gpt_chat(
+    messages: Union[str, Iterable],
+    *,
+    openai_client: Union["openai.OpenAI", ClientPool],
+    model: str,
+    timeout: Union[float, "openai.Timeout", None] = None,
+    retries: int = 3,
+    throttle: float = 3.0,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    stream: bool = False,
+    stop_when: Optional[Callable[[str], bool]] = None,
+    metrics: Optional[Metrics] = None,
+    question_keys: Iterable[str] = (),
+    queued_at: Optional[float] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+    expected_output_tokens: Optional[int] = None,
+    completion_options: Optional[Dict[str, Any]] = None,
+):
+    # completion_options are extra arguments to chat.completions.create,
+    # such as a response_format or tools (see structured_output).
+    import openai
+
+    if type(messages) == str:
+        messages = [{"role": "user", "content": messages}]
+    question_keys = list(question_keys)
+    prompt_tokens = estimate_prompt_tokens(messages)
+    completion_options = dict(completion_options or {})
+
+    # Every logical call (with all of its retries) becomes one CallRecord
+    # when there's a Metrics to give it to.
+    call = None
+    if metrics is not None:
+        call = metrics.start_call(
+            model=model, question_keys=question_keys, queued_at=queued_at
+        )
+        call.estimated_prompt_tokens = prompt_tokens
+
+    try:
+        # With refresh_cache, we skip the lookup but still store the new reply.
+        cache_key = None
+        cut_short_key = None
+        if cache is not None:
+            cache_key, cut_short_key = _cache_keys(
+                model,
+                messages,
+                completion_options,
+                early_stop=stream and stop_when is not None,
+            )
+            if not refresh_cache:
+                reply = _cache_get(cache, cache_key, cut_short_key)
+                if reply is not None:
+                    if call is not None:
+                        call.cache_hit = True
+                        call.succeeded = True
+                    return reply
+
+        # With a client pool, every attempt goes to whichever endpoint the
+        # pool picks, and is throttled by that endpoint's own rate limiter if
+        # it has one.
+        pool = openai_client if isinstance(openai_client, ClientPool) else None
+        estimated_tokens = 0
+
+        # Passing timeout=None to the client would switch its timeout off
+        # altogether, so in that case leave it out and let the client's own
+        # default apply.
+        request_options = {} if timeout is None else {"timeout": timeout}
+        request_options.update(completion_options)
+
+        # With a timeout policy (and no fixed timeout), each attempt's
+        # timeout comes from how long calls like this one have been taking.
+        # expected_output_tokens defaults to the policy's per-question
+        # figure times the number of questions asked.
+        if timeout_policy is not None and expected_output_tokens is None:
+            expected_output_tokens = timeout_policy.expected_output_tokens * max(
+                1, len(question_keys)
+            )
+        timeouts = 0
+
+        attempt = 0
+        while attempt < retries:
+            if timeout is None and timeout_policy is not None:
+                request_options = {
+                    "timeout": timeout_policy.timeout_for(
+                        model, prompt_tokens, expected_output_tokens, attempt=timeouts
+                    ),
+                    **completion_options,
+                }
+            client, limiter, endpoint = openai_client, rate_limiter, None
+            if pool is not None:
+                endpoint = pool.choose()
+                client = endpoint.client
+                limiter = endpoint.rate_limiter or rate_limiter
+
+            retry_after = None
+            was_throttled = False
+            responded = False
+            failure = None
+            try:
+                if limiter is not None:
+                    if not estimated_tokens:
+                        estimated_tokens = limiter.estimate_tokens(messages)
+                    limiter.acquire(estimated_tokens)
+                if call is not None:
+                    call.begin_attempt()
+                sent_at = time.monotonic()
+                cut_short = False
+                if stream:
+                    response = client.chat.completions.create(
+                        messages=messages,
+                        model=model,
+                        temperature=0,
+                        stream=True,
+                        **_STREAM_OPTIONS,
+                        **request_options,
+                    )
+                    reply, usage, cut_short = _read_stream(
+                        response, stop_when=stop_when, call=call
+                    )
+                    responded = True
+                    if usage is None and reply is not None:
+                        usage = _stream_usage(reply, prompt_tokens)
+                    if call is not None:
+                        call.end_attempt()
+                        call.set_usage(usage)
+                    if limiter is not None:
+                        limiter.settle(estimated_tokens, usage)
+                    if reply is None:
+                        return None
+                else:
+                    response = client.chat.completions.create(
+                        messages=messages, model=model, temperature=0, **request_options
+                    )
+                    responded = True
+                    if call is not None:
+                        call.record_response(response)
+                    if limiter is not None:
+                        limiter.settle(
+                            estimated_tokens, getattr(response, "usage", None)
+                        )
+                    if (
+                        not response
+                        or not response.choices
+                        or not len(response.choices)
+                    ):
+                        return None
+                    reply = _reply_from_choice(response.choices[0])
+                    if reply is None:
+                        return None
+                if timeout_policy is not None and not cut_short:
+                    # Replies that were cut short are left out.
+                    timeout_policy.observe(
+                        model,
+                        prompt_tokens,
+                        expected_output_tokens,
+                        time.monotonic() - sent_at,
+                    )
+                if cache is not None:
+                    key = cut_short_key if cut_short else cache_key
+                    cache.put(key, reply, model=model)
+                if call is not None:
+                    call.succeeded = True
+                return reply
+
+            except (openai.APITimeoutError, openai.InternalServerError) as e:
+                failure = type(e).__name__
+                if isinstance(e, openai.APITimeoutError):
+                    timeouts += 1
+                    if timeout_policy is not None:
+                        timeout_policy.record_timeout(
+                            model, prompt_tokens, expected_output_tokens
+                        )
+                if call is not None:
+                    call.end_attempt(error=failure)
+            except openai.RateLimitError as e:
+                was_throttled = True
+                retry_after = get_retry_after(e)
+                if call is not None:
+                    call.end_attempt(error=type(e).__name__)
+            except (
+                openai.APIConnectionError,
+                openai.AuthenticationError,
+                openai.PermissionDeniedError,
+            ) as e:
+                # Worth retrying only if there's another endpoint to try.
+                if pool is None:
+                    raise
+                failure = type(e).__name__
+                if call is not None:
+                    call.end_attempt(error=failure)
+            finally:
+                if endpoint is not None:
+                    pool.release(
+                        endpoint,
+                        succeeded=responded,
+                        error=failure,
+                        throttled_for=(
+                            (retry_after or throttle) if was_throttled else None
+                        ),
+                    )
+
+            attempt += 1
+            if attempt >= retries:
+                break
+
+            delay = compute_backoff(attempt - 1, base=throttle, retry_after=retry_after)
+            if was_throttled and limiter is not None:
+                # Hold back every caller sharing this limiter, not just this one.
+                # The next acquire() will do the waiting.
+                limiter.pause(delay)
+            elif delay:
+                time.sleep(delay)
+    except BaseException as e:
+        if call is not None:
+            call.end_attempt(error=type(e).__name__)
+        raise
+    finally:
+        if call is not None:
+            metrics.end_call(call)
+
+
+async def async_send_gpt_chat(
+    messages: Union[str, Iterable],
+    *,
+    openai_client: Union["openai.AsyncOpenAI", ClientPool],
+    model: str,
+    timeout: Union[float, "openai.Timeout", None] = None,
+    retries: int = 3,
+    throttle: float = 3.0,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    stream: bool = False,
+    stop_when: Optional[Callable[[str], bool]] = None,
+    metrics: Optional[Metrics] = None,
+    question_keys: Iterable[str] = (),
+    queued_at: Optional[float] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+    expected_output_tokens: Optional[int] = None,
+    hedge_policy: Optional[HedgePolicy] = None,
+    completion_options: Optional[Dict[str, Any]] = None,
+):
+    # Same contract as send_gpt_chat, but yields to the event loop while the
+    # request is in flight so that many cells can be outstanding at once.
+    # With a hedge_policy, a request that's running late is duplicated and
+    # whichever copy finishes first is used. (Only the async path hedges.)
+    import openai
+
+    if type(messages) == str:
+        messages = [{"role": "user", "content": messages}]
+    question_keys = list(question_keys)
+    prompt_tokens = estimate_prompt_tokens(messages)
+    completion_options = dict(completion_options or {})
+
+    # Every logical call (with all of its retries) becomes one CallRecord
+    # when there's a Metrics to give it to.
+    call = None
+    if metrics is not None:
+        call = metrics.start_call(
+            model=model, question_keys=question_keys, queued_at=queued_at
+        )
+        call.estimated_prompt_tokens = prompt_tokens
+
+    try:
+        # With refresh_cache, we skip the lookup but still store the new reply.
+        cache_key = None
+        cut_short_key = None
+        if cache is not None:
+            cache_key, cut_short_key = _cache_keys(
+                model,
+                messages,
+                completion_options,
+                early_stop=stream and stop_when is not None,
+            )
+            if not refresh_cache:
+                reply = _cache_get(cache, cache_key, cut_short_key)
+                if reply is not None:
+                    if call is not None:
+                        call.cache_hit = True
+                        call.succeeded = True
+                    return reply
+
+        # With a client pool, every attempt goes to whichever endpoint the
+        # pool picks, and is throttled by that endpoint's own rate limiter if
+        # it has one.
+        pool = openai_client if isinstance(openai_client, ClientPool) else None
+        estimated_tokens = 0
+
+        # Passing timeout=None to the client would switch its timeout off
+        # altogether, so in that case leave it out and let the client's own
+        # default apply.
+        request_options = {} if timeout is None else {"timeout": timeout}
+        request_options.update(completion_options)
+
+        # With a timeout policy (and no fixed timeout), each attempt's
+        # timeout comes from how long calls like this one have been taking.
+        # expected_output_tokens defaults to the policy's per-question
+        # figure times the number of questions asked.
+        latencies = [timeout_policy] if timeout_policy is not None else []
+        if hedge_policy is not None and hedge_policy.latencies is not timeout_policy:
+            latencies.append(hedge_policy.latencies)
+        if latencies and expected_output_tokens is None:
+            expected_output_tokens = latencies[0].expected_output_tokens * max(
+                1, len(question_keys)
+            )
+        timeouts = 0
+
+        attempt = 0
+        while attempt < retries:
+            if timeout is None and timeout_policy is not None:
+                request_options = {
+                    "timeout": timeout_policy.timeout_for(
+                        model, prompt_tokens, expected_output_tokens, attempt=timeouts
+                    ),
+                    **completion_options,
+                }
+            client, limiter, endpoint = openai_client, rate_limiter, None
+            if pool is not None:
+                endpoint = pool.choose()
+                client = endpoint.async_client
+                limiter = endpoint.rate_limiter or rate_limiter
+
+            retry_after = None
+            was_throttled = False
+            responded = False
+            failure = None
+            try:
+                if limiter is not None:
+                    if not estimated_tokens:
+                        estimated_tokens = limiter.estimate_tokens(messages)
+                    await limiter.async_acquire(estimated_tokens)
+                if call is not None:
+                    call.begin_attempt()
+                sent_at = time.monotonic()
+
+                async def request(c):
+                    # (reply, usage, cut_short) for a stream, the response
+                    # otherwise.
+                    if stream:
+                        response = await c.chat.completions.create(
+                            messages=messages,
+                            model=model,
+                            temperature=0,
+                            stream=True,
+                            **_STREAM_OPTIONS,
+                            **request_options,
+                        )
+                        return await _async_read_stream(
+                            response, stop_when=stop_when, call=call
+                        )
+                    return await c.chat.completions.create(
+                        messages=messages, model=model, temperature=0, **request_options
+                    )
+
+                async def hedgeable_request(is_hedge: bool):
+                    # A hedge goes to an endpoint of its own if there's a
+                    # pool. It skips the rate limiter, since hedges are
+                    # rationed by the policy anyway.
+                    if not is_hedge or pool is None:
+                        return await request(client)
+                    hedge_endpoint = pool.choose()
+                    hedge_responded = False
+                    hedge_failure = None
+                    try:
+                        result = await request(hedge_endpoint.async_client)
+                        hedge_responded = True
+                        return result
+                    except (openai.APIConnectionError, openai.InternalServerError) as e:
+                        hedge_failure = type(e).__name__
+                        raise
+                    finally:
+                        pool.release(
+                            hedge_endpoint,
+                            succeeded=hedge_responded,
+                            error=hedge_failure,
+                        )
+
+                if hedge_policy is None:
+                    result = await request(client)
+                else:
+                    result, hedged, hedge_won = await run_hedged(
+                        hedgeable_request,
+                        delay=hedge_policy.delay_for(
+                            model, prompt_tokens, expected_output_tokens
+                        ),
+                        policy=hedge_policy,
+                    )
+                    if call is not None and hedged:
+                        call.hedges += 1
+                        call.hedge_won = call.hedge_won or hedge_won
+                responded = True
+
+                cut_short = False
+                if stream:
+                    reply, usage, cut_short = result
+                    if usage is None and reply is not None:
+                        usage = _stream_usage(reply, prompt_tokens)
+                    if call is not None:
+                        call.end_attempt()
+                        call.set_usage(usage)
+                    if limiter is not None:
+                        limiter.settle(estimated_tokens, usage)
+                    if reply is None:
+                        return None
+                else:
+                    response = result
+                    if call is not None:
+                        call.record_response(response)
+                    if limiter is not None:
+                        limiter.settle(
+                            estimated_tokens, getattr(response, "usage", None)
+                        )
+                    if (
+                        not response
+                        or not response.choices
+                        or not len(response.choices)
+                    ):
+                        return None
+                    reply = _reply_from_choice(response.choices[0])
+                    if reply is None:
+                        return None
+                if not cut_short:
+                    # Replies that were cut short are left out.
+                    for tracker in latencies:
+                        tracker.observe(
+                            model,
+                            prompt_tokens,
+                            expected_output_tokens,
+                            time.monotonic() - sent_at,
+                        )
+                if cache is not None:
+                    key = cut_short_key if cut_short else cache_key
+                    cache.put(key, reply, model=model)
+                if call is not None:
+                    call.succeeded = True
+                return reply
+
+            except (openai.APITimeoutError, openai.InternalServerError) as e:
+                failure = type(e).__name__
+                if isinstance(e, openai.APITimeoutError):
+                    timeouts += 1
+                    if timeout_policy is not None:
+                        timeout_policy.record_timeout(
+                            model, prompt_tokens, expected_output_tokens
+                        )
+                if call is not None:
+                    call.end_attempt(error=failure)
+            except openai.RateLimitError as e:
+                was_throttled = True
+                retry_after = get_retry_after(e)
+                if call is not None:
+                    call.end_attempt(error=type(e).__name__)
+            except (
+                openai.APIConnectionError,
+                openai.AuthenticationError,
+                openai.PermissionDeniedError,
+            ) as e:
+                # Worth retrying only if there's another endpoint to try.
+                if pool is None:
+                    raise
+                failure = type(e).__name__
+                if call is not None:
+                    call.end_attempt(error=failure)
+            finally:
+                if endpoint is not None:
+                    pool.release(
+                        endpoint,
+                        succeeded=responded,
+                        error=failure,
+                        throttled_for=(
+                            (retry_after or throttle) if was_throttled else None
+                        ),
+                    )
+
+            attempt += 1
+            if attempt >= retries:
+                break
+
+            delay = compute_backoff(attempt - 1, base=throttle, retry_after=retry_after)
+            if was_throttled and limiter is not None:
+                # Hold back every caller sharing this limiter, not just this one.
+                # The next acquire() will do the waiting.
+                limiter.pause(delay)
+            elif delay:
+                await asyncio.sleep(delay)
+    except BaseException as e:
+        if call is not None:
+            call.end_attempt(error=type(e).__name__)
+        raise
+    finally:
+        if call is not None:
+            metrics.end_call(call)
+
+
+def create_datatypes_prompt(
+    questions: List[Question], document_description: Optional[str] = None
+) -> str:
+    if type(document_description) == tuple:
+        document_description = document_description[0]
+
+    prompt = (
+        "I'm a programmer who's writing a data ingestion script for a client. "
+        "I need your help to determine the best variable types with which to represent "
+        "the data that the client wants to extract.\n\n"
+        "The client will give me a series of documents. I haven't seen the documents myself "
+        "yet, but I know that there will be hundreds of them. "
+    )
+    if document_description:
+        prompt += "Each document can best be described as: " + document_description
+
+    prompt += "\n\nFrom each document, I need to extract the following variables:\n\n"
+
+    for question in questions:
+        prompt += f"- **{question.key}**: {question.text}\n"
+
+    prompt += (
+        "\nI need to pick an appropriate data type for each variable. "
+        "I have a fixed set of data types at my disposal. The data types I can use "
+        "are as follows:\n\n"
+        "- **int**\n"
+        "- **float**\n"
+        "- **str**\n"
+        "- **List[int]** (i.e. a list of integers)\n"
+        "- **List[float]** (i.e. a list of floats)\n"
+        "- **List[str]** (i.e. a list of strings)\n"
+        "- **date** (i.e. a Python datetime.date object)\n"
+        "- **datetime** (i.e. a Python datetime.datetime object)\n"
+        "- **timedelta** (i.e. a Python datetime.timedelta object)\n"
+        '- **enum("VALUE_1", "VALUE_2", ...)** (i.e. an enum with a set number of possible values, each of which is denoted with a string)\n'
+        "\nFor numerical data types, I also have the option to provide a string that indicates the number's units.\n\n"
+    )
+
+    prompt += (
+        "I'd like you to go through each variable, one at a time, and determine which of the "
+        "above data types would be most appropriate for it. You will provide the name of the "
+        "variable, a brief discussion about what its best data type might be, a datatype, and "
+        "a unit label (if appropriate). In some cases, you might even choose an appropriate default value. "
+        "As such, for each variable, your reply will look like this:\n"
+        "\n"
+        "VARIABLE: name_of_variable\n"
+        "DISCUSSION: Here you discuss which of the available data types would best suit this variable.\n"
+        "DATATYPE: one of the above data types\n"
+        "UNITS: for numerical types, a label indicating what units the variable's value will represent\n"
+        "DEFAULT: a default value, if one seems appropriate\n"
+        "\n"
+        "Here are a few examples:\n"
+        "\n"
+        "VARIABLE: bank_account_balance\n"
+        "DISCUSSION: A bank account is represented by a scalar numerical value. We don't know the currency, "
+        "so we will assume USD because it's the most commonly used currency in the world. "
+        "To represent cents, we need decimal support; as such, a floating-point value is the most "
+        "appropriate choice. As for default value, we'll choose a round number for a typical "
+        "checking account balance.\n"
+        "DATATYPE: float\n"
+        "UNITS: U.S. Dollars (US$)\n"
+        "DEFAULT: 10000.0\n"
+        "\n"
+        "VARIABLE: us_coin\n"
+        "DISCUSSION: The US Mint only makes a few denominations of coins, so an enum would be the most appropriate.\n"
+        'DATATYPE: enum("PENNY", "NICKEL", "DIME", "QUARTER", "HALFDOLLAR", "SILVERDOLLAR")\n'
+        "UNITS: N/A\n"
+        "DEFAULT: N/A"
+    )
+    return prompt
+
+
+def apply_datatypes_reply(questions: List[Question], reply: str) -> List[Question]:
+    if not reply:
+        return questions
+
+    reply_lines = reply.split("\n")
+    q_by_key = {q.key: q for q in questions}
+    q_current = None
+    for line in reply_lines:
+        if ":" not in line:
+            continue
+        line = line.strip()
+        fieldname, fieldvalue = line.split(":", maxsplit=1)
+        fieldname = fieldname.strip()
+        fieldvalue = fieldvalue.strip()
+
+        if fieldvalue.upper() == "N/A":
+            continue
+
+        if fieldname.upper() == "VARIABLE":
+            q_current = q_by_key.get(fieldvalue)
+            continue
+
+        if not q_current:
+            continue
+
+        if fieldname.upper() == "DISCUSSION":
+            if not q_current.explanation:
+                q_current.explanation = fieldvalue
+
+        elif fieldname.upper() == "UNITS":
+            if not q_current.unitlabel:
+                q_current.unitlabel = fieldvalue
+
+        elif fieldname.upper() == "DEFAULT":
+            if not q_current.defaultvalue:
+                q_current.defaultvalue = fieldvalue
+
+        elif fieldname.upper() == "DATATYPE":
+            if not q_current.datatype:
+                datatype = Question.datatype_from_string(fieldvalue)
+                if datatype is not None:
+                    q_current.datatype = datatype
+
+    for q in questions:
+        if q.defaultvalue is not None and q.datatype is not None:
+            q.defaultvalue = q.coerce_to_my_datatype(q.defaultvalue)
+        q.check_aggregation()
+
+    return questions
+
+
+def _datatypes_timeout(questions: List[Question]) -> float:
+    # The timeout should be proportional to the number of questions.
+    # Each question really shouldn't take more than five seconds max
+    # to determine the data type.
+    return 10 + 5 * len(questions)
+
+
+def _questions_needing_datatypes(
+    questions: List[Question],
+    *,
+    schema_cache: Optional[SchemaCache],
+    document_description: Optional[str],
+) -> Tuple[List[Question], Dict[str, str]]:
+    # Fill in whatever the schema cache already knows, and return the
+    # questions that still have to be sent to the model, along with their
+    # fingerprints so the results can be stored afterwards.
+    if schema_cache is None:
+        return questions, {}
+
+    pending = []
+    fingerprints = {}
+    for q in questions:
+        fingerprint = SchemaCache.fingerprint(q, document_description)
+        entry = schema_cache.get(fingerprint)
+        if entry is not None:
+            SchemaCache.apply(q, entry)
+        else:
+            pending.append(q)
+            fingerprints[q.key] = fingerprint
+    return pending, fingerprints
+
+
+def _remember_datatypes(
+    questions: List[Question],
+    *,
+    schema_cache: Optional[SchemaCache],
+    fingerprints: Dict[str, str],
+):
+    # A question the model didn't give a datatype to is left out, so that
+    # it gets asked about again next time rather than staying untyped.
+    questions = [q for q in questions if q.datatype is not None]
+    if schema_cache is None or not questions:
+        return
+    for q in questions:
+        schema_cache.put(fingerprints[q.key], q)
+    schema_cache.save()
+
+
+def determine_datatypes(
+    questions: List[Question],
+    *,
+    openai_client: Union["openai.OpenAI", ClientPool],
+    document_description: Optional[str] = None,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    schema_cache: Optional[SchemaCache] = None,
+    model: str = DATATYPES_MODEL,
+    metrics: Optional[Metrics] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+) -> List[Question]:
+    pending, fingerprints = _questions_needing_datatypes(
+        questions,
+        schema_cache=schema_cache,
+        document_description=document_description,
+    )
+    if not pending:
+        return questions
+
+    prompt = create_datatypes_prompt(
+        questions=pending, document_description=document_description
+    )
+
+    # A timeout policy replaces the fixed guess at how long this takes.
+    reply = send_gpt_chat(
+        messages=prompt,
+        timeout=None if timeout_policy else _datatypes_timeout(pending),
+        model=model,
+        openai_client=openai_client,
+        cache=cache,
+        refresh_cache=refresh_cache,
+        rate_limiter=rate_limiter,
+        metrics=metrics,
+        question_keys=[DATATYPES_METRICS_KEY],
+        timeout_policy=timeout_policy,
+        expected_output_tokens=DATATYPES_OUTPUT_TOKENS_PER_QUESTION * len(pending),
+    )
+    if reply:
+        apply_datatypes_reply(questions=pending, reply=reply)
+        _remember_datatypes(
+            pending, schema_cache=schema_cache, fingerprints=fingerprints
+        )
+    return questions
+
+
+async def async_determine_datatypes(
+    questions: List[Question],
+    *,
+    openai_client: Union["openai.AsyncOpenAI", ClientPool],
+    document_description: Optional[str] = None,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    schema_cache: Optional[SchemaCache] = None,
+    model: str = DATATYPES_MODEL,
+    metrics: Optional[Metrics] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+) -> List[Question]:
+    pending, fingerprints = _questions_needing_datatypes(
+        questions,
+        schema_cache=schema_cache,
+        document_description=document_description,
+    )
+    if not pending:
+        return questions
+
+    prompt = create_datatypes_prompt(
+        questions=pending, document_description=document_description
+    )
+
+    # A timeout policy replaces the fixed guess at how long this takes.
+    reply = await async_send_gpt_chat(
+        messages=prompt,
+        timeout=None if timeout_policy else _datatypes_timeout(pending),
+        model=model,
+        openai_client=openai_client,
+        cache=cache,
+        refresh_cache=refresh_cache,
+        rate_limiter=rate_limiter,
+        metrics=metrics,
+        question_keys=[DATATYPES_METRICS_KEY],
+        timeout_policy=timeout_policy,
+        expected_output_tokens=DATATYPES_OUTPUT_TOKENS_PER_QUESTION * len(pending),
+    )
+    if reply:
+        apply_datatypes_reply(questions=pending, reply=reply)
+        _remember_datatypes(
+            pending, schema_cache=schema_cache, fingerprints=fingerprints
+        )
+    return questions
+
+
+def create_systemprompt(question: Question) -> str:
+    systemprompt = ""
+
+    systemprompt += f"""
+I will present a short document to you. You will read this document and then extract a single piece of information from that document. You will be graded on your reasoning process and your ability to justify your answer.
+
+The piece of information I'd like you to extract is: {question.text}
+
+Present your response in Markdown format, using the following multi-part structure: RELEVANCE, AVAILABILITY, DISCUSSION, and ANSWER. Each part will begin with its header, followed by your content.
+
+# RELEVANCE
+Here, you will determine whether or not the desired piece of information is relevant to the subject matter of the document. You will ultimately write, in all caps, either RELEVANT (it's relevant), or OFFTOPIC (it's off-topic).
+
+# AVAILABILITY
+Here, you will determine whether or not the desired information is present in the document. You will ultimately write, in all caps, one of the following: STATED (the information is explicitly stated in the document), IMPLIED (the information is implied by other content in the document), or ABSENT (the information cannot be determined from the document).
+
+# COMPUTATION
+If the problem requires any kind of counting, enumeration, calculation, or so forth, then you can use this section as a scratchpad upon which to work out your math. If the problem doesn't require any such processes, then you can simply skip this section if you wish.
+
+# DISCUSSION
+Here, you will discuss what your final answer will be. You will give arguments about why the answer might be one thing or another.
+
+# ANSWER
+Here, you will state your final answer in a succinct manner, with no other text.
+
+"""
+
+    if question.datatype is not None:
+        systemprompt += "Your final answer in will be written in the following format: "
+        systemprompt += question.instructions_for_my_datatype()
+        systemprompt += "\n\n"
+
+    if question.required:
+        systemprompt += "It is mandatory that you provide *some* answer in the ANSWER section. If needed, just take your best guess.\n\n"
+
+    systemprompt += "Good luck."
+
+    return systemprompt
+
+
+def create_multi_question_systemprompt(questions: List[Question]) -> str:
+    systemprompt = ""
+
+    systemprompt += """
+I will present a short document to you. You will read this document and then extract several pieces of information from that document. You will be graded on your reasoning process and your ability to justify your answers.
+
+The pieces of information I'd like you to extract are listed below, each with a key that identifies it.
+
+"""
+
+    for question in questions:
+        systemprompt += f"- **{question.key}**: {question.text}\n"
+        if question.datatype is not None:
+            systemprompt += (
+                "  Its final answer will be written in the following format: "
+            )
+            systemprompt += question.instructions_for_my_datatype()
+            systemprompt += "\n"
+        if question.required:
+            systemprompt += "  It is mandatory that you provide *some* answer for this one. If needed, just take your best guess.\n"
+
+    systemprompt += """
+Present your response in Markdown format. Address each piece of information separately, in the order listed above. For each one, begin with a top-level header of the form "# QUESTION: key" (using the key exactly as written above), followed by the multi-part structure RELEVANCE, AVAILABILITY, COMPUTATION, DISCUSSION, and ANSWER. Each part will begin with its own second-level header, followed by your content.
+
+## RELEVANCE
+Here, you will determine whether or not the desired piece of information is relevant to the subject matter of the document. You will ultimately write, in all caps, either RELEVANT (it's relevant), or OFFTOPIC (it's off-topic).
+
+## AVAILABILITY
+Here, you will determine whether or not the desired information is present in the document. You will ultimately write, in all caps, one of the following: STATED (the information is explicitly stated in the document), IMPLIED (the information is implied by other content in the document), or ABSENT (the information cannot be determined from the document).
+
+## COMPUTATION
+If the problem requires any kind of counting, enumeration, calculation, or so forth, then you can use this section as a scratchpad upon which to work out your math. If the problem doesn't require any such processes, then you can simply skip this section if you wish.
+
+## DISCUSSION
+Here, you will discuss what your final answer will be. You will give arguments about why the answer might be one thing or another.
+
+## ANSWER
+Here, you will state your final answer in a succinct manner, with no other text.
+
+"""
+
+    systemprompt += "Good luck."
+
+    return systemprompt
+
+
+def _unit_request(
+    questions: List[Question],
+    *,
+    multi_question: bool = False,
+    structured_output: Optional[StructuredOutput] = None,
+) -> Tuple[str, Optional[Dict[str, Any]], Optional[int]]:
+    # What asking these questions of a document takes, apart from the
+    # document: the system prompt, any extra arguments to the request, and
+    # the expected length of the reply if it's not the usual one.
+    if structured_output is None:
+        if multi_question:
+            return create_multi_question_systemprompt(questions=questions), None, None
+        return create_systemprompt(question=questions[0]), None, None
+
+    if multi_question:
+        systemprompt = structured_output.multi_question_systemprompt(questions)
+    else:
+        systemprompt = structured_output.systemprompt(questions[0])
+    return (
+        systemprompt,
+        structured_output.completion_options(questions, multi_question=multi_question),
+        structured_output.expected_output_tokens(len(questions)),
+    )
+
+
+def split_gpt_output(gpt_output):
+    matches = re.findall(r"# (.*?)\n(.*?)(?=# |\Z)", gpt_output, re.DOTALL)
+
+    retval = {match[0]: match[1].strip() for match in matches}
+    return retval
+
+
+def split_multi_question_output(
+    gpt_output: str, questions: List[Question]
+) -> Dict[str, Optional[str]]:
+    # Cut a multi-question reply back into one block per question, with the
+    # second-level headers promoted so that each block looks exactly like a
+    # single-question reply. Questions the model skipped come back as None.
+    retval = {q.key: None for q in questions}
+    if not gpt_output:
+        return retval
+
+    blocks = re.split(r"^#\s*QUESTION:\s*(.*?)\s*$", gpt_output, flags=re.MULTILINE)
+    # re.split with one capture group alternates [preamble, key, body, key, body, ...]
+    for i in range(1, len(blocks) - 1, 2):
+        key = blocks[i].strip("*` ")
+        if key not in retval:
+            continue
+        body = re.sub(r"^##\s+", "# ", blocks[i + 1], flags=re.MULTILINE)
+        retval[key] = body.strip()
+    return retval
+
+
+def extract_gpt_answer(gpt_output):
+    # The answer part of a reply, or None if it's OFFTOPIC or ABSENT. The
+    # answer to a structured reply is parsed JSON; to a Markdown one, it's
+    # still a string.
+    if is_structured_reply(gpt_output):
+        reply = parse_structured_reply(gpt_output)
+        if reply["relevance"] == "OFFTOPIC" or reply["availability"] == "ABSENT":
+            return None
+        return reply.get("answer")
+
+    outdict = split_gpt_output(gpt_output)
+
+    has_relevant_token = "RELEVANT" in outdict.get("RELEVANCE", "")
+    has_offtopic_token = "OFFTOPIC" in outdict.get("RELEVANCE", "")
+    if (not has_relevant_token and not has_offtopic_token) or (
+        has_relevant_token and has_offtopic_token
+    ):
+        raise ValueError("Can't have both (or neither) for RELEVANCE")
+
+    if has_offtopic_token:
+        return None
+
+    has_absent_token = "ABSENT" in outdict.get("AVAILABILITY", "")
+    if has_absent_token:
+        return None
+
+    answer = outdict.get("ANSWER")
+    return answer
+
+
+def reached_null_verdict(partial_output: str) -> bool:
+    # Used while a reply is still streaming in. Returns True once the
+    # RELEVANCE section has settled on OFFTOPIC, or AVAILABILITY on ABSENT,
+    # since extract_gpt_answer will throw the rest of the reply away anyway.
+    # A section only counts as settled once the next header has begun.
+    outdict = split_gpt_output(partial_output)
+    settled = list(outdict.keys())[:-1]
+
+    if "RELEVANCE" in settled:
+        relevance = outdict["RELEVANCE"]
+        if "OFFTOPIC" in relevance and "RELEVANT" not in relevance:
+            return True
+
+    if "AVAILABILITY" in settled and "ABSENT" in outdict["AVAILABILITY"]:
+        return True
+
+    return False
+
+
+def is_null_reply(gpt_output: Union[str, List[str], None]) -> bool:
+    # True if a reply (or every reply, for a chunked document) came back
+    # OFFTOPIC, ABSENT, or unreadable.
+    replies = gpt_output if isinstance(gpt_output, list) else [gpt_output]
+    for reply in replies:
+        if not reply:
+            continue
+        try:
+            if extract_gpt_answer(reply) is not None:
+                return False
+        except ValueError:
+            continue
+    return True
+
+
+def interpret_gpt_answer(
+    question: Question, gpt_output: Optional[str], *, use_default: bool = True
+) -> Any:
+    # Turns one cell's raw reply into a typed value. Anything that doesn't
+    # yield a usable answer (no reply, OFFTOPIC, ABSENT, or an answer that
+    # won't coerce to the question's datatype) falls back to the default,
+    # or to None if use_default is off.
+    fallback = question.defaultvalue if use_default else None
+    if not gpt_output:
+        return fallback
+    try:
+        answer = extract_gpt_answer(gpt_output)
+    except ValueError:
+        return fallback
+    if answer is None:
+        return fallback
+
+    if is_structured_reply(gpt_output):
+        value = question.coerce_json_to_my_datatype(answer)
+    else:
+        value = question.coerce_to_my_datatype(answer)
+    if value is None:
+        return fallback
+    return value
+
+
+def is_acceptable_reply(question: Question, gpt_output: Optional[str]) -> bool:
+    # Used by the model cascade to decide whether a reply is good enough to
+    # keep, or whether the cell should be escalated to a stronger model. A
+    # reply is acceptable if it parses, its verdicts are consistent with one
+    # another, and any answer it gives coerces to the question's datatype.
+    if not gpt_output:
+        return False
+    try:
+        answer = extract_gpt_answer(gpt_output)
+    except ValueError:
+        return False
+
+    if is_structured_reply(gpt_output):
+        # parse_structured_reply has already checked that there's exactly
+        # one verdict of each kind.
+        reply = parse_structured_reply(gpt_output)
+        if reply["relevance"] == "OFFTOPIC" or reply["availability"] == "ABSENT":
+            return not question.required
+        if answer is None or answer == "":
+            return False
+        return _coerces(question, answer, structured=True)
+
+    outdict = split_gpt_output(gpt_output)
+    if "OFFTOPIC" in outdict.get("RELEVANCE", ""):
+        # Nothing after this matters (and with early_stop, it may not even
+        # have been sent). But a required question must get an answer.
+        return not question.required
+
+    availability = outdict.get("AVAILABILITY", "")
+    verdicts = [v for v in ("STATED", "IMPLIED", "ABSENT") if v in availability]
+    if len(verdicts) != 1:
+        return False
+    if verdicts[0] == "ABSENT":
+        return not question.required
+
+    if not answer:
+        return False
+    return _coerces(question, answer, structured=False)
+
+
+def _coerces(question: Question, answer: Any, *, structured: bool) -> bool:
+    # An answer that can't be coerced to the question's datatype is as good
+    # as no answer, however the coercion fails; the cascade escalates it
+    # rather than letting the error end the run.
+    try:
+        if structured:
+            return question.coerce_json_to_my_datatype(answer) is not None
+        return question.coerce_to_my_datatype(answer) is not None
+    except (ValueError, TypeError, KeyError):
+        return False
+
+
+def group_questions(
+    questions: List[Question], max_questions_per_prompt: int
+) -> List[List[Question]]:
+    # A prompt that asks too many questions at once produces a reply long
+    # enough to get truncated, so big question sets are asked in groups.
+    n = max(1, max_questions_per_prompt)
+    return [questions[i : i + n] for i in range(0, len(questions), n)]
+
+
+def ask_gpt_question_about_document(
+    question: Question,
+    document: Document,
+    openai_client: Union["openai.OpenAI", ClientPool],
+    *,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    early_stop: bool = False,
+    model: str = DEFAULT_MODEL,
+    metrics: Optional[Metrics] = None,
+    queued_at: Optional[float] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+    structured_output: Optional[StructuredOutput] = None,
+):
+    # With early_stop, the reply is streamed and cut off as soon as it's
+    # clear that the answer is OFFTOPIC or ABSENT. With structured_output,
+    # the reply is a short JSON object rather than Markdown; those aren't
+    # streamed, since there'd be next to nothing left to cut off.
+    systemprompt, completion_options, expected_output_tokens = _unit_request(
+        [question], structured_output=structured_output
+    )
+    early_stop = early_stop and structured_output is None
+    messages = document.to_gpt_messages(systemprompt=systemprompt)
+
+    reply = send_gpt_chat(
+        messages=messages,
+        openai_client=openai_client,
+        model=model,
+        cache=cache,
+        refresh_cache=refresh_cache,
+        rate_limiter=rate_limiter,
+        stream=early_stop,
+        stop_when=reached_null_verdict if early_stop else None,
+        metrics=metrics,
+        question_keys=[question.key],
+        queued_at=queued_at,
+        timeout_policy=timeout_policy,
+        expected_output_tokens=expected_output_tokens,
+        completion_options=completion_options,
+    )
+    return reply
+
+
+async def async_ask_gpt_question_about_document(
+    question: Question,
+    document: Document,
+    openai_client: Union["openai.AsyncOpenAI", ClientPool],
+    *,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    early_stop: bool = False,
+    model: str = DEFAULT_MODEL,
+    metrics: Optional[Metrics] = None,
+    queued_at: Optional[float] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+    hedge_policy: Optional[HedgePolicy] = None,
+    structured_output: Optional[StructuredOutput] = None,
+):
+    # With early_stop, the reply is streamed and cut off as soon as it's
+    # clear that the answer is OFFTOPIC or ABSENT. With structured_output,
+    # the reply is a short JSON object rather than Markdown; those aren't
+    # streamed, since there'd be next to nothing left to cut off.
+    systemprompt, completion_options, expected_output_tokens = _unit_request(
+        [question], structured_output=structured_output
+    )
+    early_stop = early_stop and structured_output is None
+    messages = document.to_gpt_messages(systemprompt=systemprompt)
+
+    reply = await async_send_gpt_chat(
+        messages=messages,
+        openai_client=openai_client,
+        model=model,
+        cache=cache,
+        refresh_cache=refresh_cache,
+        rate_limiter=rate_limiter,
+        stream=early_stop,
+        stop_when=reached_null_verdict if early_stop else None,
+        metrics=metrics,
+        question_keys=[question.key],
+        queued_at=queued_at,
+        timeout_policy=timeout_policy,
+        expected_output_tokens=expected_output_tokens,
+        hedge_policy=hedge_policy,
+        completion_options=completion_options,
+    )
+    return reply
+
+
+def ask_gpt_questions_about_document(
+    questions: List[Question],
+    document: Document,
+    openai_client: Union["openai.OpenAI", ClientPool],
+    *,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    model: str = DEFAULT_MODEL,
+    metrics: Optional[Metrics] = None,
+    queued_at: Optional[float] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+    structured_output: Optional[StructuredOutput] = None,
+) -> Dict[str, Optional[str]]:
+    systemprompt, completion_options, expected_output_tokens = _unit_request(
+        questions, multi_question=True, structured_output=structured_output
+    )
+    messages = document.to_gpt_messages(systemprompt=systemprompt)
+
+    reply = send_gpt_chat(
+        messages=messages,
+        openai_client=openai_client,
+        model=model,
+        cache=cache,
+        refresh_cache=refresh_cache,
+        rate_limiter=rate_limiter,
+        metrics=metrics,
+        question_keys=[q.key for q in questions],
+        queued_at=queued_at,
+        timeout_policy=timeout_policy,
+        expected_output_tokens=expected_output_tokens,
+        completion_options=completion_options,
+    )
+    if structured_output is not None:
+        return split_structured_multi_question_output(reply, questions)
+    return split_multi_question_output(gpt_output=reply, questions=questions)
+
+
+async def async_ask_gpt_questions_about_document(
+    questions: List[Question],
+    document: Document,
+    openai_client: Union["openai.AsyncOpenAI", ClientPool],
+    *,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    rate_limiter: Optional[RateLimiter] = None,
+    model: str = DEFAULT_MODEL,
+    metrics: Optional[Metrics] = None,
+    queued_at: Optional[float] = None,
+    timeout_policy: Optional[AdaptiveTimeouts] = None,
+    hedge_policy: Optional[HedgePolicy] = None,
+    structured_output: Optional[StructuredOutput] = None,
+) -> Dict[str, Optional[str]]:
+    systemprompt, completion_options, expected_output_tokens = _unit_request(
+        questions, multi_question=True, structured_output=structured_output
+    )
+    messages = document.to_gpt_messages(systemprompt=systemprompt)
+
+    reply = await async_send_gpt_chat(
+        messages=messages,
+        openai_client=openai_client,
+        model=model,
+        cache=cache,
+        refresh_cache=refresh_cache,
+        rate_limiter=rate_limiter,
+        metrics=metrics,
+        question_keys=[q.key for q in questions],
+        queued_at=queued_at,
+        timeout_policy=timeout_policy,
+        expected_output_tokens=expected_output_tokens,
+        hedge_policy=hedge_policy,
+        completion_options=completion_options,
+    )
+    if structured_output is not None:
+        return split_structured_multi_question_output(reply, questions)
+    return split_multi_question_output(gpt_output=reply, questions=questions)
+
+
+#######################################################################################
+
+
+def _collect_documents(documents, document_description: str) -> Iterable[Document]:
+    if isinstance(documents, Corpus):
+        # Already in its final form; its documents are read straight out of
+        # the store as they're needed.
+        if document_description:
+            return documents.with_description(document_description)
+        return documents
+    if documents is None or isinstance(documents, (list, dict, str, Document)):
+        return Document.create_collection(
+            documents=documents, document_description=document_description
+        )
+    # Anything else (a generator, or one of the readers in document_source)
+    # is consumed lazily, one document at a time.
+    return Document.iter_collection(
+        documents, document_description=document_description
+    )
+
+
+def create_async_client(
+    openai_client: Union["openai.OpenAI", ClientPool],
+) -> Union["openai.AsyncOpenAI", ClientPool]:
+    # Build an async twin of a sync client, so that callers who only ever
+    # constructed an openai.OpenAI can still use the concurrent engine. A
+    # client pool serves both kinds of caller as it is. Like a pool's
+    # clients, the twin doesn't retry on its own (see create_client).
+    import openai
+
+    if isinstance(openai_client, ClientPool):
+        return openai_client
+    return openai.AsyncOpenAI(
+        api_key=openai_client.api_key,
+        organization=openai_client.organization,
+        base_url=openai_client.base_url,
+        max_retries=0,
+    )
+
+
+async def async_iter_text2table(
+    questions,
+    *,
+    documents,
+    openai_client: Union["openai.AsyncOpenAI", ClientPool],
+    options: Optional[ExtractionOptions] = None,
+    **changes,
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    # Yields (document id, answers) as soon as every cell of a document has
+    # been answered. Rows come out in completion order, not input order.
+    # How the job is run is up to `options` (see ExtractionOptions), with
+    # any keyword arguments overriding its fields.
+    options = ExtractionOptions.create(options, **changes)
+    document_description = options.document_description
+    max_concurrency = options.max_concurrency
+    multi_question = options.multi_question
+    max_questions_per_prompt = options.max_questions_per_prompt
+    cache = options.cache
+    refresh_cache = options.refresh_cache
+    rate_limiter = options.rate_limiter
+    schema_cache = options.schema_cache
+    journal = options.journal
+    resume = options.resume
+    max_chunk_tokens = options.max_chunk_tokens
+    chunk_overlap_tokens = options.chunk_overlap_tokens
+    early_stop = options.early_stop
+    skip_predictor = options.skip_predictor
+    deduplicator = options.deduplicator
+    cascade = options.cascade
+    datatypes_model = options.datatypes_model
+    metrics = options.metrics
+    budget = options.budget
+    timeout_policy = options.timeout_policy
+    hedge_policy = options.hedge_policy
+    structured_output = options.structured_output
+
+    sinks = list(options.sinks)
+    if budget is not None:
+        # The budget learns what each call actually cost by listening in.
+        if metrics is None:
+            metrics = Metrics(prices=budget.prices)
+        if budget not in metrics.hooks:
+            # A worker runs one shard after another with the same metrics.
+            metrics.add_hook(budget)
+        budget.check_prices(_models_used(cascade) + [datatypes_model])
+    if metrics is not None:
+        metrics.start_run()
+    if journal is not None:
+        if resume:
+            journal.load()
+        else:
+            journal.completed = {}
+
+    questions = Question.create_collection(questions=questions)
+    questions = await async_determine_datatypes(
+        questions=questions,
+        document_description=document_description,
+        openai_client=openai_client,
+        cache=cache,
+        refresh_cache=refresh_cache,
+        rate_limiter=rate_limiter,
+        schema_cache=schema_cache,
+        model=datatypes_model,
+        metrics=metrics,
+        timeout_policy=timeout_policy,
+    )
+
+    documents = _collect_documents(documents, document_description)
+
+    for sink in sinks:
+        sink.set_questions(questions)
+
+    if not questions:
+        for doc in documents:
+            for sink in sinks:
+                sink.write_row(doc.id, {})
+            yield doc.id, {}
+        for sink in sinks:
+            sink.flush()
+        if metrics is not None:
+            metrics.end_run()
+        if budget is not None:
+            metrics.hooks.remove(budget)
+        return
+
+    # In multi-question mode, a "cell" is a document paired with a group of
+    # questions that all get asked in a single request.
+    if multi_question:
+        question_units = group_questions(questions, max_questions_per_prompt)
+    else:
+        question_units = [[q] for q in questions]
+
+    unit_requests = []
+    if budget is not None:
+        unit_requests = [
+            _unit_request(
+                unit,
+                multi_question=multi_question,
+                structured_output=structured_output,
+            )
+            for unit in question_units
+        ]
+
+    def projected_row_cost(doc: Document) -> Tuple[int, float]:
+        # What asking this document's cells will probably cost, in tokens
+        # and dollars, not counting cells the journal already has answers
+        # for or any escalation up a cascade.
+        tokens = 0
+        dollars = 0.0
+        for unit, (systemprompt, _, output) in zip(question_units, unit_requests):
+            if journal is not None and all(journal.has(doc.id, q.key) for q in unit):
+                continue
+            model = DEFAULT_MODEL
+            if cascade is not None:
+                model = cascade.models_for(unit[0].key)[0]
+            prompt = estimate_prompt_tokens(
+                doc.to_gpt_messages(systemprompt=systemprompt)
+            )
+            if output is None:
+                output = budget.expected_output_tokens * len(unit)
+            tokens += prompt + output
+            dollars += budget.price(model, prompt, output)
+        return tokens, dollars
+
+    # Partially-answered rows, keyed by the document's position in the input
+    # (IDs aren't guaranteed to be unique). Because cells are handed out in
+    # document order, only about max_concurrency rows are ever open at once.
+    open_rows = {}
+
+    # Duplicates whose representative's row is still open, keyed by the
+    # representative's document ID. They're finished along with it.
+    waiting_duplicates = {}
+
+    def generate_cells():
+        for i, doc in enumerate(documents):
+            # The reservation is made before the deduplicator sees the
+            # document, so that a document we stop short of never becomes
+            # the representative of a cluster.
+            reservation = None
+            if budget is not None:
+                reservation = projected_row_cost(doc)
+                if not budget.reserve(*reservation):
+                    return
+            representative = False
+            if deduplicator is not None:
+                rep = deduplicator.assign(doc)
+                # A duplicate is only copied from a representative that's
+                # being answered now or was answered already. One whose
+                # representative never got answered (say, because the run
+                # that found it was interrupted) is asked itself, and a
+                # representative seen in an earlier run is answered again,
+                # from the journal if there is one.
+                if rep is not None and (
+                    rep in waiting_duplicates
+                    or (rep != doc.id and deduplicator.has_answers(rep))
+                ):
+                    if reservation is not None:
+                        budget.release(*reservation)
+                    # A single placeholder cell (unit None) stands for the
+                    # whole row of a duplicate.
+                    open_rows[i] = {"answers": {}, "remaining": 1, "rep": rep}
+                    yield i, doc, None
+                    continue
+                if rep == doc.id:
+                    representative = True
+                    waiting_duplicates[rep] = []
+            open_rows[i] = {
+                "answers": {},
+                "remaining": len(question_units),
+                "reservation": reservation,
+                "representative": representative,
+            }
+            for unit in question_units:
+                yield i, doc, unit
+
+    # Rather than creating one task per cell up front (which, for a large
+    # corpus, would mean hundreds of thousands of pending coroutines), we run
+    # a fixed pool of workers that all pull from the same lazy cell iterator.
+    # This caps the number of requests in flight at max_concurrency.
+    cells = generate_cells()
+
+    # The queue is bounded so that a slow consumer applies backpressure to
+    # the workers instead of letting finished rows pile up in memory.
+    finished_rows = asyncio.Queue(maxsize=max(1, max_concurrency))
+    done = object()
+
+    # A chunked document fans out into several requests at once, so the cap
+    # on requests in flight is enforced here rather than by the worker count.
+    in_flight = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def ask_unit_of_model(
+        doc: Document, unit: List[Question], model: str
+    ) -> Dict[str, Any]:
+        queued_at = time.monotonic()
+        async with in_flight:
+            if multi_question:
+                return await async_ask_gpt_questions_about_document(
+                    questions=unit,
+                    document=doc,
+                    openai_client=openai_client,
+                    cache=cache,
+                    refresh_cache=refresh_cache,
+                    rate_limiter=rate_limiter,
+                    model=model,
+                    metrics=metrics,
+                    queued_at=queued_at,
+                    timeout_policy=timeout_policy,
+                    hedge_policy=hedge_policy,
+                    structured_output=structured_output,
+                )
+            reply = await async_ask_gpt_question_about_document(
+                question=unit[0],
+                document=doc,
+                openai_client=openai_client,
+                cache=cache,
+                refresh_cache=refresh_cache,
+                rate_limiter=rate_limiter,
+                early_stop=early_stop,
+                model=model,
+                metrics=metrics,
+                queued_at=queued_at,
+                timeout_policy=timeout_policy,
+                hedge_policy=hedge_policy,
+                structured_output=structured_output,
+            )
+            return {unit[0].key: reply}
+
+    async def ask_unit(doc: Document, unit: List[Question]) -> Dict[str, Any]:
+        if cascade is None:
+            return await ask_unit_of_model(doc, unit, DEFAULT_MODEL)
+
+        # Questions in a unit can have different cascades, so at each step
+        # we ask every question that's still pending and whose cascade
+        # reaches this far, grouped by the model it's up to.
+        replies = {}
+        pending = [(q, cascade.models_for(q.key)) for q in unit]
+        tier = 0
+        while pending:
+            by_model = {}
+            for q, models in pending:
+                by_model.setdefault(models[tier], []).append(q)
+
+            results = await asyncio.gather(
+                *[ask_unit_of_model(doc, qs, m) for m, qs in by_model.items()]
+            )
+
+            still_pending = []
+            for (model, qs), result in zip(by_model.items(), results):
+                accepted = 0
+                for q in qs:
+                    reply = result.get(q.key)
+                    models = cascade.models_for(q.key)
+                    replies[q.key] = reply
+                    if is_acceptable_reply(q, reply):
+                        accepted += 1
+                    elif tier + 1 < len(models):
+                        still_pending.append((q, models))
+                cascade.record(model, asked=len(qs), accepted=accepted)
+            pending = still_pending
+            tier += 1
+        return replies
+
+    async def answer_unit(
+        doc: Document, unit: List[Question]
+    ) -> Dict[str, Tuple[Any, Any]]:
+        # Returns {question key: (raw reply, typed value)}.
+        chunks = [doc]
+        if max_chunk_tokens:
+            chunks = chunk_document(
+                doc, max_tokens=max_chunk_tokens, overlap_tokens=chunk_overlap_tokens
+            )
+
+        if len(chunks) == 1:
+            replies = await ask_unit(doc, unit)
+            return {
+                q.key: (replies.get(q.key), interpret_gpt_answer(q, replies.get(q.key)))
+                for q in unit
+            }
+
+        chunk_replies = await asyncio.gather(*[ask_unit(c, unit) for c in chunks])
+        retval = {}
+        for q in unit:
+            replies = [r.get(q.key) for r in chunk_replies]
+            if all(reply is None for reply in replies):
+                retval[q.key] = (None, q.defaultvalue)
+                continue
+            values = [interpret_gpt_answer(q, r, use_default=False) for r in replies]
+            value = reduce_answers(q, values)
+            if value is None:
+                value = q.defaultvalue
+            retval[q.key] = (replies, value)
+        return retval
+
+    async def finish_row(i: int, doc: Document, answers: Dict[str, Any]):
+        row = open_rows.pop(i)
+        reservation = row.get("reservation")
+        if reservation is not None:
+            budget.release(*reservation)
+        if metrics is not None:
+            metrics.record_row()
+        for sink in sinks:
+            sink.write_row(doc.id, answers)
+        await finished_rows.put((doc.id, answers))
+
+        if row.get("representative"):
+            deduplicator.set_answers(doc.id, answers)
+            for j, duplicate in waiting_duplicates.pop(doc.id):
+                await finish_row(j, duplicate, dict(answers))
+
+    async def worker():
+        for i, doc, unit in cells:
+            row = open_rows[i]
+
+            if unit is None:
+                # A duplicate. Representatives always come earlier in the
+                # input, so its answers are either stored already or on the
+                # way; either way this worker doesn't have to wait for them.
+                rep = row["rep"]
+                if rep in waiting_duplicates:
+                    waiting_duplicates[rep].append((i, doc))
+                else:
+                    await finish_row(i, doc, deduplicator.get_answers(rep) or {})
+                continue
+
+            if journal is not None and all(
+                journal.has(doc.id, question.key) for question in unit
+            ):
+                # Answered in a previous run.
+                for question in unit:
+                    row["answers"][question.key] = journal.get(doc.id, question.key)
+            else:
+                # The skip predictor (if any) gets a say on each question
+                # before anything is sent.
+                to_ask = unit
+                audits = set()
+                if skip_predictor is not None:
+                    to_ask = []
+                    for question in unit:
+                        decision = skip_predictor.decide(question.key, doc)
+                        if decision == SkipPredictor.SKIP:
+                            row["answers"][question.key] = question.defaultvalue
+                            continue
+                        if decision == SkipPredictor.AUDIT:
+                            audits.add(question.key)
+                        to_ask.append(question)
+
+                results = await answer_unit(doc, to_ask) if to_ask else {}
+                for question in to_ask:
+                    reply, value = results[question.key]
+                    row["answers"][question.key] = value
+                    # A missing reply means the call failed outright, so it's
+                    # left out of the journal and will be retried on resume.
+                    if journal is not None and reply is not None:
+                        journal.record(
+                            doc.id,
+                            question.key,
+                            reply=reply,
+                            value=value,
+                            datatype=question.datatype,
+                        )
+
+                    if skip_predictor is not None and reply is not None:
+                        absent = is_null_reply(reply)
+                        skip_predictor.observe(question.key, doc, absent)
+                        if question.key in audits:
+                            skip_predictor.record_audit(absent)
+
+            row["remaining"] -= 1
+            if row["remaining"] == 0:
+                await finish_row(i, doc, row["answers"])
+
+    async def run_workers():
+        try:
+            await asyncio.gather(*[worker() for _ in range(max(1, max_concurrency))])
+        finally:
+            await finished_rows.put(done)
+
+    runner = asyncio.create_task(run_workers())
+    try:
+        while True:
+            item = await finished_rows.get()
+            if item is done:
+                break
+            yield item
+        # Surfaces any exception raised by a worker.
+        await runner
+    finally:
+        for sink in sinks:
+            sink.flush()
+        if not runner.done():
+            runner.cancel()
+            try:
+                await runner
+            except (asyncio.CancelledError, Exception):
+                pass
+        if journal is not None:
+            journal.close()
+        if skip_predictor is not None and skip_predictor.path:
+            skip_predictor.save()
+        if deduplicator is not None:
+            deduplicator.commit()
+            deduplicator.save_clusters()
+        if metrics is not None:
+            metrics.end_run()
+        if budget is not None:
+            metrics.hooks.remove(budget)
+
+
+async def async_text2table(
+    questions,
+    *,
+    documents,
+    openai_client: Union["openai.AsyncOpenAI", ClientPool],
+    options: Optional[ExtractionOptions] = None,
+    **changes,
+) -> ResultTable:
+    # Takes the same arguments as async_iter_text2table, but waits for the
+    # whole job and returns the results as a ResultTable.
+    options = ExtractionOptions.create(options, **changes)
+    table = ResultTable()
+    async for _ in async_iter_text2table(
+        questions=questions,
+        documents=documents,
+        openai_client=openai_client,
+        options=options.replace(sinks=[table] + list(options.sinks)),
+    ):
+        pass
+    return table
+
+
+def iter_text2table(
+    questions,
+    *,
+    documents,
+    openai_client: Union["openai.OpenAI", "openai.AsyncOpenAI", ClientPool],
+    options: Optional[ExtractionOptions] = None,
+    **changes,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    # Synchronous generator over the same rows as async_iter_text2table. The
+    # event loop only runs while the caller is asking for the next row.
+    # Since the loop is this function's own, so are any async clients
+    # opened on it, and they're closed along with it.
+    import openai
+
+    twin = None
+    if not isinstance(openai_client, (openai.AsyncOpenAI, ClientPool)):
+        openai_client = twin = create_async_client(openai_client)
+
+    agen = async_iter_text2table(
+        questions=questions,
+        documents=documents,
+        openai_client=openai_client,
+        options=ExtractionOptions.create(options, **changes),
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        try:
+            loop.run_until_complete(agen.aclose())
+        finally:
+            if twin is not None:
+                loop.run_until_complete(twin.close())
+            elif isinstance(openai_client, ClientPool):
+                loop.run_until_complete(openai_client.aclose())
+            loop.close()
+
+
+def text2table(
+    questions,
+    *,
+    documents,
+    openai_client: Union["openai.OpenAI", "openai.AsyncOpenAI", ClientPool],
+    options: Optional[ExtractionOptions] = None,
+    **changes,
+) -> ResultTable:
+    # Synchronous entry point; takes the same arguments as
+    # async_iter_text2table. Callers that are already inside an event loop
+    # should await async_text2table directly instead.
+    options = ExtractionOptions.create(options, **changes)
+    table = ResultTable()
+    for _ in iter_text2table(
+        questions=questions,
+        documents=documents,
+        openai_client=openai_client,
+        options=options.replace(sinks=[table] + list(options.sinks)),
+    ):
+        pass
+    return table
+
+
+def _models_used(cascade: Optional[ModelCascade]) -> List[str]:
+    # The models a run's cells can go to: DEFAULT_MODEL, or every model of
+    # the cascade.
+    if cascade is None:
+        return [DEFAULT_MODEL]
+    models = []
+    for m in [cascade.models] + list(cascade.question_models.values()):
+        models += [model for model in m if model not in models]
+    return models
+
+
+def plan_text2table(
+    questions,
+    *,
+    documents,
+    document_description: str = "",
+    multi_question: bool = False,
+    max_questions_per_prompt: int = 8,
+    max_chunk_tokens: Optional[int] = None,
+    chunk_overlap_tokens: int = 200,
+    cascade: Optional[ModelCascade] = None,
+    models: Optional[Iterable[str]] = None,
+    schema_cache: Optional[SchemaCache] = None,
+    datatypes_model: str = DATATYPES_MODEL,
+    expected_output_tokens: Optional[int] = None,
+    token_counter: Optional[TokenCounter] = None,
+    batch_size: int = 4096,
+    max_concurrency: int = 16,
+    expected_latency: float = 10.0,
+    rate_limiter: Optional[RateLimiter] = None,
+    prices: Optional[Dict[str, Tuple[float, float]]] = None,
+    structured_output: Optional[StructuredOutput] = None,
+) -> JobPlan:
+    # A dry run: builds every prompt the engine would send, tokenizes it
+    # locally, and adds up calls, tokens, the cost under each of `models`
+    # (by default, DEFAULT_MODEL or the models of the cascade) and a runtime
+    # estimate under the rate limiter's limits. Nothing goes over the
+    # network. Questions without a datatype (in the question itself or in
+    # the schema cache) are planned without one, which leaves their prompts
+    # a few dozen tokens short. expected_output_tokens is per question, and
+    # defaults to what the answer format usually takes; with
+    # structured_output, the schema sent along with each request is counted
+    # as part of its prompt. Deduplication, skipping, early stopping and
+    # cascade escalations all make a real run cheaper or dearer than this.
+    questions = Question.create_collection(questions=questions)
+    if models is None:
+        models = _models_used(cascade)
+    plan = JobPlan(models=models, prices=prices)
+
+    counter = token_counter if token_counter is not None else TokenCounter()
+    plan.exact = counter.exact
+    try:
+        pending, _ = _questions_needing_datatypes(
+            questions,
+            schema_cache=schema_cache,
+            document_description=document_description,
+        )
+        if pending:
+            prompt = create_datatypes_prompt(
+                questions=pending, document_description=document_description
+            )
+            plan.datatypes_model = datatypes_model
+            plan.datatypes_prompt_tokens = message_tokens([counter.count(prompt)])
+            plan.datatypes_output_tokens = DATATYPES_OUTPUT_TOKENS_PER_QUESTION * len(
+                pending
+            )
+
+        if not questions:
+            return plan
+
+        if multi_question:
+            question_units = group_questions(questions, max_questions_per_prompt)
+        else:
+            question_units = [[q] for q in questions]
+        units = []
+        for unit in question_units:
+            systemprompt, completion_options, output_tokens = _unit_request(
+                unit,
+                multi_question=multi_question,
+                structured_output=structured_output,
+            )
+            systemprompt_tokens = counter.count(systemprompt)
+            if completion_options:
+                systemprompt_tokens += counter.count(json.dumps(completion_options))
+            if expected_output_tokens is not None:
+                output_tokens = expected_output_tokens * len(unit)
+            elif output_tokens is None:
+                output_tokens = DEFAULT_OUTPUT_TOKENS_PER_QUESTION * len(unit)
+            units.append(([q.key for q in unit], systemprompt_tokens, output_tokens))
+
+        def plan_batch(docs: List[Document]):
+            bodies = counter.count_batch([doc.body for doc in docs])
+            for doc, body_tokens in zip(docs, bodies):
+                plan.documents += 1
+                chunks, body_total = chunk_layout(
+                    body_tokens,
+                    max_tokens=max_chunk_tokens,
+                    overlap_tokens=chunk_overlap_tokens,
+                )
+                description = doc.description
+                if chunks > 1:
+                    plan.chunked_documents += 1
+                    # Every chunk's description is the same length, give or
+                    # take a digit.
+                    description = f"Excerpt 1 of {chunks} from a longer document."
+                    if doc.description:
+                        description = f"{doc.description} ({description})"
+
+                # The document's own messages, apart from the body. IDs are
+                # all different, so they bypass the counter's cache.
+                contents = []
+                if doc.id:
+                    contents.append(count_tokens(f"Document ID: {doc.id}"))
+                if description:
+                    contents.append(
+                        counter.count(f"Document description: {description}")
+                    )
+                largest_body = body_tokens
+                if doc.body:
+                    largest_body = min(body_tokens, max_chunk_tokens or body_tokens)
+
+                for keys, systemprompt_tokens, output_tokens in units:
+                    framing = message_tokens([systemprompt_tokens] + contents)
+                    body_cost = 0
+                    largest = framing
+                    if doc.body:
+                        body_cost = chunks * TOKENS_PER_MESSAGE + body_total
+                        largest += TOKENS_PER_MESSAGE + largest_body
+                    plan.add_calls(
+                        keys,
+                        calls=chunks,
+                        prompt_tokens=chunks * framing + body_cost,
+                        output_tokens=chunks * output_tokens,
+                        largest_prompt=largest,
+                    )
+
+        batch = []
+        for doc in _collect_documents(documents, document_description):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                plan_batch(batch)
+                batch = []
+        if batch:
+            plan_batch(batch)
+    finally:
+        if token_counter is None:
+            counter.close()
+
+    requests_per_minute = None
+    tokens_per_minute = None
+    if rate_limiter is not None:
+        if rate_limiter.requests is not None:
+            requests_per_minute = rate_limiter.requests.capacity
+        if rate_limiter.tokens is not None:
+            tokens_per_minute = rate_limiter.tokens.capacity
+    plan.estimate_runtime(
+        max_concurrency=max_concurrency,
+        expected_latency=expected_latency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+    )
+    return plan
+
+
+def prepare_batch_job(
+    questions,
+    *,
+    documents,
+    directory: str,
+    backend: Any = None,
+    openai_client: Union["openai.OpenAI", ClientPool, None] = None,
+    document_description: str = "",
+    model: str = DEFAULT_MODEL,
+    multi_question: bool = False,
+    max_questions_per_prompt: int = 8,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    schema_cache: Optional[SchemaCache] = None,
+    datatypes_model: str = DATATYPES_MODEL,
+    max_requests_per_file: int = 50000,
+    structured_output: Optional[StructuredOutput] = None,
+) -> BatchJob:
+    # Writes every cell's request into the Batch API input files of a job in
+    # `directory`, using the same prompts as the interactive engine. If the
+    # directory already holds a prepared job, that job is returned as it is,
+    # so a batch run can be restarted at any point.
+    job = BatchJob(directory, backend=backend)
+    if job.prepared:
+        return job
+
+    questions = Question.create_collection(questions=questions)
+    if openai_client is not None:
+        # Datatype inference is one small request, so it's done right away
+        # rather than through the batch.
+        questions = determine_datatypes(
+            questions=questions,
+            document_description=document_description,
+            openai_client=openai_client,
+            cache=cache,
+            refresh_cache=refresh_cache,
+            schema_cache=schema_cache,
+            model=datatypes_model,
+        )
+
+    if multi_question:
+        question_units = group_questions(questions, max_questions_per_prompt)
+    else:
+        question_units = [[q] for q in questions]
+    unit_requests = [
+        _unit_request(
+            unit, multi_question=multi_question, structured_output=structured_output
+        )
+        for unit in question_units
+    ]
+
+    def iter_requests():
+        for i, doc in enumerate(_collect_documents(documents, document_description)):
+            requests = [
+                (
+                    make_custom_id(i, u),
+                    model,
+                    doc.to_gpt_messages(systemprompt=systemprompt),
+                    completion_options,
+                )
+                for u, (systemprompt, completion_options, _) in enumerate(unit_requests)
+            ]
+            yield doc.id, requests
+
+    job.metadata = {
+        "questions": [q.to_dict() for q in questions],
+        "units": [[q.key for q in unit] for unit in question_units],
+        "multi_question": multi_question,
+        "model": model,
+        "structured_output": (
+            None if structured_output is None else structured_output.to_dict()
+        ),
+    }
+    job.write_requests(iter_requests(), max_requests_per_file=max_requests_per_file)
+    return job
+
+
+def ingest_batch_job(job: BatchJob, *, sinks: Iterable[Any] = ()) -> ResultTable:
+    # Reads a finished job's output files back through the same answer
+    # parsing as the interactive engine. Cells with no usable result (failed
+    # requests, or batches that expired first) get their default values.
+    #
+    # Rows are written out, in input order, as soon as they're complete:
+    # when the last of their requests has been read, or at the latest once
+    # every shard holding one of their requests has been. Since a
+    # document's requests are written out together, only about a shard's
+    # worth of answers is ever held at once.
+    questions = [Question.create_from(q) for q in job.metadata["questions"]]
+    questions_by_key = {q.key: q for q in questions}
+    units = [[questions_by_key[key] for key in unit] for unit in job.metadata["units"]]
+
+    table = ResultTable()
+    sinks = [table] + list(sinks)
+    for sink in sinks:
+        sink.set_questions(questions)
+
+    docids = job.document_ids()
+    answers: Dict[int, Dict[str, Any]] = {}
+    results_read: Dict[int, int] = {}
+    next_row = 0
+
+    def write_rows(stop: Optional[int]):
+        # Writes out every row before `stop` (or every row left, if None).
+        nonlocal next_row
+        for docid in docids:
+            row = answers.pop(next_row, {})
+            results_read.pop(next_row, None)
+            for q in questions:
+                if q.key not in row:
+                    row[q.key] = q.defaultvalue
+            for sink in sinks:
+                sink.write_row(docid, row)
+            next_row += 1
+            if stop is not None and next_row >= stop:
+                return
+
+    requests_read = 0
+    for shard, results in job.iter_shard_results():
+        for custom_id, reply in results:
+            i, u = parse_custom_id(custom_id)
+            if i < next_row:
+                # A row that's already been written out.
+                continue
+            unit = units[u]
+            if job.metadata["multi_question"] and job.metadata.get("structured_output"):
+                replies = split_structured_multi_question_output(reply, unit)
+            elif job.metadata["multi_question"]:
+                replies = split_multi_question_output(gpt_output=reply, questions=unit)
+            else:
+                replies = {unit[0].key: reply}
+            row = answers.setdefault(i, {})
+            for q in unit:
+                if replies.get(q.key) is None and q.key in row:
+                    # Don't let a later error record clobber a good result.
+                    continue
+                row[q.key] = interpret_gpt_answer(q, replies.get(q.key))
+            results_read[i] = results_read.get(i, 0) + 1
+
+            while results_read.get(next_row, 0) >= len(units) > 0:
+                write_rows(next_row + 1)
+
+        # Every row whose requests all came before the end of this shard
+        # is as complete as it's going to get.
+        requests_read += shard["requests"]
+        if units and next_row < requests_read // len(units):
+            write_rows(requests_read // len(units))
+
+    write_rows(None)
+    for sink in sinks:
+        sink.flush()
+    return table
+
+
+def batch_text2table(
+    questions,
+    *,
+    documents,
+    directory: str,
+    openai_client: Union["openai.OpenAI", ClientPool, None] = None,
+    backend: Any = None,
+    poll_interval: float = 60.0,
+    timeout: Optional[float] = None,
+    sinks: Iterable[Any] = (),
+    **kwargs,
+) -> ResultTable:
+    # The offline counterpart of text2table: cheaper and with a much higher
+    # throughput ceiling, but results take hours rather than seconds. Runs
+    # the whole prepare/submit/wait/ingest cycle; because every step is
+    # recorded in `directory`, calling it again after an interruption picks
+    # up where it left off. Extra arguments go to prepare_batch_job.
+    if backend is None:
+        batch_client = openai_client
+        if isinstance(batch_client, ClientPool):
+            # Batches belong to one account, so they all go to the first
+            # endpoint; only the datatypes request uses the whole pool.
+            batch_client = batch_client.endpoints[0].client
+        backend = OpenAIBatchBackend(batch_client)
+    job = prepare_batch_job(
+        questions,
+        documents=documents,
+        directory=directory,
+        backend=backend,
+        openai_client=openai_client,
+        **kwargs,
+    )
+    job.submit()
+    job.wait(poll_interval=poll_interval, timeout=timeout)
+    return ingest_batch_job(job, sinks=sinks)
+
+
+def create_sharded_job(
+    questions,
+    *,
+    source: str,
+    queue: Union[str, WorkQueue],
+    output_dir: str,
+    openai_client: Union["openai.OpenAI", ClientPool, None] = None,
+    document_description: str = "",
+    shard_size: int = 1000,
+    cache: Optional[ResponseCache] = None,
+    refresh_cache: bool = False,
+    schema_cache: Optional[SchemaCache] = None,
+    datatypes_model: str = DATATYPES_MODEL,
+) -> WorkQueue:
+    # Sets up a job for run_shard_worker: works out the datatypes once, so
+    # that every worker uses the same schema, and splits the corpus into
+    # shards of shard_size documents. The corpus has to be a path that
+    # every worker can read (see document_source). Calling this again on a
+    # queue that already has shards leaves them alone.
+    if not isinstance(source, (str, os.PathLike)):
+        raise ValueError("A sharded job needs a corpus path every worker can open")
+    source = os.fspath(source)
+    if isinstance(queue, str):
+        queue = WorkQueue(queue)
+    if queue.get_meta("questions") is not None:
+        return queue
+
+    questions = Question.create_collection(questions=questions)
+    if openai_client is not None:
+        questions = determine_datatypes(
+            questions=questions,
+            document_description=document_description,
+            openai_client=openai_client,
+            cache=cache,
+            refresh_cache=refresh_cache,
+            schema_cache=schema_cache,
+            model=datatypes_model,
+        )
+
+    # One pass over the corpus finds where each shard starts, so that a
+    # worker can seek straight to its shard.
+    os.makedirs(output_dir, exist_ok=True)
+    shard_size = max(1, shard_size)
+    total = 0
+    offsets = []
+    for offset in iter_source_offsets(source):
+        if total % shard_size == 0:
+            offsets.append(offset)
+        total += 1
+    queue.set_meta("source", source)
+    queue.set_meta("document_description", document_description)
+    queue.set_meta("output_dir", os.path.abspath(output_dir))
+    queue.set_meta("questions", [q.to_dict() for q in questions])
+    queue.create_shards(total, shard_size=shard_size, offsets=offsets)
+    return queue
+
+
+def _run_shard(
+    queue: WorkQueue,
+    lease: Dict[str, Any],
+    questions: List[Question],
+    *,
+    worker_id: str,
+    lease_seconds: float,
+    openai_client: Union["openai.OpenAI", "openai.AsyncOpenAI", ClientPool],
+    options: ExtractionOptions,
+) -> bool:
+    output_dir = queue.get_meta("output_dir")
+    name = f"shard-{lease['shard']:06d}"
+
+    # The journal is shared by every worker that ever holds this shard, so
+    # a worker that picks up a crashed worker's shard doesn't re-ask the
+    # cells that were already answered.
+    journal = ExtractionJournal(os.path.join(output_dir, f"{name}.journal.jsonl"))
+
+    # Reading starts at the shard's offset, and positions are counted from
+    # its start, so that generated IDs match what a single-process run
+    # would produce. A shard without an offset has to be found by reading
+    # the corpus from the beginning.
+    if lease.get("offset") is not None:
+        offset, start = lease["offset"], lease["start"]
+    else:
+        offset, start = 0, 0
+    documents = itertools.islice(
+        iter_documents(
+            queue.get_meta("source"),
+            document_description=queue.get_meta("document_description"),
+            offset=offset,
+            start=start,
+        ),
+        lease["start"] - start,
+        lease["stop"] - start,
+    )
+
+    tmppath = os.path.join(output_dir, f"{name}.{worker_id}.tmp")
+    renewed = time.monotonic()
+    metrics = options.metrics
+    deduplicator = options.deduplicator
+    docids = []
+    try:
+        with open(tmppath, "w", encoding="utf-8") as f:
+            for docid, answers in iter_text2table(
+                questions=questions,
+                documents=documents,
+                openai_client=openai_client,
+                options=options.replace(journal=journal, resume=True),
+            ):
+                record = {"document_id": docid, "answers": answers}
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+                if deduplicator is not None:
+                    docids.append(docid)
+
+                if time.monotonic() - renewed > lease_seconds / 3:
+                    if not queue.renew(
+                        lease["shard"], worker_id, lease_seconds=lease_seconds
+                    ):
+                        # Presumed dead and replaced; leave it to the new
+                        # lease holder.
+                        return False
+                    renewed = time.monotonic()
+
+        # The output file only appears once it's complete. If a worker that
+        # lost its lease gets here too, it replaces the file with an equally
+        # complete copy, so it's harmless.
+        outpath = os.path.join(output_dir, f"{name}.jsonl")
+        os.replace(tmppath, outpath)
+        if metrics is not None:
+            with open(
+                os.path.join(output_dir, f"{name}.metrics.json"), "w", encoding="utf-8"
+            ) as f:
+                json.dump(metrics.summary(), f)
+        if deduplicator is not None:
+            deduplicator.export_clusters(
+                os.path.join(output_dir, f"{name}.clusters.jsonl"),
+                document_ids=docids,
+            )
+        return queue.complete(lease["shard"], worker_id, output=outpath)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+
+def run_shard_worker(
+    queue: Union[str, WorkQueue],
+    *,
+    openai_client: Union["openai.OpenAI", "openai.AsyncOpenAI", ClientPool],
+    worker_id: Optional[str] = None,
+    lease_seconds: float = 600.0,
+    idle_poll_seconds: float = 5.0,
+    options: Optional[ExtractionOptions] = None,
+    **changes,
+) -> int:
+    # Leases shards from a job made by create_sharded_job and runs each one
+    # through iter_text2table, until there's nothing left. Any number of
+    # these can run at once, in any number of processes or hosts, and they
+    # can come and go at will. The options (other than the journal, which
+    # each shard has its own of) go to iter_text2table. Returns the number
+    # of shards this worker finished.
+    options = ExtractionOptions.create(options, **changes)
+    if isinstance(queue, str):
+        queue = WorkQueue(queue)
+    worker_id = worker_id or make_worker_id()
+    questions = [Question.create_from(q) for q in queue.get_meta("questions")]
+
+    finished = 0
+    while True:
+        lease = queue.lease(worker_id, lease_seconds=lease_seconds)
+        if lease is None:
+            if queue.is_finished():
+                return finished
+            # Everything left is leased by somebody else. Hang around in
+            # case one of them dies and its lease runs out.
+            time.sleep(idle_poll_seconds)
+            continue
+
+        try:
+            if _run_shard(
+                queue,
+                lease,
+                questions,
+                worker_id=worker_id,
+                lease_seconds=lease_seconds,
+                openai_client=openai_client,
+                options=options,
+            ):
+                finished += 1
+        except BaseException:
+            queue.release(lease["shard"], worker_id)
+            raise
+
+
+def merge_shard_outputs(
+    queue: Union[str, WorkQueue], *, sinks: Iterable[Any] = ()
+) -> ResultTable:
+    # Combines the finished shards' outputs, in corpus order, into one
+    # ResultTable (and any extra sinks).
+    if isinstance(queue, str):
+        queue = WorkQueue(queue)
+    if not queue.is_finished():
+        raise ValueError(f"Sharded job in {queue.path} isn't finished yet")
+
+    questions = [Question.create_from(q) for q in queue.get_meta("questions")]
+    table = ResultTable()
+    sinks = [table] + list(sinks)
+    for sink in sinks:
+        sink.set_questions(questions)
+    for path in queue.outputs():
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                for sink in sinks:
+                    sink.write_row(record["document_id"], record["answers"])
+    for sink in sinks:
+        sink.flush()
+    return table
+
+
+# The ExtractionOptions fields that hold locks, connections or learned state,
+# and so can't be handed to another process. sharded_text2table sends each
+# worker their configs instead, and the worker builds its own.
+_PER_WORKER_OPTIONS = {
+    "cache": ResponseCache,
+    "schema_cache": SchemaCache,
+    "rate_limiter": RateLimiter,
+    "skip_predictor": SkipPredictor,
+    "deduplicator": Deduplicator,
+    "cascade": ModelCascade,
+    "metrics": Metrics,
+    "budget": Budget,
+    "timeout_policy": AdaptiveTimeouts,
+    "hedge_policy": HedgePolicy,
+}
+
+
+def _worker_option_configs(
+    options: ExtractionOptions, num_workers: int
+) -> Dict[str, Any]:
+    retval = {}
+    for name, value in options.changed().items():
+        if name in ("journal", "resume"):
+            raise ValueError(f"{name} is set per shard, and can't be passed in")
+        if value is None or name not in _PER_WORKER_OPTIONS:
+            retval[name] = value
+            continue
+        config = value.to_config()
+        if name == "rate_limiter":
+            # The account's limits are split evenly among the workers.
+            for k in ("requests_per_minute", "tokens_per_minute"):
+                if config[k]:
+                    config[k] /= num_workers
+        elif name == "budget":
+            # And so is the budget.
+            if config["max_tokens"] is not None:
+                config["max_tokens"] //= num_workers
+            if config["max_dollars"] is not None:
+                config["max_dollars"] /= num_workers
+        elif name == "deduplicator":
+            # A deduplicator's store can't be shared between processes (its
+            # writes hold SQLite's lock for long stretches), so each worker
+            # gets a temporary one of its own, and only finds duplicates
+            # among the documents it handles itself. Each shard's clusters
+            # are written next to its output, and merged at the end.
+            config["path"] = None
+            config["clusters_path"] = None
+        elif name == "hedge_policy" and value.latencies is options.timeout_policy:
+            # Shared with the timeouts; rebuilt as shared, too.
+            config["latencies"] = None
+        retval[name] = config
+    return retval
+
+
+def _build_worker_options(configs: Dict[str, Any]) -> Dict[str, Any]:
+    retval = dict(configs)
+    for name, config in configs.items():
+        if (
+            config is not None
+            and name in _PER_WORKER_OPTIONS
+            and name != "hedge_policy"
+        ):
+            retval[name] = _PER_WORKER_OPTIONS[name].from_config(config)
+    hedge_config = configs.get("hedge_policy")
+    if hedge_config is not None:
+        latencies = None
+        if hedge_config["latencies"] is None:
+            latencies = retval["timeout_policy"]
+        retval["hedge_policy"] = HedgePolicy.from_config(
+            hedge_config, latencies=latencies
+        )
+    return retval
+
+
+def _shard_worker_main(
+    queue_path: str, client_config: Dict[str, Any], option_configs: Dict[str, Any]
+):
+    import openai
+
+    if "pool" in client_config:
+        openai_client = ClientPool.from_config(client_config["pool"])
+    else:
+        openai_client = openai.OpenAI(**client_config)
+    options = ExtractionOptions(**_build_worker_options(option_configs))
+    try:
+        run_shard_worker(queue_path, openai_client=openai_client, options=options)
+    finally:
+        if options.deduplicator is not None:
+            options.deduplicator.close()
+
+
+def sharded_text2table(
+    questions,
+    *,
+    source: str,
+    queue_path: str,
+    output_dir: str,
+    openai_client: Union["openai.OpenAI", ClientPool],
+    num_workers: int = 4,
+    shard_size: int = 1000,
+    options: Optional[ExtractionOptions] = None,
+    **changes,
+) -> ResultTable:
+    # Runs a sharded job on this host with num_workers processes, each with
+    # its own event loop, and merges the results. Workers on other hosts
+    # can join the same job by calling run_shard_worker on the same queue.
+    # The options go to each worker's iter_text2table, except for the
+    # sinks, which get the merged results. Each worker builds its own copy
+    # of the ones that hold state (see
+    # _PER_WORKER_OPTIONS): rate limits and budgets are split evenly among
+    # the workers, metrics hooks are dropped (each shard's metrics summary
+    # is written next to its output instead), and deduplication only
+    # happens within a worker (the shards' clusters are gathered into the
+    # deduplicator's clusters_path, if it has one).
+    num_workers = max(1, num_workers)
+    options = ExtractionOptions.create(options, **changes)
+    # The description is stored with the job, and applied as the shards
+    # are read.
+    option_configs = _worker_option_configs(
+        options.replace(document_description="", sinks=()), num_workers
+    )
+    create_sharded_job(
+        questions,
+        source=source,
+        queue=queue_path,
+        output_dir=output_dir,
+        openai_client=openai_client,
+        document_description=options.document_description,
+        shard_size=shard_size,
+        cache=options.cache,
+        refresh_cache=options.refresh_cache,
+        schema_cache=options.schema_cache,
+        datatypes_model=options.datatypes_model,
+    )
+
+    # A client pool is rebuilt in each worker, so each has its own
+    # connections, health records and per-endpoint rate limits.
+    if isinstance(openai_client, ClientPool):
+        client_config = {"pool": openai_client.to_config()}
+    else:
+        client_config = {
+            "api_key": openai_client.api_key,
+            "organization": openai_client.organization,
+            "base_url": openai_client.base_url,
+            "max_retries": 0,
+        }
+    processes = [
+        multiprocessing.Process(
+            target=_shard_worker_main, args=(queue_path, client_config, option_configs)
+        )
+        for _ in range(num_workers)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    queue = WorkQueue(queue_path)
+    if not queue.is_finished():
+        raise RuntimeError(
+            f"Every worker exited but shards are left: {queue.progress()}"
+        )
+    deduplicator = options.deduplicator
+    if deduplicator is not None and deduplicator.clusters_path:
+        with open(deduplicator.clusters_path, "w", encoding="utf-8") as fout:
+            for path in queue.outputs():
+                clusters_path = path[: -len(".jsonl")] + ".clusters.jsonl"
+                if os.path.exists(clusters_path):
+                    with open(clusters_path, encoding="utf-8") as f:
+                        shutil.copyfileobj(f, fout)
+    return merge_shard_outputs(queue, sinks=options.sinks)
+
+
+#######################################################################################
+
+
+def create_client(
+    secrets_path: Optional[str] = None,
+) -> Union["openai.OpenAI", ClientPool]:
+    # Builds a client from a secrets file: a JSON object with OPENAI_API_KEY
+    # (and optionally OPENAI_ORGANIZATION), or with OPENAI_ENDPOINTS, a list
+    # of the arguments of client_pool.PoolEndpoint for several accounts or
+    # servers to spread the load over. Without a secrets file, the client
+    # reads OPENAI_API_KEY and friends from the environment.
+    #
+    # The client is built with max_retries=0: the send functions do their
+    # own retrying, with the rate limiter's pauses, Retry-After and backoff,
+    # and they'd never see a 429 or a 5xx that the client had retried
+    # away by itself.
+    import openai
+
+    if not secrets_path:
+        return openai.OpenAI(max_retries=0)
+    with open(secrets_path, encoding="utf-8") as f:
+        secrets = json.load(f)
+    if secrets.get("OPENAI_ENDPOINTS"):
+        return ClientPool(secrets["OPENAI_ENDPOINTS"])
+    return openai.OpenAI(
+        api_key=secrets["OPENAI_API_KEY"],
+        organization=secrets.get("OPENAI_ORGANIZATION"),
+        max_retries=0,
+    )
+
+
+def read_questions(path: str):
+    # A .json file holds anything Question.create_collection takes: an
+    # object mapping keys to question text (or to question dicts, as in a
+    # schema written out by Question.to_dict), or a list of question dicts.
+    # Any other file has one "key: question text" per line.
+    with open(path, encoding="utf-8") as f:
+        if path.lower().endswith(".json"):
+            return json.load(f)
+        questions = {}
+        for line in f:
+            if not line.strip():
+                continue
+            if ":" not in line:
+                raise ValueError(f'{path}: expected "key: question", got {line!r}')
+            key, text = line.split(":", 1)
+            questions[key.strip()] = text.strip()
+        return questions
+
+
+def _create_table_writer(path: str):
+    # The engine tells the writer its columns once the datatypes are known.
+    lowerpath = path.lower()
+    if lowerpath.endswith(".csv"):
+        return CsvTableWriter(path)
+    elif lowerpath.endswith(".parquet"):
+        return ParquetTableWriter(path)
+    elif lowerpath.endswith((".arrow", ".feather", ".ipc")):
+        return ArrowIpcTableWriter(path)
+    raise ValueError(f"Don't know how to write a table to {path}")
+
+
+def main(argv: Optional[List[str]] = None):
+    # python -m text2table --questions questions.json --documents corpus.jsonl
+    #
+    # Rows are written as JSON lines to stdout, or with --output, to a CSV,
+    # Parquet or Arrow file.
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="text2table",
+        description="Turn freeform documents into a table of answers to questions.",
+    )
+    parser.add_argument(
+        "--questions",
+        help='a .json file of questions (or a schema), or a text file of "key: question" lines',
+    )
+    parser.add_argument(
+        "--documents",
+        help="a .json array, .jsonl file, .txt dump of blank-line-separated documents, corpus store, directory or glob of documents",
+    )
+    parser.add_argument("--document-description", default="")
+    parser.add_argument(
+        "--sample", action="store_true", help="run the built-in Santa letter example"
+    )
+    parser.add_argument(
+        "--output", help="write the table to a .csv, .parquet or .arrow file"
+    )
+    parser.add_argument(
+        "--secrets",
+        help="JSON file with OPENAI_API_KEY or OPENAI_ENDPOINTS (default: secrets.json if it exists, else the environment)",
+    )
+    parser.add_argument(
+        "--models",
+        help="comma-separated models to cascade through, cheapest first (default: %s)"
+        % DEFAULT_MODEL,
+    )
+    parser.add_argument("--datatypes-model", default=DATATYPES_MODEL)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--multi-question", action="store_true")
+    parser.add_argument("--max-questions-per-prompt", type=int, default=8)
+    parser.add_argument("--max-chunk-tokens", type=int)
+    parser.add_argument("--early-stop", action="store_true")
+    parser.add_argument(
+        "--answer-format",
+        choices=["markdown", "json_schema", "json_object", "function"],
+        default="markdown",
+    )
+    parser.add_argument(
+        "--reasoning", choices=["none", "brief", "full"], default="brief"
+    )
+    parser.add_argument("--cache", help="SQLite response cache to reuse replies from")
+    parser.add_argument("--schema", help="schema cache file for inferred datatypes")
+    parser.add_argument("--journal", help="journal file to record finished cells in")
+    parser.add_argument(
+        "--resume", action="store_true", help="skip cells already in the journal"
+    )
+    parser.add_argument(
+        "--max-dollars", type=float, help="stop starting new documents past this spend"
+    )
+    parser.add_argument(
+        "--dedup",
+        metavar="CLUSTERS",
+        help="ask only one document of each cluster of duplicates, and write each document's representative to this .jsonl file",
+    )
+    parser.add_argument("--adaptive-timeouts", action="store_true")
+    parser.add_argument("--hedge-percentile", type=float)
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="estimate the job's calls, tokens, cost and runtime without running it",
+    )
+    args = parser.parse_args(argv)
+
+    if args.sample:
+        questions = sample_questions
+        documents = sample_input
+        document_description = args.document_description or sample_description
+    elif args.questions and args.documents:
+        questions = read_questions(args.questions)
+        documents = iter_documents(
+            args.documents, document_description=args.document_description
+        )
+        document_description = args.document_description
+    else:
+        parser.error("either --sample, or both --questions and --documents, are needed")
+
+    cascade = None
+    if args.models:
+        cascade = ModelCascade([m.strip() for m in args.models.split(",") if m.strip()])
+    structured_output = None
+    if args.answer_format != "markdown":
+        structured_output = StructuredOutput(
+            mode=args.answer_format, reasoning=args.reasoning
+        )
+    schema_cache = SchemaCache(args.schema) if args.schema else None
+
+    if args.plan:
+        plan = plan_text2table(
+            questions,
+            documents=documents,
+            document_description=document_description,
+            multi_question=args.multi_question,
+            max_questions_per_prompt=args.max_questions_per_prompt,
+            max_chunk_tokens=args.max_chunk_tokens,
+            cascade=cascade,
+            schema_cache=schema_cache,
+            datatypes_model=args.datatypes_model,
+            max_concurrency=args.concurrency,
+            structured_output=structured_output,
+        )
+        print(plan.format())
+        return
+
+    secrets_path = args.secrets
+    if secrets_path is None and os.path.exists("secrets.json"):
+        secrets_path = "secrets.json"
+    openai_client = create_client(secrets_path)
+
+    timeout_policy = AdaptiveTimeouts() if args.adaptive_timeouts else None
+    hedge_policy = None
+    if args.hedge_percentile is not None:
+        hedge_policy = HedgePolicy(
+            hedge_percentile=args.hedge_percentile, latencies=timeout_policy
+        )
+    budget = Budget(max_dollars=args.max_dollars) if args.max_dollars else None
+
+    writer = _create_table_writer(args.output) if args.output else None
+    options = ExtractionOptions(
+        document_description=document_description,
+        max_concurrency=args.concurrency,
+        multi_question=args.multi_question,
+        max_questions_per_prompt=args.max_questions_per_prompt,
+        max_chunk_tokens=args.max_chunk_tokens,
+        early_stop=args.early_stop,
+        cascade=cascade,
+        datatypes_model=args.datatypes_model,
+        cache=ResponseCache(args.cache) if args.cache else None,
+        schema_cache=schema_cache,
+        journal=ExtractionJournal(args.journal) if args.journal else None,
+        resume=args.resume,
+        sinks=[writer] if writer is not None else [],
+        budget=budget,
+        timeout_policy=timeout_policy,
+        hedge_policy=hedge_policy,
+        structured_output=structured_output,
+        deduplicator=Deduplicator(clusters_path=args.dedup) if args.dedup else None,
+    )
+    rows = iter_text2table(
+        questions=questions,
+        documents=documents,
+        openai_client=openai_client,
+        options=options,
+    )
+    try:
+        for docid, answers in rows:
+            if writer is None:
+                record = {"document_id": docid, "answers": answers}
+                print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
+    finally:
+        if writer is not None:
+            writer.close()
@@ -0,0 +1,290 @@
+import array
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from .document import GENERATED_ID_WIDTH, Document
+
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Union
+
+# A compact, read-only store for corpora too big to hold as Document objects.
+# Every body lives in one contiguous UTF-8 buffer, and so does every ID; a
+# document is just its position, and the offset tables say where its bytes
+# start and end. Descriptions, which are nearly always one string shared by
+# the whole corpus, are kept once each in a small table, with a per-document
+# index into it only if there's more than one.
+#
+# The store is a single file, memory-mapped, so the offset tables are read
+# straight out of the page cache rather than copied into Python objects,
+# opening a store takes no time at all whatever its size, and every process
+# that opens the same file shares one copy. Indexing, slicing and iterating
+# a Corpus all hand out DocumentViews, which hold nothing but a reference to
+# the corpus and a position; a document's text is only decoded when it's
+# asked for, and a full Document is only built when a prompt is.
+#
+# The file is laid out as: bodies, IDs, body offsets, ID offsets, then
+# (optionally) description indices, each section padded to 8 bytes, and
+# finally a JSON trailer, its length, and MAGIC. Offsets are stored in the
+# machine's native byte order, so a store isn't portable between big- and
+# little-endian machines.
+
+MAGIC = b"T2TCORP1"
+
+# What document_source expects a store's filename to end with.
+CORPUS_SUFFIX = ".t2tcorpus"
+
+_TRAILER_LENGTH = struct.Struct("<Q")
+
+
+def _pad(f: BinaryIO):
+    # Pads the file out to a multiple of 8 bytes, so that the offset tables
+    # that follow are aligned.
+    f.write(b"\0" * (-f.tell() % 8))
+
+
+class DocumentView(Document):
+    # A document in a Corpus. Reads like a Document (and is one, as far as
+    # isinstance is concerned), but its fields are fetched from the corpus
+    # on demand and can't be changed.
+    __slots__ = ("corpus", "index")
+
+    def __init__(self, corpus: "Corpus", index: int):
+        self.corpus = corpus
+        self.index = index
+
+    @property
+    def id(self) -> str:
+        return self.corpus._id(self.index)
+
+    @property
+    def description(self) -> str:
+        return self.corpus._description(self.index)
+
+    @property
+    def body(self) -> str:
+        return self.corpus._body(self.index)
+
+    def materialize(self) -> Document:
+        return Document(id=self.id, description=self.description, body=self.body)
+
+    def to_gpt_messages(self, systemprompt: str = ""):
+        return self.materialize().to_gpt_messages(systemprompt=systemprompt)
+
+    def __repr__(self):
+        return f"DocumentView({self.corpus.path!r}, {self.index})"
+
+
+class Corpus:
+    def __init__(self, source: Union[str, BinaryIO]):
+        # Opens a store written by Corpus.build, from its path or from an
+        # open binary file (which the Corpus then owns).
+        if isinstance(source, (str, os.PathLike)):
+            self.path = os.fspath(source)
+            self._file = open(self.path, "rb")
+        else:
+            self.path = getattr(source, "name", None)
+            self._file = source
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+
+        if bytes(buf[-len(MAGIC) :]) != MAGIC:
+            raise ValueError(f"{self.path} isn't a corpus store")
+        end = len(buf) - len(MAGIC) - _TRAILER_LENGTH.size
+        (trailer_length,) = _TRAILER_LENGTH.unpack(
+            buf[end : end + _TRAILER_LENGTH.size]
+        )
+        trailer = json.loads(bytes(buf[end - trailer_length : end]))
+
+        count = trailer["count"]
+        self.count = count
+        self.id_width = trailer["id_width"]
+        self._bodies = buf[: trailer["ids_start"]]
+        self._ids = buf[trailer["ids_start"] : trailer["body_offsets_start"]]
+
+        def table(start: int, length: int, typecode: str) -> memoryview:
+            size = struct.calcsize(typecode)
+            return buf[start : start + length * size].cast(typecode)
+
+        self._body_offsets = table(trailer["body_offsets_start"], count + 1, "q")
+        self._id_offsets = table(trailer["id_offsets_start"], count + 1, "q")
+        self._description_indices = None
+        if trailer["description_indices_start"] is not None:
+            self._description_indices = table(
+                trailer["description_indices_start"], count, "I"
+            )
+        self.descriptions: List[str] = [sys.intern(d) for d in trailer["descriptions"]]
+        self._description_override: Optional[str] = None
+
+        # The positions (in the whole store) that this Corpus covers. Slicing
+        # makes a new Corpus over the same buffers with a narrower range.
+        self._positions = range(count)
+
+    @staticmethod
+    def build(
+        documents: Iterable[Any],
+        *,
+        path: Optional[str] = None,
+        document_description: str = "",
+    ) -> "Corpus":
+        # Writes documents (anything Document.create_from accepts, read one
+        # at a time) into a store and opens it. Without a path, the store is
+        # an anonymous temporary file that goes away when the Corpus is
+        # closed. Documents without an ID get the same generated IDs that
+        # Document.create_collection would give them, and
+        # document_description, if given, replaces every document's own.
+        if isinstance(documents, dict):
+            documents = documents.items()
+        elif isinstance(documents, (str, Document)):
+            documents = [documents]
+
+        if path is None:
+            f = tempfile.TemporaryFile()
+        else:
+            # Written under a temporary name and renamed into place, so a
+            # store that exists is always complete.
+            dirname = os.path.dirname(os.path.abspath(path))
+            fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            f = os.fdopen(fd, "w+b")
+
+        try:
+            with tempfile.TemporaryFile() as idfile:
+                body_offsets = array.array("q", [0])
+                id_offsets = array.array("q", [0])
+                description_indices = array.array("I")
+                descriptions: Dict[str, int] = {}
+                body_end = 0
+                id_end = 0
+
+                for x in documents:
+                    doc = Document.create_from(x)
+                    body = doc.body.encode("utf-8")
+                    f.write(body)
+                    body_end += len(body)
+                    body_offsets.append(body_end)
+
+                    # An empty ID means "generate one", as it does for
+                    # create_collection.
+                    docid = f"{doc.id}".encode("utf-8") if doc.id else b""
+                    idfile.write(docid)
+                    id_end += len(docid)
+                    id_offsets.append(id_end)
+
+                    description = document_description or doc.description
+                    if description not in descriptions:
+                        descriptions[description] = len(descriptions)
+                    description_indices.append(descriptions[description])
+
+                _pad(f)
+                ids_start = f.tell()
+                idfile.seek(0)
+                shutil.copyfileobj(idfile, f)
+
+            count = len(body_offsets) - 1
+            _pad(f)
+            body_offsets_start = f.tell()
+            body_offsets.tofile(f)
+            id_offsets_start = f.tell()
+            id_offsets.tofile(f)
+            description_indices_start = None
+            if len(descriptions) > 1:
+                _pad(f)
+                description_indices_start = f.tell()
+                description_indices.tofile(f)
+
+            trailer = json.dumps(
+                {
+                    "count": count,
+                    "id_width": GENERATED_ID_WIDTH,
+                    "ids_start": ids_start,
+                    "body_offsets_start": body_offsets_start,
+                    "id_offsets_start": id_offsets_start,
+                    "description_indices_start": description_indices_start,
+                    "descriptions": list(descriptions) or [""],
+                },
+                ensure_ascii=False,
+            ).encode("utf-8")
+            f.write(trailer)
+            f.write(_TRAILER_LENGTH.pack(len(trailer)))
+            f.write(MAGIC)
+            f.flush()
+
+            if path is None:
+                f.seek(0)
+                return Corpus(f)
+            f.close()
+            os.replace(tmppath, path)
+            return Corpus(path)
+        except BaseException:
+            f.close()
+            if path is not None and os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def _id(self, i: int) -> str:
+        start = self._id_offsets[i]
+        stop = self._id_offsets[i + 1]
+        if start == stop:
+            return f"document_{f'{i + 1}'.rjust(self.id_width, '0')}"
+        return str(self._ids[start:stop], "utf-8")
+
+    def _description(self, i: int) -> str:
+        if self._description_override is not None:
+            return self._description_override
+        if self._description_indices is None:
+            return self.descriptions[0]
+        return self.descriptions[self._description_indices[i]]
+
+    def _body(self, i: int) -> str:
+        return str(
+            self._bodies[self._body_offsets[i] : self._body_offsets[i + 1]], "utf-8"
+        )
+
+    def _view(self, positions: range) -> "Corpus":
+        # A Corpus over some of this one's documents, sharing its buffers.
+        retval = Corpus.__new__(Corpus)
+        retval.__dict__.update(self.__dict__)
+        retval._positions = positions
+        return retval
+
+    def with_description(self, document_description: str) -> "Corpus":
+        # The same documents, all with the given description.
+        retval = self._view(self._positions)
+        retval._description_override = sys.intern(document_description)
+        return retval
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[DocumentView, "Corpus"]:
+        if isinstance(key, slice):
+            return self._view(self._positions[key])
+        return DocumentView(self, self._positions[key])
+
+    def __iter__(self) -> Iterator[DocumentView]:
+        for i in self._positions:
+            yield DocumentView(self, i)
+
+    @property
+    def nbytes(self) -> int:
+        # The size of the whole store, most of which is only ever in the
+        # page cache rather than in this process's own memory.
+        return len(self._mmap)
+
+    def close(self):
+        # Views handed out earlier can't be read after this.
+        for name in ("_bodies", "_ids", "_body_offsets", "_id_offsets"):
+            getattr(self, name).release()
+        if self._description_indices is not None:
+            self._description_indices.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
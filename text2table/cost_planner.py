@@ -0,0 +1,463 @@
+import hashlib
+import importlib.util
+import math
+import multiprocessing
+import os
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+from .chunking import count_tokens
+from .instrumentation import DEFAULT_PRICES, CallRecord
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Pre-flight planning and budget enforcement. TokenCounter counts tokens
+# locally (exactly with tiktoken, roughly without it), caching the counts
+# and spreading big batches over several processes. JobPlan holds the
+# projected size of a run, which text2table.plan_text2table works out
+# without making a single request. Budget caps what a live run may spend.
+
+# Every chat message costs a few tokens of framing on top of its content,
+# and every request a few more to prime the reply.
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REQUEST = 3
+
+# A typical RELEVANCE/AVAILABILITY/DISCUSSION/ANSWER reply to one question.
+DEFAULT_OUTPUT_TOKENS_PER_QUESTION = 300
+
+
+def model_prices(
+    prices: Dict[str, Tuple[float, float]], model: str
+) -> Tuple[float, float]:
+    # A model's (prompt, output) prices, in dollars per million tokens. A
+    # model that isn't in the table is an error rather than free, since a
+    # plan that came to $0 or a dollar cap that was never enforced would be
+    # worse than useless.
+    if model not in prices:
+        raise ValueError(
+            f"No price known for model {model!r}; pass its (prompt, output)"
+            " dollars per million tokens in prices"
+        )
+    return prices[model]
+
+
+def _count_batch(texts: List[str]) -> List[int]:
+    # Runs in the pool's worker processes.
+    return [count_tokens(text) for text in texts]
+
+
+def has_exact_tokenizer() -> bool:
+    return importlib.util.find_spec("tiktoken") is not None
+
+
+class TokenCounter:
+    # Counts are cached twice over: short strings that recur (system
+    # prompts, description lines) in a small in-memory LRU, and document
+    # bodies, if `path` is given, in a SQLite file keyed by a digest of the
+    # text, so that planning the same corpus again only tokenizes what
+    # changed. Batches are split across `processes` worker processes, but
+    # only when tiktoken is installed; the fallback estimate is cheaper to
+    # compute than to ship to another process.
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        processes: Optional[int] = None,
+        min_parallel_batch: int = 256,
+        memory_entries: int = 4096,
+    ):
+        self.path = path
+        self.exact = has_exact_tokenizer()
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.processes = processes if self.exact else 1
+        self.min_parallel_batch = min_parallel_batch
+        self.memory_entries = memory_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._memory: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS counts"
+                " (digest BLOB PRIMARY KEY, tokens INTEGER NOT NULL)"
+            )
+            self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def digest(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def count(self, text: str) -> int:
+        with self._lock:
+            tokens = self._memory.get(text)
+            if tokens is not None:
+                self._memory.move_to_end(text)
+                self.hits += 1
+                return tokens
+        tokens = count_tokens(text)
+        with self._lock:
+            self.misses += 1
+            self._memory[text] = tokens
+            if len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+        return tokens
+
+    def _lookup(self, digests: List[bytes]) -> Dict[bytes, int]:
+        retval = {}
+        # Stays well under SQLite's limit on bound parameters.
+        for start in range(0, len(digests), 500):
+            part = digests[start : start + 500]
+            placeholders = ",".join("?" * len(part))
+            retval.update(
+                self._conn.execute(
+                    f"SELECT digest, tokens FROM counts WHERE digest IN ({placeholders})",
+                    part,
+                ).fetchall()
+            )
+        return retval
+
+    def _tokenize(self, texts: List[str]) -> List[int]:
+        if self.processes <= 1 or len(texts) < self.min_parallel_batch:
+            return _count_batch(texts)
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes)
+        size = math.ceil(len(texts) / (self.processes * 4))
+        parts = [texts[i : i + size] for i in range(0, len(texts), size)]
+        retval = []
+        for counts in self._pool.map(_count_batch, parts):
+            retval.extend(counts)
+        return retval
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        # Counts a list of (typically long, typically distinct) texts, in
+        # order. Callers planning a big corpus should hand these over a few
+        # thousand at a time, so that the worker processes stay busy.
+        if self._conn is None:
+            self.misses += len(texts)
+            return self._tokenize(texts)
+
+        digests = [TokenCounter.digest(text) for text in texts]
+        known = self._lookup(digests)
+        missing = [i for i, d in enumerate(digests) if d not in known]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            counts = self._tokenize([texts[i] for i in missing])
+            new = {digests[i]: tokens for i, tokens in zip(missing, counts)}
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO counts VALUES (?, ?)", new.items()
+                )
+            known.update(new)
+        return [known[d] for d in digests]
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def message_tokens(contents: Iterable[int]) -> int:
+    # The size of a request whose messages have the given content sizes.
+    return TOKENS_PER_REQUEST + sum(TOKENS_PER_MESSAGE + n for n in contents)
+
+
+def chunk_layout(
+    body_tokens: int, *, max_tokens: Optional[int], overlap_tokens: int
+) -> Tuple[int, int]:
+    # Returns (number of chunks, total body tokens over all the chunks) for
+    # a document that chunking.split_into_chunks would split. Overlaps get
+    # sent twice, so the total is more than the body itself.
+    if not max_tokens or body_tokens <= max_tokens:
+        return 1, body_tokens
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    step = max(1, max_tokens - overlap_tokens)
+    chunks = max(1, math.ceil((body_tokens - overlap_tokens) / step))
+    return chunks, body_tokens + (chunks - 1) * overlap_tokens
+
+
+class JobPlan:
+    # The projected size of a run, accumulated cell by cell. Token counts
+    # cover the cells only; the datatype inference call (if there'll be
+    # one) is kept separately, since it goes to a different model.
+
+    def __init__(
+        self,
+        *,
+        models: Iterable[str],
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        self.models = list(models)
+        self.prices = dict(DEFAULT_PRICES)
+        self.prices.update(prices or {})
+        for model in self.models:
+            model_prices(self.prices, model)
+
+        self.documents = 0
+        self.chunked_documents = 0
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.max_prompt_tokens = 0
+        self.columns: Dict[str, Dict[str, float]] = {}
+
+        self.datatypes_model: Optional[str] = None
+        self.datatypes_prompt_tokens = 0
+        self.datatypes_output_tokens = 0
+
+        self.runtime_seconds: Optional[float] = None
+        self.bottleneck: Optional[str] = None
+        self.exact = False
+
+    def add_calls(
+        self,
+        question_keys: List[str],
+        *,
+        calls: int,
+        prompt_tokens: int,
+        output_tokens: int,
+        largest_prompt: int,
+    ):
+        self.calls += calls
+        self.prompt_tokens += prompt_tokens
+        self.output_tokens += output_tokens
+        self.max_prompt_tokens = max(self.max_prompt_tokens, largest_prompt)
+
+        # As in Metrics, a multi-question call is split evenly among the
+        # questions it asks.
+        share = 1.0 / len(question_keys)
+        for key in question_keys:
+            column = self.columns.setdefault(
+                key, {"calls": 0, "prompt_tokens": 0.0, "output_tokens": 0.0}
+            )
+            column["calls"] += calls
+            column["prompt_tokens"] += prompt_tokens * share
+            column["output_tokens"] += output_tokens * share
+
+    def price(self, model: str, prompt_tokens: float, output_tokens: float) -> float:
+        prompt_price, output_price = model_prices(self.prices, model)
+        return (prompt_tokens * prompt_price + output_tokens * output_price) / 1e6
+
+    def datatypes_cost(self) -> float:
+        if self.datatypes_model is None:
+            return 0.0
+        return self.price(
+            self.datatypes_model,
+            self.datatypes_prompt_tokens,
+            self.datatypes_output_tokens,
+        )
+
+    def cost(self, model: str) -> float:
+        # What the whole run would cost if every cell went to `model`.
+        return (
+            self.price(model, self.prompt_tokens, self.output_tokens)
+            + self.datatypes_cost()
+        )
+
+    def estimate_runtime(
+        self,
+        *,
+        max_concurrency: int,
+        expected_latency: float,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        # The run can go no faster than the slowest of: the concurrency cap
+        # (each call holds a slot for about expected_latency seconds), and
+        # each of the rate limits. Retries and throttling only add to this.
+        bounds = {
+            "concurrency": self.calls * expected_latency / max(1, max_concurrency)
+        }
+        if requests_per_minute:
+            bounds["requests_per_minute"] = 60.0 * self.calls / requests_per_minute
+        if tokens_per_minute:
+            tokens = self.prompt_tokens + self.output_tokens
+            bounds["tokens_per_minute"] = 60.0 * tokens / tokens_per_minute
+        self.bottleneck = max(bounds, key=bounds.get)
+        self.runtime_seconds = bounds[self.bottleneck]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "documents": self.documents,
+            "chunked_documents": self.chunked_documents,
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "exact_token_counts": self.exact,
+            "datatypes": {
+                "model": self.datatypes_model,
+                "prompt_tokens": self.datatypes_prompt_tokens,
+                "output_tokens": self.datatypes_output_tokens,
+                "cost": self.datatypes_cost(),
+            },
+            "costs": {model: self.cost(model) for model in self.models},
+            "columns": {
+                key: dict(
+                    column,
+                    costs={
+                        model: self.price(
+                            model, column["prompt_tokens"], column["output_tokens"]
+                        )
+                        for model in self.models
+                    },
+                )
+                for key, column in self.columns.items()
+            },
+            "runtime_seconds": self.runtime_seconds,
+            "bottleneck": self.bottleneck,
+        }
+
+    def format(self) -> str:
+        lines = [
+            f"documents:        {self.documents}"
+            f" ({self.chunked_documents} split into chunks)",
+            f"calls:            {self.calls}",
+            f"prompt tokens:    {self.prompt_tokens}"
+            + ("" if self.exact else " (estimated; install tiktoken for exact)"),
+            f"output tokens:    {self.output_tokens} (estimated)",
+            f"largest prompt:   {self.max_prompt_tokens}",
+        ]
+        if self.runtime_seconds is not None:
+            lines.append(
+                f"runtime:          {self.runtime_seconds / 60:.1f} min"
+                f" (bound by {self.bottleneck})"
+            )
+        for model in self.models:
+            lines.append(f"cost, {model}: ${self.cost(model):,.2f}")
+        return "\n".join(lines)
+
+
+class Budget:
+    # A hard cap on what a run may spend, in tokens, dollars, or both. The
+    # engine reserves a document's projected cost before it starts on the
+    # document, and stops taking on new documents once a reservation won't
+    # fit; documents already under way are finished. Actual spending comes
+    # in through on_call, as a Metrics hook. Since reservations are released
+    # as rows finish, spent plus reserved stays under the cap, give or take
+    # how far the real calls stray from the projections.
+    #
+    # Calls are charged the usage their responses report (streamed calls
+    # report it too, even early-stopped ones, whose usage is counted
+    # locally), at the budget's own prices. A call that got no response
+    # isn't charged at all. With max_dollars, every model the run uses has
+    # to have a price; check_prices says which one doesn't, before the run
+    # starts.
+
+    def __init__(
+        self,
+        *,
+        max_tokens: Optional[int] = None,
+        max_dollars: Optional[float] = None,
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+        expected_output_tokens: int = DEFAULT_OUTPUT_TOKENS_PER_QUESTION,
+    ):
+        if max_tokens is None and max_dollars is None:
+            raise ValueError("A budget needs max_tokens, max_dollars, or both")
+        self.max_tokens = max_tokens
+        self.max_dollars = max_dollars
+        self.prices = dict(DEFAULT_PRICES)
+        self.prices.update(prices or {})
+        self.expected_output_tokens = expected_output_tokens
+
+        self.spent_tokens = 0
+        self.spent_dollars = 0.0
+        self.reserved_tokens = 0
+        self.reserved_dollars = 0.0
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "Budget":
+        return Budget(**config)
+
+    def to_config(self) -> Dict[str, Any]:
+        # What's been spent so far isn't included.
+        return {
+            "max_tokens": self.max_tokens,
+            "max_dollars": self.max_dollars,
+            "prices": dict(self.prices),
+            "expected_output_tokens": self.expected_output_tokens,
+        }
+
+    def check_prices(self, models: Iterable[str]):
+        if self.max_dollars is not None:
+            for model in models:
+                model_prices(self.prices, model)
+
+    def price(self, model: str, prompt_tokens: int, output_tokens: int) -> float:
+        # Without a cap on dollars, nothing needs a price.
+        if self.max_dollars is None:
+            return 0.0
+        prompt_price, output_price = model_prices(self.prices, model)
+        return (prompt_tokens * prompt_price + output_tokens * output_price) / 1e6
+
+    def _fits(self, tokens: int, dollars: float) -> bool:
+        if self.max_tokens is not None:
+            if self.spent_tokens + self.reserved_tokens + tokens > self.max_tokens:
+                return False
+        if self.max_dollars is not None:
+            if self.spent_dollars + self.reserved_dollars + dollars > self.max_dollars:
+                return False
+        return True
+
+    def reserve(self, tokens: int, dollars: float) -> bool:
+        # Returns False, and marks the budget exhausted, if the reservation
+        # would take the run over the cap.
+        with self._lock:
+            if self.exhausted or not self._fits(tokens, dollars):
+                self.exhausted = True
+                return False
+            self.reserved_tokens += tokens
+            self.reserved_dollars += dollars
+            return True
+
+    def release(self, tokens: int, dollars: float):
+        with self._lock:
+            self.reserved_tokens = max(0, self.reserved_tokens - tokens)
+            self.reserved_dollars = max(0.0, self.reserved_dollars - dollars)
+
+    def charge(self, tokens: int, dollars: float):
+        with self._lock:
+            self.spent_tokens += tokens
+            self.spent_dollars += dollars
+
+    def on_call(self, record: CallRecord):
+        if record.cache_hit or not (record.prompt_tokens or record.completion_tokens):
+            return
+        self.charge(
+            record.prompt_tokens + record.completion_tokens,
+            self.price(record.model, record.prompt_tokens, record.completion_tokens),
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_tokens": self.max_tokens,
+                "max_dollars": self.max_dollars,
+                "spent_tokens": self.spent_tokens,
+                "spent_dollars": self.spent_dollars,
+                "reserved_tokens": self.reserved_tokens,
+                "reserved_dollars": self.reserved_dollars,
+                "exhausted": self.exhausted,
+            }
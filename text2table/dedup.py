@@ -0,0 +1,334 @@
+import array
+import hashlib
+import json
+import os
+import pickle
+import random
+import re
+import sqlite3
+import tempfile
+import zlib
+
+from .document import Document
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_body(text: str) -> str:
+    # Case, punctuation and whitespace differences don't make two documents
+    # different for extraction purposes.
+    text = re.sub(r"[^\w\s]", " ", f"{text}".lower())
+    return " ".join(text.split())
+
+
+def choose_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    # LSH with b bands of r rows each makes two documents candidates with
+    # probability 1 - (1 - s^r)^b at Jaccard similarity s, an S-curve whose
+    # midpoint is about (1/b)^(1/r). We pick the split that puts the midpoint
+    # closest to (but not above) the threshold, so near-duplicates right at
+    # the threshold are still likely to collide.
+    best = (num_perm, 1)
+    best_error = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        midpoint = (1.0 / bands) ** (1.0 / rows)
+        error = threshold - midpoint
+        if error < 0:
+            continue
+        if best_error is None or error < best_error:
+            best = (bands, rows)
+            best_error = error
+    return best
+
+
+class Deduplicator:
+    # Groups documents into clusters of exact duplicates (same normalized
+    # body) and near-duplicates (estimated Jaccard similarity of word
+    # shingles above a threshold, found with MinHash and LSH banding). The
+    # first document of each cluster is its representative; only
+    # representatives get sent to the model, and their answers are copied to
+    # the other members.
+    #
+    # Everything is kept in SQLite rather than in Python dicts, so memory
+    # use stays bounded however many documents go through. With no path, a
+    # temporary file is used and removed on close(). Documents are known by
+    # their IDs, so a store at a path can be carried over from an
+    # interrupted run to the one that resumes it: a document seen before
+    # (with the same body) lands in the cluster it was put in last time.
+    #
+    # With a clusters_path, the engine writes the clusters there (as
+    # export_clusters does) at the end of every run, so the mapping from
+    # each document to its representative comes out alongside the table.
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        threshold: float = 0.85,
+        near_duplicates: bool = True,
+        num_perm: int = 64,
+        shingle_size: int = 5,
+        seed: int = 1,
+        commit_every: int = 1000,
+        clusters_path: Optional[str] = None,
+    ):
+        self.threshold = threshold
+        self.near_duplicates = near_duplicates
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.commit_every = commit_every
+        self.clusters_path = clusters_path
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+
+        rng = random.Random(seed)
+        self._perms = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+        self._temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".dedup.sqlite3")
+            os.close(fd)
+        self.path = path
+
+        self.exact_duplicates = 0
+        self.near_duplicate_count = 0
+        self.representatives = 0
+        self._uncommitted = 0
+
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS exact (hash BLOB PRIMARY KEY, rep TEXT);"
+            "CREATE TABLE IF NOT EXISTS bands ("
+            " band INTEGER, bucket INTEGER, rep TEXT);"
+            "CREATE INDEX IF NOT EXISTS bands_lookup ON bands (band, bucket);"
+            "CREATE TABLE IF NOT EXISTS reps ("
+            " rep TEXT PRIMARY KEY, signature BLOB, answers BLOB);"
+            "CREATE TABLE IF NOT EXISTS members ("
+            " document_id TEXT PRIMARY KEY, hash BLOB, rep TEXT, kind TEXT);"
+        )
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "Deduplicator":
+        config = dict(config)
+        return Deduplicator(config.pop("path"), **config)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "path": None if self._temporary else self.path,
+            "threshold": self.threshold,
+            "near_duplicates": self.near_duplicates,
+            "num_perm": self.num_perm,
+            "shingle_size": self.shingle_size,
+            "seed": self.seed,
+            "commit_every": self.commit_every,
+            "clusters_path": self.clusters_path,
+        }
+
+    def signature(self, normalized: str) -> array.array:
+        words = normalized.split()
+        k = self.shingle_size
+        if len(words) <= k:
+            shingles = {" ".join(words)}
+        else:
+            shingles = {" ".join(words[i : i + k]) for i in range(len(words) - k + 1)}
+        hashes = [zlib.crc32(s.encode("utf-8")) for s in shingles]
+
+        p = _MERSENNE_PRIME
+        return array.array(
+            "L", [min((a * x + b) % p for x in hashes) for a, b in self._perms]
+        )
+
+    def _band_buckets(self, signature: array.array) -> List[Tuple[int, int]]:
+        retval = []
+        for band in range(self.bands):
+            rows = signature[band * self.rows : (band + 1) * self.rows]
+            bucket = zlib.crc32(rows.tobytes())
+            retval.append((band, bucket))
+        return retval
+
+    @staticmethod
+    def _similarity(a: array.array, b: array.array) -> float:
+        return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+    def assign(self, document: Document) -> Optional[str]:
+        # Returns the ID of the representative of this document's cluster,
+        # which is the document's own ID if it's the first of its kind. A
+        # document seen before keeps the cluster it was given then. Returns
+        # None for a document that can't be tracked because another one
+        # with a different body was already seen under its ID; it should
+        # just be asked on its own.
+        docid = f"{document.id}"
+        normalized = normalize_body(document.body)
+        digest = hashlib.sha1(normalized.encode("utf-8")).digest()
+
+        row = self._conn.execute(
+            "SELECT hash, rep, kind FROM members WHERE document_id = ?", (docid,)
+        ).fetchone()
+        if row is not None:
+            if row[0] != digest:
+                return None
+            self._count(row[2])
+            return row[1]
+
+        row = self._conn.execute(
+            "SELECT rep FROM exact WHERE hash = ?", (digest,)
+        ).fetchone()
+        if row is not None:
+            self._count("exact")
+            self._add_member(docid, digest, row[0], "exact")
+            return row[0]
+
+        signature = None
+        buckets = []
+        if self.near_duplicates:
+            signature = self.signature(normalized)
+            buckets = self._band_buckets(signature)
+            candidates = set()
+            for band, bucket in buckets:
+                for (rep,) in self._conn.execute(
+                    "SELECT rep FROM bands WHERE band = ? AND bucket = ?",
+                    (band, bucket),
+                ):
+                    candidates.add(rep)
+
+            for rep in sorted(candidates):
+                (blob,) = self._conn.execute(
+                    "SELECT signature FROM reps WHERE rep = ?", (rep,)
+                ).fetchone()
+                other = array.array("L")
+                other.frombytes(blob)
+                if self._similarity(signature, other) >= self.threshold:
+                    self._count("near")
+                    self._add_member(docid, digest, rep, "near")
+                    return rep
+
+        # A new representative.
+        self._count("representative")
+        self._conn.execute("INSERT INTO exact VALUES (?, ?)", (digest, docid))
+        self._conn.execute(
+            "INSERT INTO reps VALUES (?, ?, NULL)",
+            (docid, signature.tobytes() if signature else None),
+        )
+        self._conn.executemany(
+            "INSERT INTO bands VALUES (?, ?, ?)",
+            [(band, bucket, docid) for band, bucket in buckets],
+        )
+        self._add_member(docid, digest, docid, "representative")
+        return docid
+
+    def _count(self, kind: str):
+        if kind == "exact":
+            self.exact_duplicates += 1
+        elif kind == "near":
+            self.near_duplicate_count += 1
+        else:
+            self.representatives += 1
+
+    def _add_member(self, docid: str, digest: bytes, rep: str, kind: str):
+        self._conn.execute(
+            "INSERT INTO members VALUES (?, ?, ?, ?)", (docid, digest, rep, kind)
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_every:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def set_answers(self, rep: str, answers: Dict[str, Any]):
+        self._conn.execute(
+            "UPDATE reps SET answers = ? WHERE rep = ?",
+            # Pickled rather than JSON, so dates and the like survive intact.
+            (pickle.dumps(answers), rep),
+        )
+
+    def get_answers(self, rep: str) -> Optional[Dict[str, Any]]:
+        row = self._conn.execute(
+            "SELECT answers FROM reps WHERE rep = ?", (rep,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return pickle.loads(row[0])
+
+    def has_answers(self, rep: str) -> bool:
+        # False for a representative that was never answered, e.g. because
+        # the run that found it was interrupted.
+        row = self._conn.execute(
+            "SELECT answers IS NOT NULL FROM reps WHERE rep = ?", (rep,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def clusters(self) -> Iterator[Tuple[str, str, str]]:
+        # Yields (document id, representative's document id, kind) for every
+        # document seen, where kind is "representative", "exact" or "near".
+        self._conn.commit()
+        yield from self._conn.execute(
+            "SELECT document_id, rep, kind FROM members ORDER BY rowid"
+        )
+
+    def export_clusters(self, path: str, *, document_ids: Iterable[str] = None):
+        # Writes the clusters out as JSONL, for every document seen or only
+        # for the given ones.
+        clusters = self.clusters()
+        if document_ids is not None:
+            clusters = self._clusters_of(document_ids)
+        with open(path, "w", encoding="utf-8") as f:
+            for docid, repid, kind in clusters:
+                record = {
+                    "document_id": docid,
+                    "representative_id": repid,
+                    "kind": kind,
+                }
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _clusters_of(
+        self, document_ids: Iterable[str]
+    ) -> Iterator[Tuple[str, str, str]]:
+        self._conn.commit()
+        for docid in document_ids:
+            row = self._conn.execute(
+                "SELECT document_id, rep, kind FROM members WHERE document_id = ?",
+                (docid,),
+            ).fetchone()
+            if row is not None:
+                yield row
+
+    def save_clusters(self):
+        if self.clusters_path:
+            self.export_clusters(self.clusters_path)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "representatives": self.representatives,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicate_count,
+        }
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._uncommitted = 0
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.commit()
+        self._conn.close()
+        self._conn = None
+        if self._temporary:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
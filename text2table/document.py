@@ -1,7 +1,18 @@
-from typing import Any, List, Dict, Tuple, Union
+from typing import Any, Iterable, Iterator, List, Dict, Tuple, Union
+
+# Documents without an ID of their own get one made from their position, as
+# in "document_000001". The number is padded to a fixed width, rather than
+# to the number of digits in the corpus's size, because a corpus that's read
+# lazily doesn't know its size up front, and a document must get the same ID
+# however its corpus is read (resuming from a journal depends on it).
+GENERATED_ID_WIDTH = 6
 
 
 class Document:
+    # No per-instance __dict__, since a big job can have a great many of
+    # these alive at once. (For corpora too big even for that, see corpus.)
+    __slots__ = ("id", "description", "body")
+
     def __init__(self, *, id: str = "", description: str = "", body: str = ""):
         self.id = id
         self.description = description
@@ -37,7 +48,7 @@ class Document:
             Tuple[str, str, "Document"],
             Tuple[str, dict],
             Tuple[str, "Document"],
-        ]
+        ],
     ):
         if isinstance(x, Document):
             retval = Document(id=x.id, description=x.description, body=x.body)
@@ -55,6 +66,10 @@ class Document:
             retval = Document(body=x)
             return retval
 
+        if type(x) == list:
+            # Parsed JSON has no tuples, so [id, body] arrives as a list.
+            x = tuple(x)
+
         if type(x) == tuple:
             if len(x) != 2 and len(x) != 3:
                 raise ValueError(f"Don't know how to unpack tuple of length {len(x)}")
@@ -64,6 +79,12 @@ class Document:
                 retval.description = x[1]
             return retval
 
+    @staticmethod
+    def generated_id(position: int) -> str:
+        # The ID given to the document at this (zero-based) position in its
+        # corpus if it doesn't have one.
+        return f"document_{f'{position + 1}'.rjust(GENERATED_ID_WIDTH, '0')}"
+
     @staticmethod
     def create_collection(
         documents: Union[List[Any], Dict[str, Any]], *, document_description: str = ""
@@ -81,17 +102,34 @@ class Document:
                 for (dockey, docvalue) in documents.items()
             ]
 
-        charlen = len(f"{len(documents)}")
-
         retval = []
         for i, doc in enumerate(documents):
             doc = Document.create_from(doc)
             if not doc.id:
-                istr = f"{i + 1}".rjust(charlen, "0")
-                doc.id = f"document_{istr}"
+                doc.id = Document.generated_id(i)
 
             if document_description:
                 doc.description = document_description
 
             retval.append(doc)
         return retval
+
+    @staticmethod
+    def iter_collection(
+        documents: Iterable[Any],
+        *,
+        document_description: str = "",
+        start: int = 0,
+    ) -> Iterator["Document"]:
+        # The lazy counterpart to create_collection, for inputs too big to
+        # hold in memory. Generated IDs are numbered from start + 1, for a
+        # stream that begins partway through a corpus.
+        for i, doc in enumerate(documents, start):
+            doc = Document.create_from(doc)
+            if not doc.id:
+                doc.id = Document.generated_id(i)
+
+            if document_description:
+                doc.description = document_description
+
+            yield doc
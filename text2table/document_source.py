@@ -0,0 +1,344 @@
+import codecs
+import glob
+import json
+import mmap
+import os
+import itertools
+import re
+
+from .corpus import CORPUS_SUFFIX, Corpus
+from .document import Document
+
+from typing import Any, Iterable, Iterator, Tuple, Union
+
+# Everything in here reads its input a piece at a time, so memory use stays
+# flat no matter how big the corpus is. The readers yield the same kinds of
+# values that Document.create_from accepts; iter_documents turns any of them
+# into a lazy stream of Documents. A corpus store (see corpus) is read in
+# place.
+#
+# Every kind of source can also be read starting partway through, from an
+# offset given by iter_source_offsets: a byte offset into a JSON file, a
+# JSONL file or a plain-text dump, or a count of documents to skip for
+# anything else. The sharded runner uses these so that a worker can go
+# straight to its shard instead of parsing everything before it.
+
+_CHUNK_SIZE = 1 << 20
+
+
+_BOM = codecs.BOM_UTF8
+
+
+def _iter_decoded_chunks(
+    path: str, chunk_size: int = _CHUNK_SIZE, *, start: int = 0
+) -> Iterator[str]:
+    # Memory-maps the file and decodes it a chunk at a time, from byte
+    # offset `start` on. The incremental decoder takes care of multi-byte
+    # characters that straddle two chunks.
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= start:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            encoding = "utf-8-sig" if start == 0 else "utf-8"
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+            for offset in range(start, size, chunk_size):
+                chunk = mm[offset : offset + chunk_size]
+                yield decoder.decode(chunk, final=offset + chunk_size >= size)
+
+
+def _starts_with_bom(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(_BOM)) == _BOM
+
+
+class _ByteCounter:
+    # Keeps track of the byte offset in the file of a position in a buffer
+    # of decoded text, by encoding each stretch of text once as the position
+    # moves past it. (Bytes that didn't decode are counted as the three
+    # bytes of their replacement character, so offsets are only exact for
+    # valid UTF-8.)
+
+    def __init__(self, offset: int):
+        self.offset = offset
+        self.mark = 0
+
+    def advance(self, buf: str, pos: int) -> int:
+        self.offset += len(buf[self.mark : pos].encode("utf-8"))
+        self.mark = pos
+        return self.offset
+
+
+def _iter_json_array(
+    path: str, *, chunk_size: int = _CHUNK_SIZE, start: int = 0
+) -> Iterator[Tuple[int, Any]]:
+    # Yields (byte offset, element) for the elements of a top-level JSON
+    # array. A nonzero start must be the offset of one of the elements.
+    decoder = json.JSONDecoder()
+    chunks = _iter_decoded_chunks(path, chunk_size, start=start)
+    counter = _ByteCounter(
+        len(_BOM) if start == 0 and _starts_with_bom(path) else start
+    )
+    buf = ""
+    pos = 0
+    at_eof = False
+    started = start > 0
+
+    def fill():
+        nonlocal buf, pos, at_eof
+        chunk = next(chunks, None)
+        if chunk is None:
+            at_eof = True
+            return
+        counter.advance(buf, pos)
+        counter.mark = 0
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    while True:
+        while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ",")):
+            pos += 1
+        if pos >= len(buf):
+            if at_eof:
+                if started:
+                    raise ValueError(f"{path}: unterminated JSON array")
+                return
+            fill()
+            continue
+
+        if not started:
+            if buf[pos] != "[":
+                raise ValueError(f"{path}: expected a JSON array")
+            started = True
+            pos += 1
+            continue
+
+        if buf[pos] == "]":
+            return
+
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if at_eof:
+                raise
+            fill()
+            continue
+
+        # A number (or true/false/null) that runs right up to the end of the
+        # buffer might continue in the next chunk. So might one that stops
+        # at a "." or an "e", which the decoder leaves off when the digits
+        # after it haven't arrived yet.
+        if not at_eof and (end >= len(buf) or buf[end] in ".eE"):
+            fill()
+            continue
+
+        offset = counter.advance(buf, pos)
+        pos = end
+        yield offset, value
+
+
+def iter_json_array(
+    path: str, *, chunk_size: int = _CHUNK_SIZE, start: int = 0
+) -> Iterator[Any]:
+    # Yields the elements of a top-level JSON array (such as
+    # letters-to-santa.json) one at a time, without ever parsing the whole
+    # file at once.
+    for _, value in _iter_json_array(path, chunk_size=chunk_size, start=start):
+        yield value
+
+
+def _iter_jsonl(path: str, *, start: int = 0) -> Iterator[Tuple[int, Any]]:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= start:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.seek(start)
+            while True:
+                offset = mm.tell()
+                line = mm.readline()
+                if not line:
+                    return
+                line = line.strip()
+                if line:
+                    yield offset, json.loads(line)
+
+
+def iter_jsonl(path: str, *, start: int = 0) -> Iterator[Any]:
+    for _, value in _iter_jsonl(path, start=start):
+        yield value
+
+
+def _iter_delimited_text(
+    path: str, *, delimiter: str, chunk_size: int = _CHUNK_SIZE, start: int = 0
+) -> Iterator[Tuple[int, str]]:
+    # Yields (byte offset, piece) for the pieces of a plain-text dump. A
+    # piece's offset is that of its first character that isn't whitespace,
+    # and a nonzero start must be one of these.
+    pattern = re.compile(delimiter)
+    counter = _ByteCounter(
+        len(_BOM) if start == 0 and _starts_with_bom(path) else start
+    )
+    buf = ""
+    pos = 0
+
+    def pieces(stop: int) -> Iterator[Tuple[int, str]]:
+        piece = buf[pos:stop]
+        body = piece.strip()
+        if body:
+            lead = len(piece) - len(piece.lstrip())
+            yield counter.advance(buf, pos + lead), body
+
+    for chunk in _iter_decoded_chunks(path, chunk_size, start=start):
+        counter.advance(buf, pos)
+        counter.mark = 0
+        buf = buf[pos:] + chunk
+        pos = 0
+        while True:
+            match = pattern.search(buf, pos)
+            # A delimiter that runs up to the end of the buffer might go on
+            # into the next chunk.
+            if match is None or match.end() >= len(buf):
+                break
+            yield from pieces(match.start())
+            pos = match.end()
+
+    for match in pattern.finditer(buf, pos):
+        yield from pieces(match.start())
+        pos = match.end()
+    yield from pieces(len(buf))
+
+
+def iter_delimited_text(
+    path: str,
+    *,
+    delimiter: str = r"\n\s*\n",
+    chunk_size: int = _CHUNK_SIZE,
+    start: int = 0,
+) -> Iterator[str]:
+    # Splits a plain-text dump (such as letters-to-santa.txt) into one
+    # document per blank-line-separated block, or per whatever regex
+    # `delimiter` matches.
+    pieces = _iter_delimited_text(
+        path, delimiter=delimiter, chunk_size=chunk_size, start=start
+    )
+    for _, piece in pieces:
+        yield piece
+
+
+def _iter_text_paths(
+    pattern: str, extensions: Iterable[str]
+) -> Iterator[Tuple[str, Union[str, None]]]:
+    # Yields (path, root) for each file that iter_text_files reads.
+    if os.path.isdir(pattern):
+        root = pattern
+        extensions = tuple(extensions)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(extensions):
+                    yield os.path.join(dirpath, filename), root
+    else:
+        for path in sorted(glob.iglob(pattern, recursive=True)):
+            if os.path.isfile(path):
+                yield path, None
+
+
+def iter_text_files(
+    pattern: str, *, extensions: Iterable[str] = (".txt", ".md"), start: int = 0
+) -> Iterator[Document]:
+    # Given a directory, reads every file with one of the given extensions
+    # beneath it. Given a glob, reads every file that matches. Each file
+    # becomes one document, with its path as the ID. The first `start`
+    # files are skipped without being read.
+    paths = itertools.islice(_iter_text_paths(pattern, extensions), start, None)
+    for path, root in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            body = f.read()
+        docid = os.path.relpath(path, root) if root else path
+        yield Document(id=docid, body=body)
+
+
+def _source_kind(path: str) -> str:
+    # A single .txt file is taken to be a dump of many documents, one per
+    # block; a directory or glob of them, to hold one document per file.
+    lowerpath = path.lower()
+    if os.path.isdir(path) or glob.has_magic(path):
+        return "text_files"
+    elif lowerpath.endswith(CORPUS_SUFFIX):
+        return "corpus"
+    elif lowerpath.endswith(".json"):
+        return "json"
+    elif lowerpath.endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    elif lowerpath.endswith(".txt") and os.path.isfile(path):
+        return "text_dump"
+    elif os.path.isfile(path):
+        return "text_files"
+    raise ValueError(f"Don't know how to read documents from {path}")
+
+
+def iter_source(source: Union[str, Iterable[Any]], *, offset: int = 0) -> Iterable[Any]:
+    # Works out what kind of source we've been handed. Anything that isn't a
+    # path is assumed to be an iterable of documents already. Reading starts
+    # at `offset`, as given by iter_source_offsets.
+    if not isinstance(source, (str, os.PathLike)):
+        return itertools.islice(source, offset, None) if offset else source
+
+    path = os.fspath(source)
+    kind = _source_kind(path)
+    if kind == "corpus":
+        return Corpus(path)[offset:]
+    elif kind == "json":
+        return iter_json_array(path, start=offset)
+    elif kind == "jsonl":
+        return iter_jsonl(path, start=offset)
+    elif kind == "text_dump":
+        return iter_delimited_text(path, start=offset)
+    return iter_text_files(path, start=offset)
+
+
+def iter_source_offsets(path: str) -> Iterator[int]:
+    # Yields, for each document in a corpus file, the offset that
+    # iter_source would have to be given to start reading at it. Finding
+    # them means reading the whole file once, but nothing is kept.
+    path = os.fspath(path)
+    kind = _source_kind(path)
+    if kind == "corpus":
+        with Corpus(path) as corpus:
+            yield from range(len(corpus))
+    elif kind == "json":
+        for offset, _ in _iter_json_array(path):
+            yield offset
+    elif kind == "jsonl":
+        for offset, _ in _iter_jsonl(path):
+            yield offset
+    elif kind == "text_dump":
+        for offset, _ in _iter_delimited_text(path, delimiter=r"\n\s*\n"):
+            yield offset
+    else:
+        for i, _ in enumerate(_iter_text_paths(path, (".txt", ".md"))):
+            yield i
+
+
+def iter_documents(
+    source: Union[str, Iterable[Any]],
+    *,
+    document_description: str = "",
+    offset: int = 0,
+    start: int = 0,
+) -> Iterator[Document]:
+    # With an offset, `start` is the position in the whole corpus of the
+    # document at that offset, so that generated IDs come out the same as
+    # if the corpus had been read from the beginning.
+    documents = iter_source(source, offset=offset)
+    if isinstance(documents, Corpus):
+        # A corpus store's documents are handed out as views, without being
+        # copied. Its generated IDs were settled when it was built.
+        if document_description:
+            documents = documents.with_description(document_description)
+        return iter(documents)
+    return Document.iter_collection(
+        documents,
+        document_description=document_description,
+        start=start,
+    )
@@ -0,0 +1,163 @@
+import asyncio
+import threading
+
+from .adaptive_timeouts import AdaptiveTimeouts
+
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# Request hedging. Since every request is made at temperature 0, a second
+# identical request is as good as the first, so when a call has been out
+# for longer than (say) 95% of calls like it take, the same request is sent
+# again, possibly to another endpoint of a client pool. Whichever comes back
+# first is used and the other is cancelled. A slow cell holds up its whole
+# row, so trimming the tail of cell latency trims row latency a lot more.
+#
+# Hedges cost requests and tokens, so they're rationed: every call earns
+# max_extra_fraction of a hedge, up to a small burst, and a hedge spends a
+# whole one. Extra volume therefore never exceeds max_extra_fraction of the
+# calls made (plus the burst).
+
+
+class HedgePolicy:
+    def __init__(
+        self,
+        *,
+        hedge_percentile: float = 95.0,
+        min_delay: float = 0.5,
+        initial_delay: Optional[float] = None,
+        max_extra_fraction: float = 0.05,
+        burst: float = 5.0,
+        latencies: Optional[AdaptiveTimeouts] = None,
+    ):
+        # The latency history comes from `latencies`, which can be the same
+        # AdaptiveTimeouts that sets the run's timeouts. Until there's enough
+        # history for a kind of call, those calls are hedged after
+        # initial_delay seconds, or not at all if that's None.
+        self.hedge_percentile = hedge_percentile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.max_extra_fraction = max_extra_fraction
+        self.burst = burst
+        self.latencies = latencies if latencies is not None else AdaptiveTimeouts()
+
+        self.credit = burst
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(
+        config: Dict[str, Any], *, latencies: Optional[AdaptiveTimeouts] = None
+    ) -> "HedgePolicy":
+        # The latency history isn't carried over. Pass latencies to share
+        # an AdaptiveTimeouts with the run's timeouts, as in __init__.
+        config = dict(config)
+        latencies_config = config.pop("latencies")
+        if latencies is None:
+            latencies = AdaptiveTimeouts.from_config(latencies_config)
+        return HedgePolicy(latencies=latencies, **config)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "hedge_percentile": self.hedge_percentile,
+            "min_delay": self.min_delay,
+            "initial_delay": self.initial_delay,
+            "max_extra_fraction": self.max_extra_fraction,
+            "burst": self.burst,
+            "latencies": self.latencies.to_config(),
+        }
+
+    def delay_for(
+        self, model: str, prompt_tokens: int, output_tokens: int
+    ) -> Optional[float]:
+        # How long to wait before hedging a call like this, or None to not
+        # hedge it.
+        latency = self.latencies.latency_percentile(
+            model, prompt_tokens, output_tokens, self.hedge_percentile
+        )
+        if latency is None:
+            latency = self.initial_delay
+        if latency is None:
+            return None
+        return max(self.min_delay, latency)
+
+    def start_call(self):
+        with self._lock:
+            self.calls += 1
+            self.credit = min(self.burst, self.credit + self.max_extra_fraction)
+
+    def try_hedge(self) -> bool:
+        with self._lock:
+            if self.credit < 1.0:
+                self.denied += 1
+                return False
+            self.credit -= 1.0
+            self.hedges += 1
+            return True
+
+    def record_winner(self, hedge_won: bool):
+        if hedge_won:
+            with self._lock:
+                self.hedge_wins += 1
+
+    def stats(self) -> Dict[str, Any]:
+        # win_rate is how often a hedge beat the request it was hedging;
+        # a low one means the hedges are going out too early.
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "denied": self.denied,
+                "extra_fraction": self.hedges / self.calls if self.calls else 0.0,
+                "win_rate": self.hedge_wins / self.hedges if self.hedges else None,
+            }
+
+
+async def run_hedged(
+    start: Callable[[bool], Awaitable[Any]],
+    *,
+    delay: Optional[float],
+    policy: HedgePolicy,
+) -> Tuple[Any, bool, bool]:
+    # Runs start(False), and, if it hasn't finished after `delay` seconds
+    # and the policy can spare a hedge, start(True) alongside it. Returns
+    # (result, hedged, hedge_won). If the first of the two to finish
+    # failed, the other one is waited for; only if both fail is the
+    # primary's exception raised.
+    policy.start_call()
+    primary = asyncio.ensure_future(start(False))
+    if delay is None:
+        return await primary, False, False
+
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not policy.try_hedge():
+            return await primary, False, False
+
+        hedge = asyncio.ensure_future(start(True))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in (primary, hedge):
+                    if task in done and task.exception() is None:
+                        policy.record_winner(task is hedge)
+                        return task.result(), True, task is hedge
+            # Both failed.
+            return primary.result(), True, False
+        finally:
+            for task in pending:
+                task.cancel()
+            for task in pending:
+                try:
+                    await task
+                except BaseException:
+                    pass
+    finally:
+        if not primary.done():
+            primary.cancel()
@@ -0,0 +1,555 @@
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Instrumentation for every chat completion the engine makes. A Metrics
+# object collects one CallRecord per logical call (covering all of its
+# retries), keeps running totals for the per-run summary, and hands each
+# record to any number of hooks: plain callables, or objects with an
+# on_call(record) method and optionally on_run_end(summary).
+# PrometheusExporter and OpenTelemetryHook below are two such hooks.
+
+# US dollars per million tokens: (prompt, completion).
+DEFAULT_PRICES = {
+    "gpt-4-1106-preview": (10.0, 30.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4": (30.0, 60.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo-16k": (3.0, 4.0),
+    "gpt-3.5-turbo-1106": (1.0, 2.0),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class CallRecord:
+    # Everything we know about one logical call. Times are from
+    # time.monotonic(), except start_wall, which is wall-clock time for
+    # exporters that need it.
+
+    def __init__(
+        self,
+        *,
+        model: str,
+        question_keys: Iterable[str] = (),
+        run_id: str = "",
+        queued_at: Optional[float] = None,
+    ):
+        self.model = model
+        self.question_keys = list(question_keys)
+        self.run_id = run_id
+
+        now = time.monotonic()
+        self.queued_at = now if queued_at is None else queued_at
+        self.start_wall = time.time() - (now - self.queued_at)
+        self.started_at: Optional[float] = None
+        self.ended_at: Optional[float] = None
+
+        self.attempts = 0
+        self.attempt_latencies: List[float] = []
+        self.errors: List[str] = []
+        self.error: Optional[str] = None
+        self.finish_reason: Optional[str] = None
+        self.succeeded = False
+        self.cache_hit = False
+
+        # Duplicate requests sent to cut a slow attempt short, and whether
+        # one of them came back first.
+        self.hedges = 0
+        self.hedge_won = False
+
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+
+        # A tokenizer-free guess at the prompt's size, for when the server
+        # doesn't report usage (e.g. on streamed replies).
+        self.estimated_prompt_tokens = 0
+
+        self._attempt_started: Optional[float] = None
+
+    @property
+    def question_key(self) -> str:
+        return ",".join(self.question_keys)
+
+    @property
+    def retries(self) -> int:
+        return max(0, self.attempts - 1)
+
+    @property
+    def queue_wait(self) -> float:
+        # Time between the cell being ready and its first request going out:
+        # waiting for a concurrency slot and for the rate limiter.
+        if self.started_at is None:
+            return 0.0
+        return self.started_at - self.queued_at
+
+    @property
+    def latency(self) -> Optional[float]:
+        # The last attempt's time on the wire.
+        return self.attempt_latencies[-1] if self.attempt_latencies else None
+
+    @property
+    def elapsed(self) -> float:
+        end = self.ended_at if self.ended_at is not None else time.monotonic()
+        return end - self.queued_at
+
+    def begin_attempt(self):
+        now = time.monotonic()
+        if self.started_at is None:
+            self.started_at = now
+        self._attempt_started = now
+        self.attempts += 1
+
+    def end_attempt(self, error: Optional[str] = None):
+        if self._attempt_started is not None:
+            self.attempt_latencies.append(time.monotonic() - self._attempt_started)
+            self._attempt_started = None
+        if error is not None:
+            self.errors.append(error)
+
+    def record_response(self, response: Any):
+        # Called when a non-streamed request comes back.
+        self.end_attempt()
+        self.set_usage(getattr(response, "usage", None))
+        if response and response.choices:
+            self.finish_reason = response.choices[0].finish_reason
+
+    def set_usage(self, usage: Any):
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_tokens += getattr(details, "cached_tokens", 0) or 0
+
+
+class Metrics:
+    def __init__(
+        self,
+        *,
+        run_id: Optional[str] = None,
+        hooks: Iterable[Any] = (),
+        prices: Optional[Dict[str, Tuple[float, float]]] = None,
+        cached_prompt_discount: float = 0.5,
+        max_samples: int = 100000,
+    ):
+        # Cached prompt tokens are billed at (1 - cached_prompt_discount) of
+        # the normal rate. Latency percentiles are computed from a uniform
+        # sample of at most max_samples calls, to bound memory.
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.hooks = list(hooks)
+        self.prices = dict(DEFAULT_PRICES)
+        self.prices.update(prices or {})
+        self.cached_prompt_discount = cached_prompt_discount
+        self.max_samples = max_samples
+
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self._reset()
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "Metrics":
+        return Metrics(**config)
+
+    def to_config(self) -> Dict[str, Any]:
+        # Hooks aren't included; they're usually tied to this process (an
+        # exporter's registry, a tracer), so they'd have to be set up anew.
+        return {
+            "run_id": self.run_id,
+            "prices": dict(self.prices),
+            "cached_prompt_discount": self.cached_prompt_discount,
+            "max_samples": self.max_samples,
+        }
+
+    def _reset(self):
+        self.started = time.monotonic()
+        self.ended: Optional[float] = None
+        self.rows = 0
+        self.calls = 0
+        self.cache_hits = 0
+        self.failed_calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.errors: Dict[str, int] = {}
+        self.finish_reasons: Dict[str, int] = {}
+        self.tokens = {"prompt": 0, "completion": 0, "cached": 0}
+        self.cost = 0.0
+        self.columns: Dict[str, Dict[str, Any]] = {}
+        self.models: Dict[str, Dict[str, Any]] = {}
+        self._latencies: List[float] = []
+        self._queue_waits: List[float] = []
+        self._sampled = 0
+
+    def add_hook(self, hook: Any):
+        self.hooks.append(hook)
+
+    def start_run(self):
+        with self._lock:
+            self._reset()
+
+    def end_run(self):
+        with self._lock:
+            self.ended = time.monotonic()
+        summary = self.summary()
+        for hook in self.hooks:
+            on_run_end = getattr(hook, "on_run_end", None)
+            if on_run_end is not None:
+                on_run_end(summary)
+        return summary
+
+    def start_call(
+        self,
+        *,
+        model: str,
+        question_keys: Iterable[str] = (),
+        queued_at: Optional[float] = None,
+    ) -> CallRecord:
+        return CallRecord(
+            model=model,
+            question_keys=question_keys,
+            run_id=self.run_id,
+            queued_at=queued_at,
+        )
+
+    def price_of(self, record: CallRecord) -> float:
+        prompt_price, completion_price = self.prices.get(record.model, (0.0, 0.0))
+        uncached = record.prompt_tokens - record.cached_tokens
+        cached = record.cached_tokens * (1.0 - self.cached_prompt_discount)
+        return (
+            (uncached + cached) * prompt_price
+            + record.completion_tokens * completion_price
+        ) / 1e6
+
+    def end_call(self, record: CallRecord):
+        record.ended_at = time.monotonic()
+        if not record.succeeded and record.error is None and record.errors:
+            record.error = record.errors[-1]
+        record.cost = self.price_of(record)
+
+        with self._lock:
+            self._aggregate(record)
+
+        for hook in self.hooks:
+            on_call = getattr(hook, "on_call", None)
+            if on_call is not None:
+                on_call(record)
+            elif callable(hook):
+                hook(record)
+
+    def _aggregate(self, record: CallRecord):
+        self.calls += 1
+        if record.cache_hit:
+            self.cache_hits += 1
+        if not record.succeeded:
+            self.failed_calls += 1
+        self.retries += record.retries
+        self.hedges += record.hedges
+        self.hedge_wins += 1 if record.hedge_won else 0
+        for error in record.errors:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        if record.finish_reason:
+            reason = record.finish_reason
+            self.finish_reasons[reason] = self.finish_reasons.get(reason, 0) + 1
+        self.tokens["prompt"] += record.prompt_tokens
+        self.tokens["completion"] += record.completion_tokens
+        self.tokens["cached"] += record.cached_tokens
+        self.cost += record.cost
+
+        model = self.models.setdefault(
+            record.model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        )
+        model["calls"] += 1
+        model["prompt_tokens"] += record.prompt_tokens
+        model["completion_tokens"] += record.completion_tokens
+
+        # A multi-question call's tokens and cost are split evenly among
+        # the questions it asked.
+        keys = record.question_keys or [""]
+        share = 1.0 / len(keys)
+        for key in keys:
+            column = self.columns.setdefault(
+                key,
+                {
+                    "calls": 0,
+                    "failed_calls": 0,
+                    "retries": 0,
+                    "prompt_tokens": 0.0,
+                    "completion_tokens": 0.0,
+                    "cost": 0.0,
+                },
+            )
+            column["calls"] += 1
+            column["failed_calls"] += 0 if record.succeeded else 1
+            column["retries"] += record.retries
+            column["prompt_tokens"] += record.prompt_tokens * share
+            column["completion_tokens"] += record.completion_tokens * share
+            column["cost"] += record.cost * share
+
+        if record.latency is not None and not record.cache_hit:
+            # Reservoir sampling, so that long runs don't grow these lists
+            # without bound.
+            self._sampled += 1
+            if len(self._latencies) < self.max_samples:
+                self._latencies.append(record.latency)
+                self._queue_waits.append(record.queue_wait)
+            else:
+                i = self._random.randrange(self._sampled)
+                if i < self.max_samples:
+                    self._latencies[i] = record.latency
+                    self._queue_waits[i] = record.queue_wait
+
+    def record_row(self):
+        with self._lock:
+            self.rows += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            end = self.ended if self.ended is not None else time.monotonic()
+            seconds = end - self.started
+            return {
+                "run_id": self.run_id,
+                "seconds": seconds,
+                "rows": self.rows,
+                "rows_per_second": self.rows / seconds if seconds else None,
+                "calls": self.calls,
+                "calls_per_second": self.calls / seconds if seconds else None,
+                "cache_hits": self.cache_hits,
+                "failed_calls": self.failed_calls,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "errors": dict(self.errors),
+                "finish_reasons": dict(self.finish_reasons),
+                "tokens": dict(self.tokens),
+                "latency": {
+                    f"p{p}": percentile(self._latencies, p) for p in (50, 95, 99)
+                },
+                "queue_wait": {
+                    f"p{p}": percentile(self._queue_waits, p) for p in (50, 95, 99)
+                },
+                "cost": self.cost,
+                "models": {k: dict(v) for k, v in self.models.items()},
+                "columns": {k: dict(v) for k, v in self.columns.items()},
+            }
+
+
+class PrometheusExporter:
+    # Keeps Prometheus-style counters and histograms, and renders them in
+    # the text exposition format. No client library is needed: the text can
+    # be written to a file for node_exporter's textfile collector, or served
+    # over HTTP with serve().
+
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+    def __init__(self, *, prefix: str = "text2table"):
+        self.prefix = prefix
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _inc(self, name: str, labels: Dict[str, str], amount: float = 1.0):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def _observe(self, name: str, labels: Dict[str, str], value: float):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self._histograms.get(key)
+        if buckets is None:
+            # One count per bucket, then +Inf, sum and count.
+            buckets = [0.0] * (len(self.LATENCY_BUCKETS) + 3)
+            self._histograms[key] = buckets
+        for i, bound in enumerate(self.LATENCY_BUCKETS):
+            if value <= bound:
+                buckets[i] += 1
+        buckets[-3] += 1
+        buckets[-2] += value
+        buckets[-1] += 1
+
+    def on_call(self, record: CallRecord):
+        labels = {
+            "model": record.model,
+            "question": record.question_key,
+            "run_id": record.run_id,
+        }
+        if record.cache_hit:
+            outcome = "cache_hit"
+        elif record.succeeded:
+            outcome = "ok"
+        else:
+            outcome = record.error or f"finish_{record.finish_reason}"
+        with self._lock:
+            self._inc("llm_calls_total", dict(labels, outcome=outcome))
+            self._inc("llm_retries_total", labels, record.retries)
+            if record.hedges:
+                self._inc("llm_hedges_total", labels, record.hedges)
+                self._inc("llm_hedge_wins_total", labels, 1 if record.hedge_won else 0)
+            for error in record.errors:
+                self._inc("llm_errors_total", dict(labels, error=error))
+            if record.finish_reason:
+                self._inc(
+                    "llm_finish_reasons_total",
+                    dict(labels, finish_reason=record.finish_reason),
+                )
+            for kind, count in (
+                ("prompt", record.prompt_tokens),
+                ("completion", record.completion_tokens),
+                ("cached", record.cached_tokens),
+            ):
+                self._inc("llm_tokens_total", dict(labels, type=kind), count)
+            self._inc("llm_cost_dollars_total", labels, record.cost)
+            if record.latency is not None and not record.cache_hit:
+                model_labels = {"model": record.model, "run_id": record.run_id}
+                self._observe("llm_latency_seconds", model_labels, record.latency)
+                self._observe("llm_queue_wait_seconds", model_labels, record.queue_wait)
+
+    @staticmethod
+    def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+        parts = []
+        for name, value in labels:
+            value = f"{value}".replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'{name}="{value}"'.replace("\n", "\\n"))
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                full = f"{self.prefix}_{name}"
+                if full not in seen:
+                    lines.append(f"# TYPE {full} counter")
+                    seen.add(full)
+                lines.append(f"{full}{self._format_labels(labels)} {value:g}")
+
+            for (name, labels), buckets in sorted(self._histograms.items()):
+                full = f"{self.prefix}_{name}"
+                if full not in seen:
+                    lines.append(f"# TYPE {full} histogram")
+                    seen.add(full)
+                # _observe counts each value in every bucket it fits, so
+                # these are already cumulative, as Prometheus expects.
+                for bound, count in zip(self.LATENCY_BUCKETS, buckets):
+                    bucket_labels = labels + (("le", f"{bound:g}"),)
+                    lines.append(
+                        f"{full}_bucket{self._format_labels(bucket_labels)} {count:g}"
+                    )
+                inf_labels = labels + (("le", "+Inf"),)
+                lines.append(
+                    f"{full}_bucket{self._format_labels(inf_labels)} {buckets[-3]:g}"
+                )
+                lines.append(f"{full}_sum{self._format_labels(labels)} {buckets[-2]:g}")
+                lines.append(
+                    f"{full}_count{self._format_labels(labels)} {buckets[-1]:g}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def serve(self, port: int = 9464, host: str = "127.0.0.1"):
+        # Serves /metrics from a background thread until shutdown().
+        import http.server
+
+        exporter = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", f"{len(body)}")
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[1]
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class OpenTelemetryHook:
+    # Emits one span per call through the OpenTelemetry API, with its start
+    # and end times backdated to when the call was really made. The span
+    # attributes follow the gen_ai semantic conventions where there is one.
+
+    def __init__(self, tracer: Any = None, *, span_name: str = "chat.completions"):
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError(
+                "OpenTelemetryHook requires opentelemetry-api"
+                " (pip install opentelemetry-api)"
+            ) from e
+        self._trace = trace
+        self.tracer = tracer or trace.get_tracer("text2table")
+        self.span_name = span_name
+
+    def on_call(self, record: CallRecord):
+        start_ns = int(record.start_wall * 1e9)
+        end_ns = start_ns + int(record.elapsed * 1e9)
+        attributes = {
+            "gen_ai.system": "openai",
+            "gen_ai.request.model": record.model,
+            "gen_ai.usage.input_tokens": record.prompt_tokens,
+            "gen_ai.usage.output_tokens": record.completion_tokens,
+            "text2table.cached_tokens": record.cached_tokens,
+            "text2table.question_key": record.question_key,
+            "text2table.run_id": record.run_id,
+            "text2table.attempts": record.attempts,
+            "text2table.retries": record.retries,
+            "text2table.queue_wait_seconds": record.queue_wait,
+            "text2table.cache_hit": record.cache_hit,
+            "text2table.cost_dollars": record.cost,
+        }
+        if record.finish_reason:
+            attributes["gen_ai.response.finish_reasons"] = [record.finish_reason]
+        if record.error:
+            attributes["error.type"] = record.error
+
+        span = self.tracer.start_span(
+            self.span_name, start_time=start_ns, attributes=attributes
+        )
+        if not record.succeeded:
+            span.set_status(
+                self._trace.Status(
+                    self._trace.StatusCode.ERROR,
+                    record.error or f"finish_reason={record.finish_reason}",
+                )
+            )
+        span.end(end_time=end_ns)
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+
+from .question import Question
+
+from typing import Any, Dict, Optional, Tuple
+
+
+def _datatype_name(datatype: Any) -> Optional[str]:
+    # An enum's choices would make every line much longer, and its values
+    # are plain strings anyway, so it's only recorded as being one.
+    if type(datatype) == list:
+        return "enum"
+    try:
+        return Question.datatype_to_string(datatype)
+    except TypeError:
+        return None
+
+
+class ExtractionJournal:
+    # An append-only JSONL record of every finished (document, question) cell.
+    # Each line is written and flushed as soon as the cell is done, so that a
+    # run that dies partway through can be resumed without paying for the
+    # same cells twice.
+    #
+    # Each record carries its question's datatype, so that values JSON has
+    # no type for (dates, datetimes and timedeltas) come back from load as
+    # the same type they were recorded as rather than as strings.
+
+    def __init__(self, path: str, *, fsync_every: int = 100):
+        self.path = path
+        self.fsync_every = fsync_every
+
+        self.completed: Dict[Tuple[str, str], Any] = {}
+
+        self._file = None
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[Tuple[str, str], Any]:
+        # A crash can leave a half-written last line behind. Such lines are
+        # skipped; the cell simply gets asked again.
+        self.completed = {}
+        if not os.path.exists(self.path):
+            return self.completed
+
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    key = (record["document_id"], record["question_key"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                # Records written without a datatype (by older versions)
+                # are passed through as they are.
+                datatype = Question.datatype_from_string(record.get("datatype"))
+                self.completed[key] = Question.value_from_json(
+                    record.get("value"), datatype
+                )
+        return self.completed
+
+    def has(self, document_id: str, question_key: str) -> bool:
+        return (document_id, question_key) in self.completed
+
+    def get(self, document_id: str, question_key: str) -> Any:
+        return self.completed.get((document_id, question_key))
+
+    def _open_for_append(self):
+        # If the last run died mid-line, start on a fresh line so that the
+        # torn record doesn't swallow the next good one.
+        needs_newline = False
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+
+        f = open(self.path, "a", encoding="utf-8")
+        if needs_newline:
+            f.write("\n")
+        return f
+
+    def record(
+        self,
+        document_id: str,
+        question_key: str,
+        *,
+        reply: Optional[str],
+        value: Any,
+        datatype: Optional[Any] = None,
+    ):
+        line = json.dumps(
+            {
+                "document_id": document_id,
+                "question_key": question_key,
+                "reply": reply,
+                "value": Question.value_to_json(value),
+                "datatype": _datatype_name(datatype),
+            },
+            ensure_ascii=False,
+            default=str,
+        )
+        with self._lock:
+            if self._file is None:
+                self._file = self._open_for_append()
+            self._file.write(line + "\n")
+            self._file.flush()
+
+            self._unsynced += 1
+            if self.fsync_every and self._unsynced >= self.fsync_every:
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+                self._unsynced = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,70 @@
+import threading
+
+from typing import Any, Dict, Iterable, List, Optional
+
+DEFAULT_CASCADE_MODELS = ("gpt-3.5-turbo-1106", "gpt-4-1106-preview")
+
+
+class ModelCascade:
+    # A list of models ordered from cheapest to strongest. Each cell is asked
+    # of the first model; only if its reply can't be used (it doesn't parse,
+    # doesn't coerce to the question's datatype, or contradicts itself) is
+    # the cell escalated to the next model, and so on. The last model's reply
+    # is taken whatever it says.
+    #
+    # Questions can be given their own list of models in question_models,
+    # e.g. to send a hard free-text question straight to the strong model.
+
+    def __init__(
+        self,
+        models: Iterable[str] = DEFAULT_CASCADE_MODELS,
+        *,
+        question_models: Optional[Dict[str, Iterable[str]]] = None,
+    ):
+        self.models = list(models)
+        if not self.models:
+            raise ValueError("A model cascade needs at least one model")
+        self.question_models = {
+            key: list(m) for key, m in (question_models or {}).items()
+        }
+        for key, m in self.question_models.items():
+            if not m:
+                raise ValueError(f"No models given for question {key}")
+
+        # Per model: {"asked": int, "accepted": int}, counted in cells.
+        self.tiers: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "ModelCascade":
+        config = dict(config)
+        return ModelCascade(config.pop("models"), **config)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {"models": list(self.models), "question_models": self.question_models}
+
+    def models_for(self, question_key: str) -> List[str]:
+        return self.question_models.get(question_key, self.models)
+
+    def record(self, model: str, *, asked: int, accepted: int):
+        with self._lock:
+            tier = self.tiers.setdefault(model, {"asked": 0, "accepted": 0})
+            tier["asked"] += asked
+            tier["accepted"] += accepted
+
+    def stats(self) -> Dict[str, Any]:
+        # hit_rate is the fraction of the cells that reached a model which
+        # that model answered acceptably. Rejected cells went on to the next
+        # model, or, at the last one, were kept as they were.
+        with self._lock:
+            retval = {}
+            for model, tier in self.tiers.items():
+                retval[model] = {
+                    "asked": tier["asked"],
+                    "accepted": tier["accepted"],
+                    "rejected": tier["asked"] - tier["accepted"],
+                    "hit_rate": (
+                        tier["accepted"] / tier["asked"] if tier["asked"] else None
+                    ),
+                }
+            return retval
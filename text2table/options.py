@@ -0,0 +1,139 @@
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional
+
+if TYPE_CHECKING:
+    from .adaptive_timeouts import AdaptiveTimeouts
+    from .cost_planner import Budget
+    from .dedup import Deduplicator
+    from .hedging import HedgePolicy
+    from .instrumentation import Metrics
+    from .journal import ExtractionJournal
+    from .model_cascade import ModelCascade
+    from .rate_limiter import RateLimiter
+    from .response_cache import ResponseCache
+    from .schema_cache import SchemaCache
+    from .skip_predictor import SkipPredictor
+    from .structured_output import StructuredOutput
+
+# The model that answers questions when no cascade is configured, and the
+# one that infers datatypes.
+DEFAULT_MODEL = "gpt-4-1106-preview"
+DATATYPES_MODEL = "gpt-3.5-turbo-16k"
+
+
+class ExtractionOptions:
+    # Everything about how async_iter_text2table runs a job, other than the
+    # questions, the documents and the client. Every entry point that runs
+    # the engine takes one of these as `options`; any keyword arguments
+    # given alongside it override its fields, so that
+    # text2table(..., early_stop=True) still works for a one-off.
+    #
+    # Every row is also written to each of the sinks (a ResultTable or one
+    # of the writers in result_table), which get flushed at the end.
+    # With a journal, every finished cell is recorded as it completes; with
+    # resume=True as well, cells already in the journal aren't asked again.
+    # With max_chunk_tokens, documents longer than that are split into
+    # overlapping chunks, and the chunks' answers are reduced per question.
+    # With early_stop, single-question replies are streamed and abandoned
+    # as soon as they settle on OFFTOPIC or ABSENT. With a skip_predictor,
+    # cells it confidently predicts to be absent aren't asked at all, and
+    # the outcomes of the cells that are asked are used to train it. With a
+    # deduplicator, only the first document of each cluster of exact or
+    # near-duplicates gets asked, and its answers are copied to the rest;
+    # the clusters are written to its clusters_path, if it has one.
+    # With a cascade, each cell goes to the cheapest model first and is only
+    # escalated to the next one if the reply is unusable; otherwise every
+    # cell is asked of DEFAULT_MODEL. With metrics, every call is recorded
+    # (and passed to its hooks), and metrics.summary() describes the run.
+    # With a budget, no new document is started once its projected cost
+    # would take the run over the budget; rows already under way finish,
+    # and the rest can be picked up later by resuming from the journal.
+    # With a timeout_policy, every call's timeout adapts to how long calls
+    # like it have been taking. With a hedge_policy, calls that run late
+    # are duplicated, and whichever copy answers first is used. With
+    # structured_output, cells are answered with short JSON objects instead
+    # of Markdown (and early_stop has no effect).
+
+    def __init__(
+        self,
+        *,
+        document_description: str = "",
+        max_concurrency: int = 16,
+        multi_question: bool = False,
+        max_questions_per_prompt: int = 8,
+        cache: Optional["ResponseCache"] = None,
+        refresh_cache: bool = False,
+        rate_limiter: Optional["RateLimiter"] = None,
+        schema_cache: Optional["SchemaCache"] = None,
+        journal: Optional["ExtractionJournal"] = None,
+        resume: bool = False,
+        sinks: Iterable[Any] = (),
+        max_chunk_tokens: Optional[int] = None,
+        chunk_overlap_tokens: int = 200,
+        early_stop: bool = False,
+        skip_predictor: Optional["SkipPredictor"] = None,
+        deduplicator: Optional["Deduplicator"] = None,
+        cascade: Optional["ModelCascade"] = None,
+        datatypes_model: str = DATATYPES_MODEL,
+        metrics: Optional["Metrics"] = None,
+        budget: Optional["Budget"] = None,
+        timeout_policy: Optional["AdaptiveTimeouts"] = None,
+        hedge_policy: Optional["HedgePolicy"] = None,
+        structured_output: Optional["StructuredOutput"] = None,
+    ):
+        self.document_description = document_description
+        self.max_concurrency = max_concurrency
+        self.multi_question = multi_question
+        self.max_questions_per_prompt = max_questions_per_prompt
+        self.cache = cache
+        self.refresh_cache = refresh_cache
+        self.rate_limiter = rate_limiter
+        self.schema_cache = schema_cache
+        self.journal = journal
+        self.resume = resume
+        self.sinks = tuple(sinks)
+        self.max_chunk_tokens = max_chunk_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.early_stop = early_stop
+        self.skip_predictor = skip_predictor
+        self.deduplicator = deduplicator
+        self.cascade = cascade
+        self.datatypes_model = datatypes_model
+        self.metrics = metrics
+        self.budget = budget
+        self.timeout_policy = timeout_policy
+        self.hedge_policy = hedge_policy
+        self.structured_output = structured_output
+
+    @staticmethod
+    def create(
+        options: Optional["ExtractionOptions"] = None, **changes
+    ) -> "ExtractionOptions":
+        # What the entry points do with their `options` and keyword
+        # arguments. Unknown names raise TypeError, as they would for any
+        # other function.
+        if options is None:
+            return ExtractionOptions(**changes)
+        return options.replace(**changes)
+
+    def replace(self, **changes) -> "ExtractionOptions":
+        # A copy with some fields changed. The objects it holds (caches,
+        # journals and so on) are shared with this one, not copied.
+        fields = self.to_dict()
+        fields.update(changes)
+        return ExtractionOptions(**fields)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+    def changed(self) -> Dict[str, Any]:
+        # Just the fields that differ from the defaults.
+        defaults = vars(ExtractionOptions())
+        return {
+            name: value
+            for name, value in vars(self).items()
+            if value is not defaults[name] and value != defaults[name]
+        }
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{k}={v!r}" for k, v in self.changed().items())
+        return f"ExtractionOptions({fields})"
@@ -0,0 +1,560 @@
+import datetime
+import json
+
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# The ways answers from several chunks of one long document can be combined
+# (see chunking.reduce_answers).
+AGGREGATIONS = ("sum", "max", "min", "first", "union", "majority")
+
+# The datatypes each aggregation can combine. "first" and "majority" work on
+# anything. (Kept as names, since the typing generics can't be hashed.)
+_AGGREGATION_DATATYPES = {
+    "sum": ("int", "float", "timedelta"),
+    "max": ("int", "float", "date", "datetime", "timedelta"),
+    "min": ("int", "float", "date", "datetime", "timedelta"),
+    "union": ("List[str]", "List[int]", "List[float]"),
+}
+
+
+class Question:
+    def __init__(
+        self,
+        text: str = "",
+        key: str = "",
+        datatype: Optional[Any] = None,
+        defaultvalue: Optional[Any] = None,
+        unitlabel: str = "",
+        explanation: str = "",
+        required: bool = False,
+        aggregation: str = "",
+    ):
+        self.key = f"{key}".strip()
+        self.text = f"{text}".strip()
+
+        self.datatype = datatype
+        self.defaultvalue = defaultvalue
+        self.unitlabel = f"{unitlabel}".strip()
+        self.explanation = f"{explanation}".strip()
+
+        self.required = required
+
+        # How to combine answers from several chunks of one long document:
+        # "sum", "max", "min", "first", "union", or "majority". Blank means
+        # pick based on the datatype. Checked here rather than when the
+        # answers are reduced, which happens well into a run.
+        self.aggregation = f"{aggregation}".strip()
+        if self.aggregation and self.aggregation not in AGGREGATIONS:
+            raise ValueError(
+                f"Unknown aggregation {self.aggregation!r}; expected one of {AGGREGATIONS}"
+            )
+        self.check_aggregation()
+
+    def check_aggregation(self):
+        # Raises ValueError if the aggregation can't combine answers of the
+        # question's datatype (a "sum" of strings, say). A question whose
+        # datatype is still to be inferred is checked again once it has
+        # one.
+        if not self.aggregation or not self.datatype:
+            return
+        allowed = _AGGREGATION_DATATYPES.get(self.aggregation)
+        if allowed is None:
+            return
+        try:
+            name = Question.datatype_to_string(self.datatype)
+        except TypeError:
+            name = None
+        if name not in allowed:
+            raise ValueError(
+                f"Question {self.key!r}: aggregation {self.aggregation!r} can't"
+                f" combine answers of type {name or self.datatype}; it needs one"
+                f" of {allowed}"
+            )
+
+    def __str__(self):
+        s = ""
+        if self.key:
+            s += self.key
+        if self.required:
+            s += "*"
+        if self.text:
+            if s:
+                s = s + ": "
+            s += self.text
+
+        sparen = []
+        if self.datatype:
+            sparen.append(f"{self.datatype}")
+        if self.unitlabel:
+            sparen.append(self.unitlabel)
+        if self.defaultvalue is not None:
+            sparen.append(f"default={self.defaultvalue}")
+        if len(sparen):
+            s += "(" + ", ".join(sparen) + ")"
+
+        if self.explanation:
+            if s:
+                s += " -- "
+            s += self.explanation
+
+        return s
+
+    def coerce_to_my_datatype(self, stringvalue: str):
+        if not self.datatype:
+            return stringvalue
+        return Question.coerce_string_to_datatype(
+            stringvalue=stringvalue, datatype=self.datatype
+        )
+
+    @staticmethod
+    def coerce_string_to_datatype(stringvalue: str, datatype: Any):
+        try:
+            if type(stringvalue) == str and (datatype == str or type(datatype) == list):
+                # We ask for these as JSON strings, so they usually come back
+                # wrapped in quotes.
+                stringvalue = stringvalue.strip()
+                if len(stringvalue) >= 2 and stringvalue[0] == stringvalue[-1] == '"':
+                    stringvalue = json.loads(stringvalue)
+
+            if datatype == str:
+                return stringvalue
+
+            elif datatype == int:
+                return int(stringvalue)
+
+            elif datatype == float:
+                return float(stringvalue)
+
+            elif datatype in (List[str], List[int], List[float]):
+                values = json.loads(stringvalue)
+                if not isinstance(values, list):
+                    # A lone value where a list was asked for, e.g. "5".
+                    values = [values]
+                convert = {List[str]: str, List[int]: int, List[float]: float}
+                return [convert[datatype](x) for x in values]
+
+            elif datatype in (datetime.date, datetime.datetime, datetime.timedelta):
+                return Question._coerce_string_to_time(stringvalue, datatype)
+
+            elif type(datatype) == list:
+                if stringvalue in datatype:
+                    return stringvalue
+                else:
+                    return None
+
+        except (ValueError, TypeError, KeyError, OverflowError):
+            return None
+
+    @staticmethod
+    def _coerce_string_to_time(stringvalue: str, datatype: Any):
+        # We ask for dates, datetimes and timedeltas as JSON objects (see
+        # instructions_for_datatype), but models sometimes answer with an
+        # ISO 8601 string instead, so that's accepted too.
+        stringvalue = f"{stringvalue}".strip()
+        try:
+            value = json.loads(stringvalue)
+        except ValueError:
+            value = stringvalue
+
+        if isinstance(value, str):
+            if datatype == datetime.date:
+                return datetime.date.fromisoformat(value.strip()[:10])
+            elif datatype == datetime.datetime:
+                return datetime.datetime.fromisoformat(value.strip())
+            raise ValueError(f"Not a timedelta: {value!r}")
+
+        if not isinstance(value, dict):
+            raise ValueError(f"Not a {datatype.__name__}: {value!r}")
+        if datatype != datetime.timedelta:
+            value = {"hour": 0, "minute": 0, "second": 0, **value}
+            return Question.coerce_json_to_datatype(value=value, datatype=datatype)
+
+        # The timedelta instructions offer years and months (and their
+        # example says "month"), which aren't fixed lengths of time; they're
+        # taken as 365 and 30 days.
+        days_per_unit = {"year": 365, "month": 30, "week": 7, "day": 1}
+        seconds_per_unit = {"hour": 3600, "minute": 60, "second": 1}
+        days = 0
+        seconds = 0.0
+        for k, v in value.items():
+            unit = k.rstrip("s")
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                raise ValueError(f"Not a number: {v!r}")
+            if unit in days_per_unit:
+                days += v * days_per_unit[unit]
+            elif unit in seconds_per_unit:
+                seconds += v * seconds_per_unit[unit]
+            else:
+                raise ValueError(f"Unknown unit of time: {k!r}")
+        return datetime.timedelta(days=days, seconds=seconds)
+
+    def coerce_json_to_my_datatype(self, value: Any):
+        if not self.datatype:
+            return value
+        return Question.coerce_json_to_datatype(value=value, datatype=self.datatype)
+
+    @staticmethod
+    def coerce_json_to_datatype(value: Any, datatype: Any):
+        # The counterpart of coerce_string_to_datatype for answers that came
+        # back as parsed JSON (see json_schema_for_datatype), so they're
+        # already numbers, lists or objects rather than strings.
+        def is_number(x):
+            return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+        def to_int(x):
+            if not is_number(x) or float(x) != int(x):
+                raise ValueError(f"Not an integer: {x!r}")
+            return int(x)
+
+        def to_float(x):
+            if not is_number(x):
+                raise ValueError(f"Not a number: {x!r}")
+            return float(x)
+
+        def to_str(x):
+            if not isinstance(x, str):
+                raise ValueError(f"Not a string: {x!r}")
+            return x
+
+        try:
+            if datatype == str:
+                return to_str(value)
+
+            elif datatype == int:
+                return to_int(value)
+
+            elif datatype == float:
+                return to_float(value)
+
+            elif datatype in (List[str], List[int], List[float]):
+                if not isinstance(value, list):
+                    return None
+                convert = {List[str]: to_str, List[int]: to_int, List[float]: to_float}
+                return [convert[datatype](x) for x in value]
+
+            elif datatype == datetime.date:
+                return datetime.date(
+                    to_int(value["year"]), to_int(value["month"]), to_int(value["day"])
+                )
+
+            elif datatype == datetime.datetime:
+                second = to_float(value["second"])
+                return datetime.datetime(
+                    to_int(value["year"]),
+                    to_int(value["month"]),
+                    to_int(value["day"]),
+                    to_int(value["hour"]),
+                    to_int(value["minute"]),
+                    int(second),
+                    int(round((second - int(second)) * 1e6)),
+                )
+
+            elif datatype == datetime.timedelta:
+                return datetime.timedelta(
+                    days=to_int(value["days"]),
+                    hours=to_int(value["hours"]),
+                    minutes=to_int(value["minutes"]),
+                    seconds=to_float(value["seconds"]),
+                )
+
+            elif type(datatype) == list:
+                if value in datatype:
+                    return value
+                else:
+                    return None
+
+        except (ValueError, TypeError, KeyError, OverflowError):
+            return None
+
+    def json_schema_for_my_datatype(self) -> Dict[str, Any]:
+        return Question.json_schema_for_datatype(self.datatype)
+
+    @staticmethod
+    def json_schema_for_datatype(datatype: Any) -> Dict[str, Any]:
+        # The JSON schema of an answer of this datatype, for the structured
+        # answer formats. Questions without a datatype get a string.
+        def record(fields: Dict[str, str]) -> Dict[str, Any]:
+            # Every field is required, and nothing else is allowed, so that
+            # the schema also works in strict mode.
+            return {
+                "type": "object",
+                "properties": {k: {"type": t} for k, t in fields.items()},
+                "required": list(fields),
+                "additionalProperties": False,
+            }
+
+        if datatype is None or datatype == str:
+            return {"type": "string"}
+
+        elif datatype == int:
+            return {"type": "integer"}
+
+        elif datatype == float:
+            return {"type": "number"}
+
+        elif datatype == List[str]:
+            return {"type": "array", "items": {"type": "string"}}
+
+        elif datatype == List[int]:
+            return {"type": "array", "items": {"type": "integer"}}
+
+        elif datatype == List[float]:
+            return {"type": "array", "items": {"type": "number"}}
+
+        elif datatype == datetime.date:
+            return record({"year": "integer", "month": "integer", "day": "integer"})
+
+        elif datatype == datetime.datetime:
+            return record(
+                {
+                    "year": "integer",
+                    "month": "integer",
+                    "day": "integer",
+                    "hour": "integer",
+                    "minute": "integer",
+                    "second": "number",
+                }
+            )
+
+        elif datatype == datetime.timedelta:
+            # Years and months aren't fixed lengths of time, so they're not
+            # offered.
+            return record(
+                {
+                    "days": "integer",
+                    "hours": "integer",
+                    "minutes": "integer",
+                    "seconds": "number",
+                }
+            )
+
+        elif type(datatype) == list:
+            if all(isinstance(x, str) for x in datatype):
+                return {"type": "string", "enum": list(datatype)}
+            return {"enum": list(datatype)}
+
+        raise TypeError(f"Don't know the JSON schema of datatype {datatype}")
+
+    def instructions_for_my_datatype(self):
+        return Question.instructions_for_datatype(self.datatype)
+
+    @staticmethod
+    def instructions_for_datatype(datatype: Any):
+        if datatype == str:
+            return 'a JSON string (e.g. "foo")'
+
+        elif datatype == int:
+            return "an int (e.g. 5)"
+
+        elif datatype == float:
+            return "a floating-point decimal value (e.g. 123.45)"
+
+        elif datatype == List[str]:
+            return 'a JSON list of strings (e.g. ["foo", "bar", "baz"])'
+
+        elif datatype == List[int]:
+            return "a JSON list of integers (e.g. [23, 55, 777])"
+
+        elif datatype == List[float]:
+            return "a JSON list of floating-point decimal values (e.g. [23.5, 55.0, 777.777])"
+
+        elif datatype == datetime.date:
+            return 'a JSON object indicating the year, month, and day, with all values being integers and negative years indicating BC (e.g. Jan 12, 2015 would be {"year": 2015, "month": 1, "day": 12})'
+
+        elif datatype == datetime.datetime:
+            return 'a JSON object indicating the year, month, day, hour, minute, and second, with all values being integers except for seconds which are float (e.g. 4:15:00 PM on Jan 12, 2015 would be {"year": 2015, "month": 1, "day": 12, "hour": 16, "minute": 15, "second": 0.0})'
+
+        elif datatype == datetime.timedelta:
+            return 'a JSON object indicating a span of years, months, days, hours, minutes, and seconds, with all values being integers except for seconds which are float (e.g. a difference of 2 years, 3 months, and 6-and-a-half hours would be {"years": 2, "month": 3, "hours": 6, "minutes": 30, "seconds": 0.0})'
+
+        elif type(datatype) == list:
+            s = " a JSON string containing exactly one of the following values, written exactly as follows: "
+            s += ",".join([f'"{x}"' for x in datatype])
+            return s
+
+        else:
+            return "unspecified"
+
+    @staticmethod
+    def value_to_json(value: Any) -> Any:
+        # The values JSON has no type for are written as dates and datetimes
+        # in ISO 8601, and timedeltas as seconds. Everything else is left as
+        # it is.
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        elif isinstance(value, datetime.timedelta):
+            return value.total_seconds()
+        return value
+
+    @staticmethod
+    def value_from_json(value: Any, datatype: Any) -> Any:
+        # The inverse of value_to_json, for a value of the given datatype.
+        # A value that doesn't read back as one is returned as it is.
+        if value is None:
+            return None
+        try:
+            if datatype == datetime.date and isinstance(value, str):
+                return datetime.date.fromisoformat(value)
+            elif datatype == datetime.datetime and isinstance(value, str):
+                return datetime.datetime.fromisoformat(value)
+            elif datatype == datetime.timedelta and isinstance(value, (int, float)):
+                return datetime.timedelta(seconds=value)
+        except (ValueError, OverflowError):
+            pass
+        return value
+
+    @staticmethod
+    def datatype_to_string(datatype: Any) -> Optional[str]:
+        # The inverse of datatype_from_string, using the same vocabulary that
+        # determine_datatypes asks the model to choose from.
+        if datatype is None:
+            return None
+        elif datatype == str:
+            return "str"
+        elif datatype == int:
+            return "int"
+        elif datatype == float:
+            return "float"
+        elif datatype == List[str]:
+            return "List[str]"
+        elif datatype == List[int]:
+            return "List[int]"
+        elif datatype == List[float]:
+            return "List[float]"
+        elif datatype == datetime.date:
+            return "date"
+        elif datatype == datetime.datetime:
+            return "datetime"
+        elif datatype == datetime.timedelta:
+            return "timedelta"
+        elif type(datatype) == list:
+            return "enum(" + ", ".join([json.dumps(f"{x}") for x in datatype]) + ")"
+        raise TypeError(f"Don't know how to serialize datatype {datatype}")
+
+    @staticmethod
+    def datatype_from_string(s: str) -> Optional[Any]:
+        if s is None:
+            return None
+        s = f"{s}".strip()
+        if s == "str":
+            return str
+        elif s == "int":
+            return int
+        elif s == "float":
+            return float
+        elif s == "List[str]":
+            return List[str]
+        elif s == "List[int]":
+            return List[int]
+        elif s == "List[float]":
+            return List[float]
+        elif s == "date":
+            return datetime.date
+        elif s == "datetime":
+            return datetime.datetime
+        elif s == "timedelta":
+            return datetime.timedelta
+        elif s.startswith("enum(") and s.endswith(")"):
+            valueliststr = "[" + s[5:-1] + "]"
+            try:
+                return json.loads(valueliststr)
+            except ValueError:
+                return None
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "key": self.key,
+            "text": self.text,
+            "datatype": Question.datatype_to_string(self.datatype),
+            "defaultvalue": Question.value_to_json(self.defaultvalue),
+            "unitlabel": self.unitlabel,
+            "explanation": self.explanation,
+            "required": self.required,
+            "aggregation": self.aggregation,
+        }
+
+    @staticmethod
+    def create_from(
+        x: Union[
+            "Question",
+            dict,
+            str,
+            Tuple[str, str],
+            Tuple[str, dict],
+            Tuple[str, "Question"],
+        ],
+    ):
+        if isinstance(x, Question):
+            retval = Question(
+                text=x.text,
+                key=x.key,
+                datatype=x.datatype,
+                defaultvalue=x.defaultvalue,
+                unitlabel=x.unitlabel,
+                explanation=x.explanation,
+                required=x.required,
+                aggregation=x.aggregation,
+            )
+            return retval
+
+        if type(x) == dict:
+            datatype = x.get("datatype")
+            if type(datatype) == str:
+                # Serialized form, e.g. from a schema file.
+                datatype = Question.datatype_from_string(datatype)
+            retval = Question(
+                text=x.get("text") or "",
+                key=x.get("key") or "",
+                datatype=datatype,
+                defaultvalue=Question.value_from_json(x.get("defaultvalue"), datatype),
+                unitlabel=x.get("unitlabel") or "",
+                explanation=x.get("explanation") or "",
+                required=x.get("required") or False,
+                aggregation=x.get("aggregation") or "",
+            )
+            return retval
+
+        if type(x) == tuple:
+            questionkey = x[0]
+            questionvalue = x[1]
+            if type(questionvalue) == str:
+                retval = Question(key=questionkey, text=questionvalue)
+                return retval
+            else:
+                retval = Question.create_from(questionvalue)
+                retval.key = questionkey
+                return retval
+
+        if type(x) == str:
+            key, text = x.split(":", maxsplit=1)
+            retval = Question(
+                key=key,
+                text=text,
+            )
+            return retval
+
+        raise TypeError("Unrecognized type passed to Question.create_from")
+
+    @staticmethod
+    def create_collection(questions: Union[List[Any], Dict[str, Any]]):
+        if questions is None:
+            return []
+
+        if type(questions) == str or isinstance(questions, Question):
+            # We've been given a single instance instead of a collection.
+            questions = [questions]
+
+        if type(questions) == dict:
+            questions = [
+                (questionkey, questiontext)
+                for (questionkey, questiontext) in questions.items()
+            ]
+
+        retval = []
+        for i, question in enumerate(questions):
+            if type(question) == str:
+                question = (f"question_{i + 1}", question)
+            qobj = Question.create_from(question)
+            retval.append(qobj)
+        return retval
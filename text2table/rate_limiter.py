@@ -0,0 +1,176 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+from typing import Any, Dict, Iterable, Optional, Union
+
+
+def estimate_prompt_tokens(messages: Union[str, Iterable]) -> int:
+    # A cheap, tokenizer-free estimate. English text averages a bit under four
+    # characters per token, and every chat message carries a few tokens of
+    # framing on top of its content.
+    if type(messages) == str:
+        messages = [{"role": "user", "content": messages}]
+    total = 3
+    for m in messages:
+        total += 4 + len(f"{m.get('content', '')}") // 4
+    return total
+
+
+def compute_backoff(
+    attempt: int,
+    *,
+    base: float = 1.0,
+    cap: float = 60.0,
+    retry_after: Optional[float] = None,
+) -> float:
+    # Exponential backoff with "full jitter", so that many workers that all
+    # got throttled at once don't all come back at once. If the server told
+    # us how long to wait, we wait at least that long.
+    delay = random.uniform(0, min(cap, base * (2**attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # Retry-After is also allowed to be an HTTP date.
+        when = email.utils.parsedate_to_datetime(value)
+        return max(0.0, when.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, *, period: float = 60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # A single request bigger than the whole bucket would otherwise wait
+        # forever, so it's allowed through once the bucket is full.
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    # Shared by every call that goes to the same account/endpoint. Holds one
+    # bucket for requests per minute and one for tokens per minute, and a
+    # "paused until" time that a 429 from the server can push out for
+    # everybody at once.
+
+    def __init__(
+        self,
+        *,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        expected_output_tokens: int = 512,
+    ):
+        self.requests = (
+            TokenBucket(requests_per_minute) if requests_per_minute else None
+        )
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.expected_output_tokens = expected_output_tokens
+        self.paused_until = 0.0
+
+        self.throttled_count = 0
+        self.waited_seconds = 0.0
+
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "RateLimiter":
+        return RateLimiter(**config)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "requests_per_minute": self.requests.capacity if self.requests else None,
+            "tokens_per_minute": self.tokens.capacity if self.tokens else None,
+            "expected_output_tokens": self.expected_output_tokens,
+        }
+
+    def estimate_tokens(self, messages: Union[str, Iterable]) -> int:
+        return estimate_prompt_tokens(messages) + self.expected_output_tokens
+
+    def _try_acquire(self, tokens: int) -> float:
+        # Either takes capacity from both buckets and returns 0, or takes
+        # nothing and returns how long the caller should wait before retrying.
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+
+            if self.requests is not None:
+                self.requests.level -= 1
+            if self.tokens is not None:
+                self.tokens.level -= min(tokens, self.tokens.capacity)
+            return 0.0
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            self.waited_seconds += wait
+            time.sleep(wait)
+
+    async def async_acquire(self, tokens: int = 0):
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            self.waited_seconds += wait
+            await asyncio.sleep(wait)
+
+    def settle(self, estimated_tokens: int, usage: Any):
+        # Once the real usage is known, give back (or take) the difference
+        # between what we reserved and what the call actually cost.
+        if self.tokens is None or usage is None:
+            return
+        actual = getattr(usage, "total_tokens", None)
+        if actual is None:
+            return
+        with self._lock:
+            self.tokens.level = min(
+                self.tokens.capacity, self.tokens.level + estimated_tokens - actual
+            )
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.throttled_count += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+
+class ResponseCache:
+    # A content-addressed store of chat completions, backed by SQLite so that
+    # it can be shared by several threads and processes on the same host.
+    # Only deterministic (temperature=0) replies should ever be put in here.
+
+    def __init__(
+        self,
+        path: str = "text2table-cache.sqlite3",
+        *,
+        max_bytes: Optional[int] = 512 * 1024 * 1024,
+        max_age_seconds: Optional[float] = 30 * 24 * 60 * 60,
+        evict_every: int = 256,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT NOT NULL,"
+                " reply TEXT NOT NULL,"
+                " nbytes INTEGER NOT NULL,"
+                " created REAL NOT NULL,"
+                " accessed REAL NOT NULL"
+                ")"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)"
+            )
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "ResponseCache":
+        config = dict(config)
+        return ResponseCache(config.pop("path"), **config)
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "max_bytes": self.max_bytes,
+            "max_age_seconds": self.max_age_seconds,
+            "evict_every": self.evict_every,
+        }
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must not be shared between threads, so each
+        # thread gets its own. WAL mode lets readers in other processes carry
+        # on while one process is writing.
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def normalize_messages(messages: Union[str, Iterable]) -> List[Dict[str, str]]:
+        if type(messages) == str:
+            messages = [{"role": "user", "content": messages}]
+        return [
+            {
+                "role": f"{m.get('role', '')}",
+                "content": f"{m.get('content', '')}".strip(),
+            }
+            for m in messages
+        ]
+
+    @staticmethod
+    def make_key(model: str, messages: Union[str, Iterable], **params: Any) -> str:
+        payload = {
+            "model": model,
+            "messages": ResponseCache.normalize_messages(messages),
+            "params": params,
+        }
+        s = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT reply, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+
+        now = time.time()
+        if row is not None and self.max_age_seconds is not None:
+            if now - row[1] > self.max_age_seconds:
+                row = None
+
+        with self._counter_lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if row is None:
+            return None
+
+        with conn:
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, key: str, reply: str, *, model: str = ""):
+        if reply is None:
+            return
+
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (key, model, reply, nbytes, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, reply, len(reply.encode("utf-8")), now, now),
+            )
+
+        with self._counter_lock:
+            self.writes += 1
+            should_evict = self.evict_every and self.writes % self.evict_every == 0
+        if should_evict:
+            self.evict()
+
+    def evict(self):
+        conn = self._connection()
+        with conn:
+            if self.max_age_seconds is not None:
+                cutoff = time.time() - self.max_age_seconds
+                conn.execute("DELETE FROM responses WHERE created < ?", (cutoff,))
+
+            if self.max_bytes is not None:
+                total = conn.execute(
+                    "SELECT COALESCE(SUM(nbytes), 0) FROM responses"
+                ).fetchone()[0]
+                if total > self.max_bytes:
+                    # Drop least-recently-used entries until we're back under
+                    # the limit.
+                    excess = total - self.max_bytes
+                    rows = conn.execute(
+                        "SELECT key, nbytes FROM responses ORDER BY accessed ASC"
+                    )
+                    doomed = []
+                    for key, nbytes in rows:
+                        if excess <= 0:
+                            break
+                        doomed.append((key,))
+                        excess -= nbytes
+                    conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, Any]:
+        conn = self._connection()
+        count, nbytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM responses"
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "entries": count,
+            "bytes": nbytes,
+        }
@@ -0,0 +1,433 @@
+import array
+import csv
+import datetime
+import json
+
+from .question import Question
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+
+def _import_pyarrow():
+    # pyarrow is only needed for Arrow/Parquet output, so we don't make
+    # everybody install it.
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError(
+            "Arrow and Parquet output require pyarrow (pip install pyarrow)"
+        ) from e
+    return pyarrow
+
+
+class Column:
+    # Holds arbitrary Python objects. The base for the more compact column
+    # types below, and the fallback for datatypes that have no better
+    # representation (str, dates, or no datatype at all).
+
+    def __init__(self, name: str, datatype: Any = None):
+        self.name = name
+        self.datatype = datatype
+        self.values = []
+
+    def append(self, value: Any):
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i: int) -> Any:
+        return self.values[i]
+
+    def to_pylist(self) -> List[Any]:
+        return [self[i] for i in range(len(self))]
+
+    def clear(self):
+        self.values = []
+
+    def arrow_type(self, pa):
+        if self.datatype == datetime.date:
+            return pa.date32()
+        elif self.datatype == datetime.datetime:
+            return pa.timestamp("us")
+        elif self.datatype == datetime.timedelta:
+            return pa.duration("us")
+        return pa.string()
+
+    def to_arrow(self, pa):
+        values = self.values
+        if self.arrow_type(pa) == pa.string():
+            values = [None if v is None else f"{v}" for v in values]
+        return pa.array(values, type=self.arrow_type(pa))
+
+
+class NumericColumn(Column):
+    # Packed machine numbers plus a validity mask, instead of one boxed
+    # Python int or float per cell.
+
+    def __init__(self, name: str, datatype: Any):
+        super().__init__(name, datatype)
+        self.typecode = "q" if datatype == int else "d"
+        self.values = array.array(self.typecode)
+        self.valid = bytearray()
+
+    def append(self, value: Any):
+        try:
+            value = int(value) if self.typecode == "q" else float(value)
+            is_valid = 1
+        except (TypeError, ValueError, OverflowError):
+            value = 0
+            is_valid = 0
+        self.values.append(value)
+        self.valid.append(is_valid)
+
+    def __getitem__(self, i: int) -> Any:
+        return self.values[i] if self.valid[i] else None
+
+    def clear(self):
+        self.values = array.array(self.typecode)
+        self.valid = bytearray()
+
+    def arrow_type(self, pa):
+        return pa.int64() if self.typecode == "q" else pa.float64()
+
+    def to_arrow(self, pa):
+        mask = pa.array([not v for v in self.valid], type=pa.bool_())
+        return pa.array(self.values, type=self.arrow_type(pa), mask=mask)
+
+
+class EnumColumn(Column):
+    # Dictionary-encoded: each cell is a small integer index into the list of
+    # allowed values, with -1 for a missing value. The question's default
+    # value is added to the list up front if it isn't one of the options, so
+    # that the list is normally fixed before the first row; anything else
+    # that turns up is appended to it, and categories are never removed or
+    # reordered.
+
+    def __init__(self, name: str, datatype: List[str], defaultvalue: Any = None):
+        super().__init__(name, datatype)
+        self.categories = [f"{x}" for x in datatype]
+        if defaultvalue is not None and f"{defaultvalue}" not in self.categories:
+            self.categories.append(f"{defaultvalue}")
+        self.category_index = {x: i for i, x in enumerate(self.categories)}
+        self.values = array.array("h")
+
+    def append(self, value: Any):
+        if value is None:
+            self.values.append(-1)
+            return
+        value = f"{value}"
+        code = self.category_index.get(value)
+        if code is None:
+            # Shouldn't happen, since coercion rejects unknown values.
+            code = len(self.categories)
+            self.categories.append(value)
+            self.category_index[value] = code
+        self.values.append(code)
+
+    def __getitem__(self, i: int) -> Any:
+        code = self.values[i]
+        return None if code < 0 else self.categories[code]
+
+    def clear(self):
+        self.values = array.array("h")
+
+    def arrow_type(self, pa):
+        return pa.dictionary(pa.int16(), pa.string())
+
+    def to_arrow(self, pa):
+        indices = pa.array(
+            self.values, type=pa.int16(), mask=pa.array([c < 0 for c in self.values])
+        )
+        return pa.DictionaryArray.from_arrays(
+            indices, pa.array(self.categories, type=pa.string())
+        )
+
+
+class ListColumn(Column):
+    # Arrow-style list layout: one flat child column holding every element of
+    # every list, and an offsets array marking where each cell's list starts.
+
+    def __init__(self, name: str, datatype: Any):
+        super().__init__(name, datatype)
+        if datatype == List[int]:
+            self.child = NumericColumn(name, int)
+        elif datatype == List[float]:
+            self.child = NumericColumn(name, float)
+        else:
+            self.child = Column(name, str)
+        self.offsets = array.array("q", [0])
+        self.valid = bytearray()
+
+    def append(self, value: Any):
+        if isinstance(value, (list, tuple)):
+            for x in value:
+                self.child.append(x)
+            self.valid.append(1)
+        else:
+            self.valid.append(0)
+        self.offsets.append(len(self.child))
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, i: int) -> Any:
+        if not self.valid[i]:
+            return None
+        return [self.child[j] for j in range(self.offsets[i], self.offsets[i + 1])]
+
+    def clear(self):
+        self.child.clear()
+        self.offsets = array.array("q", [0])
+        self.valid = bytearray()
+
+    def arrow_type(self, pa):
+        return pa.list_(self.child.arrow_type(pa))
+
+    def to_arrow(self, pa):
+        offsets = pa.array(self.offsets, type=pa.int32())
+        lists = pa.ListArray.from_arrays(
+            offsets,
+            self.child.to_arrow(pa),
+            mask=pa.array([not v for v in self.valid], type=pa.bool_()),
+        )
+        return lists
+
+
+def make_column(name: str, datatype: Any, defaultvalue: Any = None) -> Column:
+    if datatype == int or datatype == float:
+        return NumericColumn(name, datatype)
+    elif datatype in (List[int], List[float], List[str]):
+        return ListColumn(name, datatype)
+    elif type(datatype) == list:
+        return EnumColumn(name, datatype, defaultvalue)
+    return Column(name, datatype)
+
+
+class ResultTable:
+    # Extraction results stored column by column, with each column's type
+    # taken from its Question. Also usable as a sink for async_iter_text2table.
+
+    ID_COLUMN = "document_id"
+
+    def __init__(self, questions: Optional[List[Question]] = None):
+        self.questions = []
+        self.ids = Column(ResultTable.ID_COLUMN, str)
+        self.columns: Dict[str, Column] = {}
+        if questions is not None:
+            self.set_questions(questions)
+
+    def set_questions(self, questions: List[Question]):
+        if len(self):
+            raise ValueError("Can't change the columns of a table that has rows")
+        self.questions = list(questions)
+        self.columns = {
+            q.key: make_column(q.key, q.datatype, q.defaultvalue) for q in questions
+        }
+
+    @property
+    def column_names(self) -> List[str]:
+        return [ResultTable.ID_COLUMN] + list(self.columns.keys())
+
+    def write_row(self, document_id: str, answers: Dict[str, Any]):
+        self.ids.append(document_id)
+        for key, column in self.columns.items():
+            column.append(answers.get(key))
+
+    def flush(self):
+        pass
+
+    def __len__(self):
+        return len(self.ids)
+
+    def column(self, key: str) -> List[Any]:
+        if key == ResultTable.ID_COLUMN:
+            return self.ids.to_pylist()
+        return self.columns[key].to_pylist()
+
+    def row(self, i: int) -> Tuple[str, Dict[str, Any]]:
+        return self.ids[i], {key: c[i] for key, c in self.columns.items()}
+
+    def rows(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for i in range(len(self)):
+            yield self.row(i)
+
+    def to_dict(self) -> Dict[str, Dict[str, Any]]:
+        return dict(self.rows())
+
+    def clear(self):
+        self.ids.clear()
+        for column in self.columns.values():
+            column.clear()
+
+    def arrow_schema(self):
+        pa = _import_pyarrow()
+        fields = [pa.field(ResultTable.ID_COLUMN, pa.string())]
+        fields += [pa.field(key, c.arrow_type(pa)) for key, c in self.columns.items()]
+        return pa.schema(fields)
+
+    def to_arrow(self):
+        pa = _import_pyarrow()
+        arrays = [self.ids.to_arrow(pa)]
+        arrays += [c.to_arrow(pa) for c in self.columns.values()]
+        return pa.Table.from_arrays(arrays, schema=self.arrow_schema())
+
+
+class TableWriter:
+    # Buffers rows in a ResultTable and writes them out one row group at a
+    # time, so that memory use is bounded by row_group_size rather than by the
+    # size of the job.
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        questions: Optional[List[Question]] = None,
+        row_group_size: int = 10000,
+    ):
+        self.path = path
+        self.row_group_size = max(1, row_group_size)
+        self.buffer = ResultTable(questions)
+        self.rows_written = 0
+        self.closed = False
+
+    def set_questions(self, questions: List[Question]):
+        if self.rows_written:
+            raise ValueError("Can't change the columns once rows have been written")
+        self.buffer.set_questions(questions)
+
+    def write_row(self, document_id: str, answers: Dict[str, Any]):
+        self.buffer.write_row(document_id, answers)
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not len(self.buffer):
+            return
+        self._write_row_group(self.buffer)
+        self.rows_written += len(self.buffer)
+        self.buffer.clear()
+
+    def _write_row_group(self, table: ResultTable):
+        raise NotImplementedError()
+
+    def _close_file(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self._close_file()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CsvTableWriter(TableWriter):
+    def __init__(self, path: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self._file = None
+        self._writer = None
+
+    def _write_row_group(self, table: ResultTable):
+        if self._file is None:
+            self._file = open(self.path, "w", newline="", encoding="utf-8")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(table.column_names)
+
+        for docid, answers in table.rows():
+            row = [docid]
+            for key in table.columns:
+                value = answers.get(key)
+                if value is None:
+                    value = ""
+                elif isinstance(value, (list, dict)):
+                    value = json.dumps(value, ensure_ascii=False)
+                row.append(value)
+            self._writer.writerow(row)
+        self._file.flush()
+
+    def _close_file(self):
+        if self._file is None:
+            # No rows at all; still produce a file with a header.
+            with open(self.path, "w", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerow(self.buffer.column_names)
+            return
+        self._file.close()
+        self._file = None
+
+
+class ParquetTableWriter(TableWriter):
+    def __init__(self, path: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self._writer = None
+
+    def _open(self, table: ResultTable):
+        _import_pyarrow()
+        import pyarrow.parquet
+
+        self._writer = pyarrow.parquet.ParquetWriter(self.path, table.arrow_schema())
+
+    def _write_row_group(self, table: ResultTable):
+        if self._writer is None:
+            self._open(table)
+        self._writer.write_table(table.to_arrow())
+
+    def _close_file(self):
+        if self._writer is None:
+            self._open(self.buffer)
+        self._writer.close()
+        self._writer = None
+
+
+class ArrowIpcTableWriter(TableWriter):
+    # An Arrow IPC file can't replace an enum column's dictionary partway
+    # through, but it can extend it, which is all an EnumColumn ever does to
+    # its categories; so a category that first turns up after the first row
+    # group is written as a dictionary delta.
+
+    def __init__(self, path: str, **kwargs):
+        super().__init__(path, **kwargs)
+        self._sink = None
+        self._writer = None
+        self._categories_written: Dict[str, List[str]] = {}
+
+    def _open(self, table: ResultTable):
+        pa = _import_pyarrow()
+        self._sink = pa.OSFile(self.path, "wb")
+        self._writer = pa.ipc.new_file(
+            self._sink,
+            table.arrow_schema(),
+            options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True),
+        )
+
+    def _check_categories(self, table: ResultTable):
+        for key, column in table.columns.items():
+            if not isinstance(column, EnumColumn):
+                continue
+            written = self._categories_written.get(key, [])
+            if column.categories[: len(written)] != written:
+                raise ValueError(
+                    f"The categories of column {key} changed after rows were "
+                    "written; they can only be added to"
+                )
+            self._categories_written[key] = list(column.categories)
+
+    def _write_row_group(self, table: ResultTable):
+        if self._writer is None:
+            self._open(table)
+        self._check_categories(table)
+        self._writer.write_table(table.to_arrow())
+
+    def _close_file(self):
+        if self._writer is None:
+            self._open(self.buffer)
+        self._writer.close()
+        self._sink.close()
+        self._writer = None
+        self._sink = None
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from .question import Question
+
+from typing import Any, Dict, List, Optional
+
+
+class SchemaCache:
+    # Remembers what determine_datatypes inferred for each question, keyed by
+    # a fingerprint of everything that went into the inference. The contents
+    # can be written out as a plain JSON schema file and loaded back in by a
+    # later run or by a worker process.
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.import_schema(path)
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "SchemaCache":
+        return SchemaCache(**config)
+
+    def to_config(self) -> Dict[str, Any]:
+        # Entries that haven't been exported to the path aren't included.
+        return {"path": self.path}
+
+    @staticmethod
+    def fingerprint(question: Question, document_description: Optional[str] = None):
+        if type(document_description) == tuple:
+            document_description = document_description[0]
+
+        # The fingerprint covers the question as the user wrote it, before any
+        # inference has filled in the blanks. Editing the text, the key, or a
+        # hand-specified datatype therefore invalidates the entry.
+        payload = {
+            "key": question.key,
+            "text": question.text,
+            "datatype": Question.datatype_to_string(question.datatype),
+            "required": question.required,
+            "document_description": document_description or "",
+        }
+        s = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self.entries.get(fingerprint)
+
+    def put(self, fingerprint: str, question: Question):
+        with self._lock:
+            self.entries[fingerprint] = question.to_dict()
+
+    @staticmethod
+    def apply(question: Question, entry: Dict[str, Any]) -> Question:
+        # Like apply_datatypes_reply, only fill in what the user left blank.
+        if not question.datatype:
+            question.datatype = Question.datatype_from_string(entry.get("datatype"))
+        if not question.unitlabel:
+            question.unitlabel = entry.get("unitlabel") or ""
+        if question.defaultvalue is None:
+            # Stored as Question.to_dict writes it, so a date's default is a
+            # string until it's read back as one.
+            question.defaultvalue = Question.value_from_json(
+                entry.get("defaultvalue"), question.datatype
+            )
+        if not question.explanation:
+            question.explanation = entry.get("explanation") or ""
+        question.check_aggregation()
+        return question
+
+    def export_schema(self, path: Optional[str] = None):
+        path = path or self.path
+        if not path:
+            raise ValueError("No path given to export the schema to")
+
+        with self._lock:
+            data = {"version": SchemaCache.FORMAT_VERSION, "entries": self.entries}
+            s = json.dumps(data, indent=2, sort_keys=True, ensure_ascii=False)
+
+        # Write to a temp file and rename it into place, so that a worker
+        # process reading the schema never sees a half-written file.
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(s)
+            os.replace(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def import_schema(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("version") != SchemaCache.FORMAT_VERSION:
+            raise ValueError(f"Unsupported schema file version: {data.get('version')}")
+
+        with self._lock:
+            self.entries.update(data.get("entries") or {})
+
+    def save(self):
+        if self.path:
+            self.export_schema(self.path)
+
+    def questions(self) -> List[Question]:
+        with self._lock:
+            return [Question.create_from(entry) for entry in self.entries.values()]
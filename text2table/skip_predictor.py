@@ -0,0 +1,232 @@
+import json
+import math
+import os
+import random
+import re
+import tempfile
+import threading
+import zlib
+
+from .document import Document
+
+from typing import Any, Dict, List, Optional
+
+
+class SkipPredictor:
+    # A tiny per-question logistic regression over hashed bag-of-words
+    # features, trained online on the outcomes of real extraction calls. Once
+    # it has seen enough examples for a question, it can predict that the
+    # answer will come back OFFTOPIC/ABSENT, and the cell can be skipped
+    # without calling the model at all.
+    #
+    # A fraction of the cells it would skip (audit_rate) get asked anyway,
+    # so that we can measure how often a skip would have lost a real answer.
+
+    ASK = "ask"
+    SKIP = "skip"
+    AUDIT = "audit"
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        threshold: float = 0.95,
+        audit_rate: float = 0.05,
+        min_examples: int = 200,
+        num_buckets: int = 1 << 18,
+        learning_rate: float = 0.1,
+        l2: float = 1e-6,
+        max_words: int = 2000,
+        seed: Optional[int] = None,
+    ):
+        self.path = path
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.min_examples = min_examples
+        self.num_buckets = num_buckets
+        self.learning_rate = learning_rate
+        self.l2 = l2
+        self.max_words = max_words
+
+        # Per question key: {"bias": float, "weights": {bucket: float},
+        # "examples": int, "absent": int}
+        self.models: Dict[str, Dict[str, Any]] = {}
+
+        self.skipped = 0
+        self.audited = 0
+        self.audit_misses = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @staticmethod
+    def from_config(config: Dict[str, Any]) -> "SkipPredictor":
+        config = dict(config)
+        return SkipPredictor(config.pop("path"), **config)
+
+    def to_config(self) -> Dict[str, Any]:
+        # The model itself goes by way of the path: whatever was last saved
+        # there is loaded by from_config.
+        return {
+            "path": self.path,
+            "threshold": self.threshold,
+            "audit_rate": self.audit_rate,
+            "min_examples": self.min_examples,
+            "num_buckets": self.num_buckets,
+            "learning_rate": self.learning_rate,
+            "l2": self.l2,
+            "max_words": self.max_words,
+        }
+
+    def features(self, document: Document) -> List[int]:
+        # crc32 rather than hash(), because hash() of a str is salted per
+        # process and the model has to mean the same thing across runs.
+        text = f"{document.description}\n{document.body}".lower()
+        words = re.findall(r"[a-z0-9']+", text)[: self.max_words]
+        grams = set(words)
+        grams.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+        return sorted(
+            set(zlib.crc32(g.encode("utf-8")) % self.num_buckets for g in grams)
+        )
+
+    def _model(self, question_key: str) -> Dict[str, Any]:
+        model = self.models.get(question_key)
+        if model is None:
+            model = {"bias": 0.0, "weights": {}, "examples": 0, "absent": 0}
+            self.models[question_key] = model
+        return model
+
+    @staticmethod
+    def _sigmoid(z: float) -> float:
+        if z >= 0:
+            return 1.0 / (1.0 + math.exp(-z))
+        ez = math.exp(z)
+        return ez / (1.0 + ez)
+
+    def _score(self, model: Dict[str, Any], features: List[int]) -> float:
+        weights = model["weights"]
+        z = model["bias"] + sum(weights.get(f, 0.0) for f in features)
+        return self._sigmoid(z)
+
+    def probability_absent(self, question_key: str, document: Document) -> float:
+        with self._lock:
+            model = self.models.get(question_key)
+            if model is None:
+                return 0.0
+            return self._score(model, self.features(document))
+
+    def observe(self, question_key: str, document: Document, absent: bool):
+        # One step of SGD on the log loss for this example.
+        features = self.features(document)
+        with self._lock:
+            model = self._model(question_key)
+            error = (1.0 if absent else 0.0) - self._score(model, features)
+            step = self.learning_rate * error
+
+            # Features are binary and all equally scaled, so normalize the
+            # step by their count to keep long documents from dominating.
+            feature_step = step / max(1.0, math.sqrt(len(features)))
+            weights = model["weights"]
+            for f in features:
+                w = weights.get(f, 0.0)
+                weights[f] = w + feature_step - self.learning_rate * self.l2 * w
+            model["bias"] += step
+
+            model["examples"] += 1
+            if absent:
+                model["absent"] += 1
+
+    def decide(self, question_key: str, document: Document) -> str:
+        # Returns ASK when the predictor isn't trained yet or isn't confident,
+        # SKIP when it's confident the answer is absent, and AUDIT when it's
+        # confident but this cell was picked to be asked anyway.
+        with self._lock:
+            model = self.models.get(question_key)
+            if model is None or model["examples"] < self.min_examples:
+                return SkipPredictor.ASK
+        if self.probability_absent(question_key, document) < self.threshold:
+            return SkipPredictor.ASK
+
+        with self._lock:
+            if self._random.random() < self.audit_rate:
+                self.audited += 1
+                return SkipPredictor.AUDIT
+            self.skipped += 1
+            return SkipPredictor.SKIP
+
+    def record_audit(self, absent: bool):
+        # Called with the real outcome of an AUDIT cell.
+        if not absent:
+            with self._lock:
+                self.audit_misses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        # audit_precision is the fraction of audited would-be skips that
+        # really were absent; 1 - audit_precision estimates how many skipped
+        # cells had a real answer that we missed.
+        with self._lock:
+            return {
+                "skipped": self.skipped,
+                "audited": self.audited,
+                "audit_misses": self.audit_misses,
+                "audit_precision": (
+                    (self.audited - self.audit_misses) / self.audited
+                    if self.audited
+                    else None
+                ),
+                "examples": {k: m["examples"] for k, m in self.models.items()},
+            }
+
+    def save(self, path: Optional[str] = None):
+        path = path or self.path
+        if not path:
+            raise ValueError("No path given to save the skip predictor to")
+
+        with self._lock:
+            data = {
+                "num_buckets": self.num_buckets,
+                "models": {
+                    key: {
+                        "bias": m["bias"],
+                        "examples": m["examples"],
+                        "absent": m["absent"],
+                        "weights": {str(f): w for f, w in m["weights"].items()},
+                    }
+                    for key, m in self.models.items()
+                },
+            }
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmppath = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def load(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        if data.get("num_buckets") != self.num_buckets:
+            raise ValueError(
+                f"{path} was trained with {data.get('num_buckets')} buckets, "
+                f"not {self.num_buckets}"
+            )
+
+        with self._lock:
+            self.models = {
+                key: {
+                    "bias": m["bias"],
+                    "examples": m["examples"],
+                    "absent": m["absent"],
+                    "weights": {int(f): w for f, w in m["weights"].items()},
+                }
+                for key, m in data.get("models", {}).items()
+            }
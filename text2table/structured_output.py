@@ -0,0 +1,232 @@
+import json
+
+from .question import Question
+
+from typing import Any, Dict, List, Optional
+
+# A compact alternative to the Markdown answer format. Instead of writing out
+# RELEVANCE, AVAILABILITY, COMPUTATION, DISCUSSION and ANSWER sections, the
+# model fills in a JSON object of the form
+#
+#     {"reasoning": ..., "relevance": ..., "availability": ..., "answer": ...}
+#
+# whose answer field has a JSON schema built from the question's datatype, so
+# an enum comes back as one of its values and a List[int] as an array of
+# integers. The object is requested through the response_format parameter
+# ("json_schema" or "json_object" mode) or as the arguments of a forced
+# function call ("function" mode). The reply is a small fraction of the
+# length of a Markdown one, and reading it is a single json.loads.
+#
+# The reasoning field is there because a model that explains itself first
+# answers better; how much it writes is the reasoning level: "none" leaves
+# the field out, "brief" asks for a sentence or two, and "full" asks it to
+# work the problem through, like the Markdown format's COMPUTATION and
+# DISCUSSION sections.
+#
+# Replies are stored, cached and journaled as the JSON text, and the answer
+# parsing in core tells them apart from Markdown ones by their opening
+# brace.
+
+REASONING_LEVELS = ("none", "brief", "full")
+ANSWER_MODES = ("json_schema", "json_object", "function")
+
+RELEVANCE_VERDICTS = ["RELEVANT", "OFFTOPIC"]
+AVAILABILITY_VERDICTS = ["STATED", "IMPLIED", "ABSENT"]
+
+# Roughly how long a reply runs, per question, at each reasoning level.
+OUTPUT_TOKENS_PER_QUESTION = {"none": 30, "brief": 80, "full": 300}
+
+# What the schema (or the function) is called in the request.
+SCHEMA_NAME = "record_answer"
+
+_REASONING_INSTRUCTIONS = {
+    "brief": "one or two sentences on where in the document the answer comes from, or why it can't be found there",
+    "full": "your reasoning process: whether the desired information is relevant to the document and present in it, any counting, enumeration or calculation the problem requires, and arguments about why the answer might be one thing or another",
+}
+
+
+def is_structured_reply(gpt_output: Any) -> bool:
+    # Markdown replies open with a header, never with a brace.
+    return isinstance(gpt_output, str) and gpt_output.lstrip().startswith("{")
+
+
+def parse_structured_reply(gpt_output: str) -> Dict[str, Any]:
+    # Returns the reply's fields, or raises ValueError if it isn't a JSON
+    # object with one valid verdict of each kind.
+    reply = json.loads(gpt_output)
+    if not isinstance(reply, dict):
+        raise ValueError("A structured reply must be a JSON object")
+    if reply.get("relevance") not in RELEVANCE_VERDICTS:
+        raise ValueError(f"Bad relevance in reply: {reply.get('relevance')!r}")
+    if reply.get("availability") not in AVAILABILITY_VERDICTS:
+        raise ValueError(f"Bad availability in reply: {reply.get('availability')!r}")
+    return reply
+
+
+def split_structured_multi_question_output(
+    gpt_output: Optional[str], questions: List[Question]
+) -> Dict[str, Optional[str]]:
+    # The structured counterpart of split_multi_question_output: cuts a
+    # reply to several questions into one single-question reply each.
+    # Questions the model skipped come back as None.
+    retval = {q.key: None for q in questions}
+    if not gpt_output:
+        return retval
+    try:
+        reply = json.loads(gpt_output)
+    except ValueError:
+        return retval
+    if not isinstance(reply, dict):
+        return retval
+    for q in questions:
+        if isinstance(reply.get(q.key), dict):
+            retval[q.key] = json.dumps(reply[q.key], ensure_ascii=False)
+    return retval
+
+
+class StructuredOutput:
+    def __init__(
+        self, *, mode: str = "function", reasoning: str = "brief", strict: bool = False
+    ):
+        # "function" and "json_object" work with any model that can call
+        # functions; "json_schema" needs one with Structured Outputs. With
+        # strict, the API guarantees that the reply matches the schema,
+        # which also needs a model with Structured Outputs.
+        if mode not in ANSWER_MODES:
+            raise ValueError(
+                f"Unknown answer mode {mode!r}; expected one of {ANSWER_MODES}"
+            )
+        if reasoning not in REASONING_LEVELS:
+            raise ValueError(
+                f"Unknown reasoning level {reasoning!r}; expected one of {REASONING_LEVELS}"
+            )
+        self.mode = mode
+        self.reasoning = reasoning
+        self.strict = strict
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "reasoning": self.reasoning, "strict": self.strict}
+
+    def expected_output_tokens(self, question_count: int = 1) -> int:
+        return OUTPUT_TOKENS_PER_QUESTION[self.reasoning] * max(1, question_count)
+
+    def answer_schema(self, question: Question) -> Dict[str, Any]:
+        # The object one question is answered with. Properties are listed in
+        # the order the model should fill them in, reasoning first. A
+        # required question's answer can't be null.
+        answer = question.json_schema_for_my_datatype()
+        if not question.required:
+            answer = {"anyOf": [answer, {"type": "null"}]}
+        properties = {}
+        if self.reasoning != "none":
+            properties["reasoning"] = {"type": "string"}
+        properties["relevance"] = {"type": "string", "enum": RELEVANCE_VERDICTS}
+        properties["availability"] = {"type": "string", "enum": AVAILABILITY_VERDICTS}
+        properties["answer"] = answer
+        return {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False,
+        }
+
+    def reply_schema(
+        self, questions: List[Question], *, multi_question: bool = False
+    ) -> Dict[str, Any]:
+        # A single question's reply is its answer object; a multi-question
+        # reply holds one answer object per question key.
+        if not multi_question:
+            return self.answer_schema(questions[0])
+        return {
+            "type": "object",
+            "properties": {q.key: self.answer_schema(q) for q in questions},
+            "required": [q.key for q in questions],
+            "additionalProperties": False,
+        }
+
+    def completion_options(
+        self, questions: List[Question], *, multi_question: bool = False
+    ) -> Dict[str, Any]:
+        # The extra arguments to chat.completions.create that ask for the
+        # reply in this format.
+        schema = self.reply_schema(questions, multi_question=multi_question)
+        if self.mode == "json_object":
+            # JSON mode doesn't take a schema; the prompt carries it.
+            return {"response_format": {"type": "json_object"}}
+        if self.mode == "json_schema":
+            return {
+                "response_format": {
+                    "type": "json_schema",
+                    "json_schema": {
+                        "name": SCHEMA_NAME,
+                        "schema": schema,
+                        "strict": self.strict,
+                    },
+                }
+            }
+        function = {"name": SCHEMA_NAME, "parameters": schema}
+        if self.strict:
+            function["strict"] = True
+        return {
+            "tools": [{"type": "function", "function": function}],
+            "tool_choice": {"type": "function", "function": {"name": SCHEMA_NAME}},
+        }
+
+    def _field_instructions(self) -> str:
+        s = ""
+        if self.reasoning != "none":
+            s += f'- "reasoning": {_REASONING_INSTRUCTIONS[self.reasoning]}.\n'
+        s += '- "relevance": whether or not the desired piece of information is relevant to the subject matter of the document: either "RELEVANT" (it\'s relevant) or "OFFTOPIC" (it\'s off-topic).\n'
+        s += '- "availability": whether or not the desired information is present in the document: "STATED" (the information is explicitly stated in the document), "IMPLIED" (the information is implied by other content in the document), or "ABSENT" (the information cannot be determined from the document).\n'
+        s += '- "answer": your final answer, in the form the schema gives for it, or null if the information is off-topic or absent.\n'
+        return s
+
+    def _reply_instructions(self) -> str:
+        if self.mode == "function":
+            return f"Reply by calling the {SCHEMA_NAME} function"
+        return "Reply with a JSON object"
+
+    def _schema_instructions(
+        self, questions: List[Question], *, multi_question: bool
+    ) -> str:
+        # Only JSON mode needs to be told the schema; otherwise it goes
+        # along with the request.
+        if self.mode != "json_object":
+            return ""
+        schema = self.reply_schema(questions, multi_question=multi_question)
+        return f"The JSON object must match this JSON schema: {json.dumps(schema)}\n\n"
+
+    def systemprompt(self, question: Question) -> str:
+        systemprompt = f"""
+I will present a short document to you. You will read this document and then extract a single piece of information from that document.
+
+The piece of information I'd like you to extract is: {question.text}
+
+{self._reply_instructions()}, with the following fields, in this order:
+{self._field_instructions()}
+"""
+        systemprompt += self._schema_instructions([question], multi_question=False)
+        if question.required:
+            systemprompt += "It is mandatory that you provide *some* answer. If needed, just take your best guess.\n\n"
+        systemprompt += "Good luck."
+        return systemprompt
+
+    def multi_question_systemprompt(self, questions: List[Question]) -> str:
+        systemprompt = """
+I will present a short document to you. You will read this document and then extract several pieces of information from that document.
+
+The pieces of information I'd like you to extract are listed below, each with a key that identifies it.
+
+"""
+        for question in questions:
+            systemprompt += f"- **{question.key}**: {question.text}\n"
+            if question.required:
+                systemprompt += "  It is mandatory that you provide *some* answer for this one. If needed, just take your best guess.\n"
+
+        systemprompt += f"""
+{self._reply_instructions()} that has one field per piece of information, named by its key exactly as written above, in the order listed. Each one holds an object with the following fields, in this order:
+{self._field_instructions()}
+"""
+        systemprompt += self._schema_instructions(questions, multi_question=True)
+        systemprompt += "Good luck."
+        return systemprompt
@@ -0,0 +1,221 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from typing import Any, Dict, List, Optional
+
+# A durable queue of corpus shards, shared by any number of worker processes
+# (on one host, or on several hosts that see the same file). A shard is a
+# range of document positions, along with where in the corpus its first
+# document can be found (see document_source.iter_source_offsets). Workers lease shards for a limited time and
+# must renew the lease while they work; if a worker crashes, its lease runs
+# out and the shard goes back to whoever asks next.
+
+
+def make_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class WorkQueue:
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+
+    def __init__(self, path: str, *, wal: bool = True):
+        # WAL mode doesn't work on network filesystems. When workers on
+        # several hosts share the queue over NFS or the like, pass wal=False
+        # so that SQLite falls back on ordinary file locking.
+        self.path = path
+        self.wal = wal
+        self._local = threading.local()
+
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS shards ("
+                " shard INTEGER PRIMARY KEY,"
+                " start INTEGER NOT NULL,"
+                " stop INTEGER NOT NULL,"
+                " offset INTEGER,"
+                " status TEXT NOT NULL,"
+                " worker TEXT,"
+                " lease_expires REAL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " output TEXT"
+                ")"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            # isolation_level=None so that we can issue BEGIN IMMEDIATE
+            # ourselves and take the write lock before reading.
+            conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+            if self.wal:
+                conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def set_meta(self, key: str, value: Any):
+        conn = self._transaction()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value))
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_meta(self, key: str, default: Any = None) -> Any:
+        row = (
+            self._connection()
+            .execute("SELECT value FROM meta WHERE key = ?", (key,))
+            .fetchone()
+        )
+        return default if row is None else json.loads(row[0])
+
+    def create_shards(
+        self, total: int, *, shard_size: int, offsets: Optional[List[int]] = None
+    ) -> bool:
+        # Splits positions [0, total) into shards. offsets, if given, holds
+        # each shard's starting offset. Does nothing (and returns False) if
+        # the queue already has shards, so that every worker can safely call
+        # this on startup.
+        conn = self._transaction()
+        try:
+            if conn.execute("SELECT COUNT(*) FROM shards").fetchone()[0]:
+                conn.execute("COMMIT")
+                return False
+            shard_size = max(1, shard_size)
+            conn.executemany(
+                "INSERT INTO shards (shard, start, stop, offset, status)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        n,
+                        start,
+                        min(total, start + shard_size),
+                        offsets[n] if offsets is not None else None,
+                        WorkQueue.PENDING,
+                    )
+                    for n, start in enumerate(range(0, total, shard_size))
+                ],
+            )
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def lease(self, worker_id: str, *, lease_seconds: float) -> Optional[Dict]:
+        # Hands out the lowest-numbered shard that's either pending or whose
+        # lease has run out. Returns None if there isn't one right now.
+        now = time.time()
+        conn = self._transaction()
+        try:
+            row = conn.execute(
+                "SELECT shard, start, stop, offset, attempts FROM shards"
+                " WHERE status = ? OR (status = ? AND lease_expires < ?)"
+                " ORDER BY shard LIMIT 1",
+                (WorkQueue.PENDING, WorkQueue.LEASED, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            shard, start, stop, offset, attempts = row
+            conn.execute(
+                "UPDATE shards SET status = ?, worker = ?, lease_expires = ?,"
+                " attempts = attempts + 1 WHERE shard = ?",
+                (WorkQueue.LEASED, worker_id, now + lease_seconds, shard),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return {
+            "shard": shard,
+            "start": start,
+            "stop": stop,
+            "offset": offset,
+            "attempt": attempts + 1,
+        }
+
+    def _update_if_owner(self, shard: int, worker_id: str, sql: str, params) -> bool:
+        conn = self._transaction()
+        try:
+            cursor = conn.execute(
+                sql + " WHERE shard = ? AND worker = ? AND status = ?",
+                tuple(params) + (shard, worker_id, WorkQueue.LEASED),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def renew(self, shard: int, worker_id: str, *, lease_seconds: float) -> bool:
+        # Returns False if the lease has already been lost to another worker,
+        # in which case this worker should abandon the shard.
+        return self._update_if_owner(
+            shard,
+            worker_id,
+            "UPDATE shards SET lease_expires = ?",
+            (time.time() + lease_seconds,),
+        )
+
+    def complete(self, shard: int, worker_id: str, *, output: str) -> bool:
+        # Only the current lease holder can complete a shard. A worker that
+        # was presumed dead and lost its lease gets False back, and its
+        # output is ignored, so no shard is ever counted twice.
+        return self._update_if_owner(
+            shard,
+            worker_id,
+            "UPDATE shards SET status = ?, lease_expires = NULL, output = ?",
+            (WorkQueue.DONE, output),
+        )
+
+    def release(self, shard: int, worker_id: str) -> bool:
+        # Gives a shard back without finishing it, e.g. after an error.
+        return self._update_if_owner(
+            shard,
+            worker_id,
+            "UPDATE shards SET status = ?, worker = NULL, lease_expires = NULL",
+            (WorkQueue.PENDING,),
+        )
+
+    def progress(self) -> Dict[str, int]:
+        retval = {WorkQueue.PENDING: 0, WorkQueue.LEASED: 0, WorkQueue.DONE: 0}
+        for status, count in self._connection().execute(
+            "SELECT status, COUNT(*) FROM shards GROUP BY status"
+        ):
+            retval[status] = count
+        return retval
+
+    def is_finished(self) -> bool:
+        progress = self.progress()
+        return progress[WorkQueue.PENDING] == 0 and progress[WorkQueue.LEASED] == 0
+
+    def outputs(self) -> List[str]:
+        # The output locations of finished shards, in corpus order.
+        return [
+            row[0]
+            for row in self._connection().execute(
+                "SELECT output FROM shards WHERE status = ? ORDER BY shard",
+                (WorkQueue.DONE,),
+            )
+        ]